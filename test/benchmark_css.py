@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measures how the time taken by the CSS parser grows with the size of the
+stylesheet. The time per KB should stay about the same from 1 KB up to 1 MB.
+
+    python test/benchmark_css.py
+"""
+
+from __future__ import print_function
+
+import sys
+import os
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from xhtml2pdf.w3c import css
+
+_block = u"""
+/* rules for block %(n)d */
+.nav-%(n)d > li.item-%(n)d a:hover, #main-%(n)d p + span {
+    color: #%(color)06x;
+    margin: 0 auto 1.5em;
+    font: bold 12px/1.5 "Helvetica Neue", Arial, sans-serif;
+    background: url(image-%(n)d.png) no-repeat;
+    *zoom: 1;
+}
+@media print {
+    .col-%(n)d { width: %(width)d%% !important; }
+}
+"""
+
+
+def stylesheet(size):
+    """Returns a stylesheet of about `size` characters."""
+    blocks = []
+    length = n = 0
+    while length < size:
+        block = _block % {"n": n, "color": n * 7919 % 0xffffff, "width": n % 100}
+        blocks.append(block)
+        length += len(block)
+        n += 1
+    return u"".join(blocks)[:size].rsplit(u"}", 1)[0] + u"}"
+
+
+def parse(src):
+    css.CSSParser(mediumSet=["all", "print"]).parse(src)
+
+
+def main():
+    print("%10s %12s %12s" % ("size", "seconds", "ms per KB"))
+    for size in (1 << 10, 1 << 14, 1 << 17, 1 << 20):
+        src = stylesheet(size)
+        repeat = max(1, (1 << 17) // size)
+        seconds = min(timeit.repeat(lambda: parse(src), number=repeat, repeat=3)) / repeat
+        print("%10d %12.4f %12.4f" % (len(src), seconds, seconds * 1000 / (len(src) / 1024.0)))
+
+
+if __name__ == "__main__":
+    main()
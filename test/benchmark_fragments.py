@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measures the memory a fragment of text takes: as a ParaFrag with all
+values of its style in its own dictionary, like every fragment was before,
+and as the TextFragment PisaContext makes now, for a paragraph of 100k text
+nodes of one style and of ten styles. The values of a TextFragment are kept
+once by the class of its style.
+
+    python test/benchmark_fragments.py
+"""
+
+from __future__ import print_function
+
+import sys
+import os
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from xhtml2pdf.context import PisaContext
+
+NODES = 100000
+
+
+def size(obj):
+    # The object and its instance dictionary, the values are shared
+    result = sys.getsizeof(obj)
+    if hasattr(obj, "__dict__"):
+        result += sys.getsizeof(obj.__dict__)
+    return result
+
+
+def fragments(styles):
+    c = PisaContext(".")
+    base = c.frag
+    for i in range(NODES):
+        c.frag = base.clone(fontSize=10 + i % styles)
+        c.add_fragment(u"word%d " % i)
+    return c.fragList
+
+
+def main():
+    print("%8s %14s %14s %14s" % ("styles", "ParaFrag", "TextFragment", "classes"))
+    for styles in (1, 10):
+        frags = fragments(styles)
+        shared = set(frag.__class__ for frag in frags)
+        before = sum(size(frag.to_frag()) for frag in frags) // len(frags)
+        after = sum(size(frag) for frag in frags) // len(frags)
+        print("%8d %12d B %12d B %14d" % (styles, before, after, len(shared)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compares the parsers of xhtml2pdf.dom on the documents in this directory
+and on a generated, well-formed report of about 2 MB.
+
+    python test/benchmark_parser.py
+
+Documents a parser can not handle are counted as failed, pisaParser would
+parse them with html5lib.
+"""
+
+from __future__ import print_function
+
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from xhtml2pdf import dom
+
+_row = u"<tr><td class='n'>%(n)d</td><td>Item &amp; description %(n)d</td><td>%(n)d.00&nbsp;EUR</td></tr>\n"
+
+
+def report(size):
+    """Returns a well-formed XHTML document of about `size` bytes."""
+    rows = []
+    length = n = 0
+    while length < size:
+        row = _row % {"n": n}
+        rows.append(row)
+        length += len(row)
+        n += 1
+    return (u"<html><head><title>Report</title></head><body><table>\n%s</table></body></html>"
+            % u"".join(rows)).encode("utf-8")
+
+
+def corpus():
+    directory = os.path.dirname(os.path.abspath(__file__))
+    documents = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.html"))):
+        with open(path, "rb") as f:
+            documents.append(f.read())
+    return documents
+
+
+def measure(parse, documents):
+    failed = 0
+    start = time.time()
+    for src in documents:
+        try:
+            parse(src)
+        except Exception:
+            failed += 1
+    return time.time() - start, failed
+
+
+def main():
+    tests = [("test/*.html", corpus()), ("2 MB report", [report(2 << 20)])]
+    print("%-10s %-14s %10s %8s" % ("parser", "documents", "seconds", "failed"))
+    for name in sorted(dom.PARSERS):
+        for label, documents in tests:
+            if name == "lxml":
+                try:
+                    import lxml
+                except ImportError:
+                    print("%-10s %-14s %10s" % (name, label, "lxml is not installed"))
+                    continue
+            seconds, failed = measure(dom.PARSERS[name], documents)
+            print("%-10s %-14s %10.3f %8d" % (name, label, seconds, failed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measures how long PisaContext takes to take in the text of a paragraph of
+100k words and to turn it into a paragraph: as one text node, as 10k text
+nodes of 10 words each, with NBSP between some of the words and with
+whitespace between blocks.
+
+    python test/benchmark_text.py
+"""
+
+from __future__ import print_function
+
+import sys
+import os
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from xhtml2pdf.context import PisaContext
+
+WORDS = 100000
+
+
+def words(n, sep=u" "):
+    return sep.join(u"word%d" % (i % 1000) for i in range(n))
+
+
+def paragraph(nodes):
+    c = PisaContext(".")
+    for text in nodes:
+        c.add_fragment(text)
+    c.add_paragraph()
+    return c
+
+
+def main():
+    cases = [
+        ("1 node", [u"\n  " + words(WORDS) + u"\n"]),
+        ("10k nodes", [u" " + words(10) + u"\n"] * (WORDS // 10)),
+        ("NBSP", [u" " + words(9) + u"\xa0word"] * (WORDS // 10)),
+        ("blocks", [u"\n    "] * (WORDS // 10)),
+    ]
+    print("%12s %12s" % ("text", "seconds"))
+    for name, nodes in cases:
+        seconds = min(timeit.repeat(lambda: paragraph(nodes), number=1, repeat=3))
+        print("%12s %12.4f" % (name, seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+import os
+import shutil
+import tempfile
+import unittest
+from reportlab.platypus.paraparser import ParaFrag
+from xhtml2pdf.context import PisaContext, coalesce_fragments, stylesheet_cache, inline_style_cache, stylesheet_snapshots
+from xhtml2pdf.util import CSSValue, get_color
+
+_css = """
+@page {
+    size: a5;
+    margin: 1cm;
+}
+p { color: red; }
+"""
+
+
+class StylesheetCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        stylesheet_cache.clear()
+
+    def parse(self, css_text):
+        c = PisaContext(".")
+        c.add_css(css_text)
+        c.parse_css()
+        return c
+
+    def test_repeated_parse_is_cached(self):
+        c1 = self.parse(_css)
+        misses = stylesheet_cache.misses
+        c2 = self.parse(_css)
+        self.assertEqual(stylesheet_cache.misses, misses)
+        self.assertTrue(stylesheet_cache.hits >= 2)
+        self.assertTrue(c1.css is c2.css)
+
+    def test_page_rules_are_replayed(self):
+        c1 = self.parse(_css)
+        c2 = self.parse(_css)
+        self.assertTrue("body" in c1.templateList)
+        self.assertTrue("body" in c2.templateList)
+        self.assertEqual(c1.pageSize, c2.pageSize)
+        self.assertTrue(c1.templateList["body"] is not c2.templateList["body"])
+
+    def test_rule_values_are_compiled(self):
+        c = self.parse(_css)
+        (declarations,) = c.css[0].values()
+        self.assertEqual(declarations["color"].color, get_color("red"))
+
+    def test_import_is_not_cached(self):
+        self.parse('@import "does-not-exist.css";\np { color: red; }')
+        hits = stylesheet_cache.hits
+        self.parse('@import "does-not-exist.css";\np { color: red; }')
+        # Only the default stylesheet is served from the cache
+        self.assertEqual(stylesheet_cache.hits, hits + 1)
+
+    def test_cache_is_bounded(self):
+        maxsize = stylesheet_cache.maxsize
+        stylesheet_cache.maxsize = 2
+        try:
+            for i in range(5):
+                self.parse("p { margin: %dpt; }" % i)
+            self.assertEqual(len(stylesheet_cache), 2)
+        finally:
+            stylesheet_cache.maxsize = maxsize
+
+
+class InlineStyleCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        inline_style_cache.clear()
+        self.c = PisaContext(".")
+        self.c.parse_css()
+
+    def test_repeated_parse_is_cached(self):
+        normal, important = self.c.CSSParser.parse_inline("color: red; margin: 1pt")
+        self.assertTrue(self.c.CSSParser.parse_inline("color: red; margin: 1pt")[0] is normal)
+        self.assertEqual(inline_style_cache.hits, 1)
+
+    def test_shorthands_are_expanded(self):
+        normal, important = self.c.CSSParser.parse_inline("margin: 1pt")
+        self.assertTrue("margin-left" in normal)
+        self.assertFalse("margin" in normal)
+
+    def test_values_are_compiled(self):
+        normal, important = self.c.CSSParser.parse_inline("color: red; margin: 1pt")
+        self.assertTrue(isinstance(normal["color"], CSSValue))
+        self.assertEqual(normal["margin-top"].points, 1.0)
+
+    def test_result_is_immutable(self):
+        normal, important = self.c.CSSParser.parse_inline("color: red")
+        self.assertRaises(TypeError, normal.__setitem__, "color", "blue")
+        self.assertRaises(TypeError, normal.update, {"color": "blue"})
+        self.assertEqual(normal["color"], "red")
+
+
+class StylesheetSnapshotsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        stylesheet_snapshots.directory = self.directory
+        stylesheet_snapshots.hits = stylesheet_snapshots.misses = 0
+        stylesheet_cache.clear()
+
+    def tearDown(self):
+        stylesheet_snapshots.directory = None
+        stylesheet_cache.clear()
+        shutil.rmtree(self.directory)
+
+    def parse(self, css_text):
+        c = PisaContext(".")
+        c.add_css(css_text)
+        c.parse_css()
+        return c
+
+    def test_snapshot_is_loaded(self):
+        c1 = self.parse(_css)
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+        # As if this was a new process
+        stylesheet_cache.clear()
+        c2 = self.parse(_css)
+        self.assertEqual(stylesheet_snapshots.hits, 2)
+        self.assertFalse(c1.css is c2.css)
+        self.assertEqual([str(selector) for selector in c2.css[0]], ["p"])
+        (declarations,) = c2.css[0].values()
+        self.assertEqual(declarations["color"].color, get_color("red"))
+        self.assertTrue(c2.css[0]._index is not None)
+        self.assertTrue("body" in c2.templateList)
+        self.assertEqual(c1.pageSize, c2.pageSize)
+
+    def test_other_version_is_parsed_again(self):
+        self.parse(_css)
+        for name in os.listdir(self.directory):
+            with open(os.path.join(self.directory, name), "r+b") as f:
+                f.write(b"X")
+        stylesheet_cache.clear()
+        c = self.parse(_css)
+        self.assertEqual(stylesheet_snapshots.hits, 0)
+        self.assertTrue("body" in c.templateList)
+        # The snapshots are written again
+        stylesheet_cache.clear()
+        self.parse(_css)
+        self.assertEqual(stylesheet_snapshots.hits, 2)
+
+    @unittest.skipUnless(hasattr(os, "getuid"), "no user ids")
+    def test_snapshot_others_can_write_is_not_loaded(self):
+        self.parse(_css)
+        for name in os.listdir(self.directory):
+            os.chmod(os.path.join(self.directory, name), 0o666)
+        stylesheet_cache.clear()
+        c = self.parse(_css)
+        self.assertEqual(stylesheet_snapshots.hits, 0)
+        self.assertTrue("body" in c.templateList)
+
+    @unittest.skipUnless(hasattr(os, "getuid"), "no user ids")
+    def test_directory_others_can_write_is_not_used(self):
+        self.parse(_css)
+        os.chmod(self.directory, 0o777)
+        stylesheet_cache.clear()
+        self.parse(_css)
+        self.assertEqual(stylesheet_snapshots.hits, 0)
+
+    def test_missing_directory(self):
+        stylesheet_snapshots.directory = os.path.join(self.directory, "missing")
+        c = self.parse(_css)
+        self.assertTrue("body" in c.templateList)
+
+
+def _collapse(texts):
+    # The whitespace handling add_fragment had before it was rewritten
+    result = []
+    strip = True
+    for text in texts:
+        text = " ".join(("x" + text + "x").split())[1: - 1]
+        if strip:
+            text = text.lstrip()
+            if text:
+                strip = False
+        result.append(text)
+    return result
+
+
+class AddFragmentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.c = PisaContext(".")
+
+    def test_whitespace_is_collapsed(self):
+        texts = [u"\n  a  b\t", u" ", u"c", u"\n", u"  d e  ", u"", u"f"]
+        for text in texts:
+            self.c.add_fragment(text)
+        self.assertEqual([f.text for f in self.c.fragList], _collapse(texts))
+        self.assertEqual(self.c.text, u"".join(_collapse(texts)))
+
+    def test_nbsp(self):
+        self.c.add_fragment(u"a\xa0 b\xc2\xa0c\xad")
+        self.assertEqual([f.text for f in self.c.fragList], [u"a", u"\xa0", u" b", u"\xa0", u"c"])
+        self.assertTrue(self.c.force)
+
+    def test_whitespace_between_blocks_is_left_out(self):
+        self.c.add_fragment(u"\n  ")
+        self.assertEqual(self.c.fragList, [])
+        self.c.add_paragraph()
+        self.assertEqual(self.c.story, [])
+
+    def test_forced_paragraph_keeps_the_whitespace_style(self):
+        self.c.frag.fontSize = 20
+        self.c.add_fragment(u"\n  ")
+        self.c.frag = self.c.frag.clone(fontSize=10)
+        self.c.add_paragraph(force=True)
+        self.assertEqual([f.fontSize for f in self.c.story[0].frags], [20, 20])
+
+    def test_pre_has_a_fragment_per_line(self):
+        self.c.frag.whiteSpace = "pre"
+        self.c.add_fragment(u" a  b\n\tc\r\n\n")
+        self.assertEqual([(f.text, getattr(f, "lineBreak", 0)) for f in self.c.fragList], [
+            (u"\xa0a\xa0\xa0b", 0), (u"", 1), (8 * u"\xa0" + u"c", 0), (u"", 1), (u"", 0), (u"", 1), (u"", 0)])
+        self.assertEqual(self.c.text, u" a  b\n\tc\r\n\n")
+
+    def test_paragraph_text(self):
+        self.c.add_fragment(u"a ")
+        self.c.add_fragment(u"b")
+        self.c.add_paragraph()
+        self.assertEqual(self.c.story[0].text, u"a b")
+        self.assertEqual(self.c.text, u"")
+
+
+class SharedStyleTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.c = PisaContext(".")
+
+    def test_fragments_share_their_values(self):
+        self.c.add_fragment(u"a\xa0b")
+        self.c.frag = self.c.frag.clone(fontSize=20)
+        self.c.add_fragment(u" c")
+        a, nbsp, b, c = self.c.fragList
+        self.assertTrue(a.__class__ is nbsp.__class__ is b.__class__)
+        self.assertFalse(c.__class__ is a.__class__)
+        self.assertFalse(hasattr(a, "__dict__"))
+        self.assertEqual((a.fontSize, c.fontSize), (10, 20))
+        self.assertEqual(a.clone(text=u"x").__class__, a.__class__)
+
+    def test_fragment_slots(self):
+        self.c.frag.link = "#a"
+        self.c.add_fragment(u"a")
+        (a,) = self.c.fragList
+        self.assertEqual((a.link, a.leading), ("#a", 0))
+        self.assertFalse(hasattr(a, "lineBreak"))
+        a.link = None
+        b = a.clone(text=u"b", lineBreak=1)
+        self.assertEqual((b.text, b.link, b.lineBreak, b.fontSize), (u"b", None, 1, 10))
+        self.assertFalse(hasattr(a, "lineBreak"))
+
+    def test_clone_with_other_attributes(self):
+        self.c.add_fragment(u"a")
+        lines = self.c.fragList[0].clone(kind=0, lines=[])
+        self.assertTrue(isinstance(lines, ParaFrag))
+        self.assertEqual((lines.text, lines.kind, lines.lines, lines.fontSize), (u"a", 0, [], 10))
+
+    def test_values_of_other_types_are_not_shared(self):
+        self.c.add_fragment(u"a")
+        self.c.frag = self.c.frag.clone(fontSize=10.0)
+        self.c.add_fragment(u"b")
+        a, b = self.c.fragList
+        self.assertEqual((type(a.fontSize), type(b.fontSize)), (int, float))
+
+    def test_unhashable_values_are_not_shared(self):
+        self.c.frag.unhashable = []
+        self.c.add_fragment(u"a")
+        self.assertTrue(isinstance(self.c.fragList[0], ParaFrag))
+
+    def test_paragraphs_share_their_style(self):
+        for text in (u"a", u"b", u"c"):
+            self.c.add_fragment(text)
+            self.c.add_paragraph()
+        self.c.fragBlock.leadingSpace = 1
+        self.c.add_fragment(u"d")
+        self.c.add_paragraph()
+        a, b, c, d = [p.style for p in self.c.story]
+        self.assertTrue(a is b is c)
+        self.assertFalse(d is a)
+        self.assertEqual((a.leading, d.leading), (15, 16))
+
+
+class CoalesceFragmentsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.c = PisaContext(".")
+
+    def test_fragments_of_the_same_style_are_joined(self):
+        self.c.add_fragment(u"a\xa0b")
+        # An element without a style of its own
+        self.c.push_fragment()
+        self.c.add_fragment(u" c")
+        self.c.pull_fragment()
+        self.c.add_fragment(u" d")
+        self.assertEqual(len(self.c.fragList), 5)
+        self.c.add_paragraph()
+        self.assertEqual([f.text for f in self.c.story[0].frags], [u"a\xa0b c d", u""])
+
+    def test_fragments_staying_on_their_own(self):
+        self.c.add_fragment(u"a")
+        self.c.frag.fontSize = 20
+        self.c.add_fragment(u" b")
+        self.c.frag.fontSize = 10
+        self.c.add_fragment(u" ")
+        self.c.add_fragment(u"c ")
+        self.c.frag.link = "http://example.com"
+        self.c.add_fragment(u"d")
+        self.c.frag.link = None
+        self.c.frag.pageNumber = True
+        self.c.add_fragment(u"1")
+        self.c.add_fragment(u"2")
+        self.c.frag.pageNumber = False
+        self.c.add_fragment(u"e")
+        self.c.add_fragment(u" f")
+        self.assertEqual([f.text for f in coalesce_fragments(self.c.fragList)],
+                         [u"a", u" b", u" ", u"c ", u"d", u"1", u"2", u"e f"])
+
+    def test_whitespace_is_not_doubled(self):
+        for text in (u"a ", u" b", u"", u"c"):
+            self.c.add_fragment(text)
+        self.assertEqual([f.text for f in coalesce_fragments(self.c.fragList)], [u"a ", u" bc"])
+
+
+def buildTestSuite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
+
+
+def main():
+    buildTestSuite()
+    unittest.main()
+
+if __name__ == "__main__":
+    main()
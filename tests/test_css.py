@@ -0,0 +1,278 @@
+import unittest
+import xml.dom.minidom
+
+from six.moves import cPickle as pickle
+
+from xhtml2pdf.w3c import css, cssDOMElementInterface
+from xhtml2pdf.w3c.cssDOMElementInterface import CSSDOMElementInterface
+
+_css = """
+p { color: red; }
+.note { color: green; }
+p.note { color: blue; }
+#main { margin-left: 1pt; }
+div { color: black; }
+p { color: yellow; }
+"""
+
+
+def _element(source):
+    document = xml.dom.minidom.parseString(source)
+    return CSSDOMElementInterface(document.documentElement)
+
+
+class CSSRulesetTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.normal, self.important = css.CSSParser(mediumSet=["all"]).parse(_css)
+
+    def test_index_buckets(self):
+        index = self.normal.getIndex()
+        self.assertEqual(sorted(index.tags), ["div", "p"])
+        self.assertEqual(list(index.classes), ["note"])
+        self.assertEqual(list(index.ids), ["main"])
+        self.assertEqual(index.universal, [])
+
+    def test_candidates(self):
+        index = self.normal.getIndex()
+        rules = index.findCandidateRules(_element('<p class="other note"/>'))
+        self.assertEqual(len(rules), 4)
+
+    def test_tag_style(self):
+        index = self.normal.getIndex()
+        style = index.getTagStyle("p")
+        self.assertEqual(dict((k, v[2]) for k, v in style.items()), {"color": "yellow"})
+        self.assertTrue(index.getTagStyle("p") is style)
+        self.assertEqual(index.getTagStyle("span"), {})
+        self.assertEqual(index.qualifiedTags, {})
+
+    def test_matching_styles(self):
+        styles = self.normal.findMatchingStyles(_element('<p class="note"/>'))
+        self.assertEqual(styles["color"][2], "blue")
+        self.assertEqual(self.normal.getIndex().getTagStyle("p")["color"][2], "yellow")
+
+    def test_most_specific_rule_is_last(self):
+        rules = self.normal.findCSSRulesFor(_element('<p class="note"/>'), "color")
+        self.assertEqual([d["color"] for s, d in rules], ["red", "yellow", "green", "blue"])
+
+    def test_later_rule_wins_for_same_specificity(self):
+        rules = self.normal.findCSSRuleFor(_element('<p/>'), "color")
+        self.assertEqual(rules[0][1]["color"], "yellow")
+
+    def test_source_order(self):
+        # Twelve classes, more than a dict of Python 2 keeps in order
+        source = "".join(".c%d { font-size: %dpt; }" % (i, i + 5) for i in range(12))
+        normal, important = css.CSSParser(mediumSet=["all"]).parse(source)
+        classes = " ".join("c%d" % i for i in range(12))
+        element = _element('<p class="%s"/>' % classes)
+        self.assertEqual([str(s) for s, d in normal.orderedItems()], ["*.c%d" % i for i in range(12)])
+        self.assertEqual(normal.findCSSRuleFor(element, "font-size")[0][1]["font-size"], ("16", "pt"))
+        self.assertEqual(normal.findMatchingStyles(element)["font-size"][2], ("16", "pt"))
+        pruned, count = normal.prune(set(["p"]), set(["c%d" % i for i in range(12)]), set())
+        self.assertEqual(pruned.orderedItems(), normal.orderedItems())
+        loaded = pickle.loads(pickle.dumps(normal, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual([str(s) for s, d in loaded.orderedItems()], ["*.c%d" % i for i in range(12)])
+
+    def test_index_is_rebuilt_after_change(self):
+        self.normal.getIndex()
+        self.normal.mergeStyles(css.CSSParser(mediumSet=["all"]).parse("span { color: red; }")[0])
+        self.assertTrue("span" in self.normal.getIndex().tags)
+
+    def test_pickled_selector_hash(self):
+        selector = list(self.normal)[0]
+        selector._hash = 0
+        loaded = pickle.loads(pickle.dumps(selector, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(hash(loaded), hash(selector.fromSelector(selector)))
+
+    def test_prune(self):
+        pruned, count = self.normal.prune(set(["p"]), set(), set(["main"]))
+        self.assertEqual(count, 3)
+        self.assertEqual(sorted(str(selector) for selector in pruned), ["*#main", "p", "p"])
+        self.assertEqual(len(self.normal), 6)
+
+
+class CSSCascadeStrategyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cascade = css.CSSCascadeStrategy(author=css.CSSParser(mediumSet=["all"]).parse(_css))
+
+    def test_styles_for_element(self):
+        element = _element('<p id="main" class="note"/>')
+        styles = self.cascade.findStylesForElement(element)
+        self.assertEqual(styles, {"color": "blue", "margin-left": ("1", "pt")})
+        for attrName, value in styles.items():
+            self.assertEqual(self.cascade.findStyleFor(element, attrName), value)
+
+    def test_styles_for_element_filtered(self):
+        styles = self.cascade.findStylesForElement(_element('<p id="main"/>'), frozenset(["color"]))
+        self.assertEqual(styles, {"color": "yellow"})
+
+    def test_inline_style_wins(self):
+        element = _element('<p class="note" style="color: white"/>')
+        element.setInlineStyle(css.CSSParser(mediumSet=["all"]).parse_inline("color: white"))
+        self.assertEqual(self.cascade.findStylesForElement(element)["color"], "white")
+
+    def test_styles_for_each(self):
+        styles = dict(self.cascade.findStylesForEach(_element('<p class="note"/>'), ["color"]))
+        self.assertEqual(styles, {"color": "blue"})
+
+
+_nested = """
+<div class="report">
+<table id="main"><tr><td title="x"><span class="note">A</span></td></tr></table>
+<p><span>B</span></p>
+</div>
+"""
+
+_selectors = """
+.report span { color: red; }
+#main span { color: red; }
+.other span { color: red; }
+#other span { color: red; }
+[title] span { color: red; }
+.report .note span { color: red; }
+.other .note span { color: red; }
+"""
+
+
+class CSSAncestorFilterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.document = xml.dom.minidom.parseString(_nested.strip())
+        self.selectors = list(css.CSSParser(mediumSet=["all"]).parse(_selectors)[0])
+
+    def elements(self, node, ancestors):
+        for child in node.childNodes:
+            if child.nodeType == child.ELEMENT_NODE:
+                element = CSSDOMElementInterface(child)
+                element.setAncestorFilter(ancestors)
+                self.assertTrue(element.getAncestorFilter() is ancestors)
+                yield element
+                ancestors.push(CSSDOMElementInterface(child))
+                for element in self.elements(child, ancestors):
+                    yield element
+                ancestors.pop()
+
+    def test_same_matches_as_walking_the_tree(self):
+        ancestors = css.CSSAncestorFilter()
+        count = 0
+        for element in self.elements(self.document, ancestors):
+            walking = CSSDOMElementInterface(element.domElement)
+            for selector in self.selectors:
+                self.assertEqual(selector.matches(element), selector.matches(walking))
+                count += selector.matches(element)
+        self.assertEqual(count, 6)
+        self.assertEqual((ancestors.elements, ancestors.classes, ancestors.ids), ([], {}, {}))
+
+    def test_filter_of_other_parent_is_not_used(self):
+        ancestors = css.CSSAncestorFilter()
+        ancestors.push(CSSDOMElementInterface(self.document.documentElement))
+        element = CSSDOMElementInterface(self.document.getElementsByTagName("span")[0])
+        element.setAncestorFilter(ancestors)
+        self.assertTrue(element.getAncestorFilter() is None)
+
+    def test_filter_is_checked_when_used(self):
+        ancestors = css.CSSAncestorFilter()
+        td = self.document.getElementsByTagName("td")[0]
+        ancestors.push(CSSDOMElementInterface(td))
+        element = CSSDOMElementInterface(self.document.getElementsByTagName("span")[0])
+        element.setAncestorFilter(ancestors)
+        self.assertTrue(element.getAncestorFilter() is ancestors)
+        # pisaLoop has moved on to another element
+        ancestors.pop()
+        ancestors.push(CSSDOMElementInterface(td.parentNode))
+        self.assertTrue(element.getAncestorFilter() is None)
+
+
+class CSSDOMElementInterfaceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.document = xml.dom.minidom.parseString(_nested.strip())
+        cssDOMElementInterface.indexElements(self.document)
+
+    def element(self, tagName, index=0):
+        return cssDOMElementInterface.getElementInterface(self.document.getElementsByTagName(tagName)[index])
+
+    def test_one_interface_per_element(self):
+        span = self.element("span")
+        self.assertTrue(span is self.element("span"))
+        parents = list(span.iterXMLParents())
+        self.assertEqual([parent.getTagName() for parent in parents], ["td", "tr", "table", "div"])
+        self.assertTrue(parents[2] is self.element("table"))
+
+    def test_siblings(self):
+        table, p = self.element("table"), self.element("p")
+        self.assertTrue(table.getPreviousSibling() is None)
+        self.assertTrue(table.getNextSibling() is p)
+        self.assertTrue(p.getPreviousSibling() is table)
+        self.assertTrue(p.inPseudoState("last-child"))
+        self.assertFalse(p.inPseudoState("first-child"))
+
+    def test_class_names_follow_set_attr(self):
+        span = self.element("span")
+        self.assertEqual(span.getClassNames(), frozenset(["note"]))
+        span.setAttr("class", "a b")
+        self.assertEqual(span.getClassNames(), frozenset(["a", "b"]))
+
+    def test_adjacent_sibling_selector(self):
+        (selector,) = css.CSSParser(mediumSet=["all"]).parse("table + p { color: red; }")[0]
+        self.assertTrue(selector.matches(self.element("p")))
+        self.assertFalse(selector.matches(self.element("table")))
+
+
+class CSSParserTestCase(unittest.TestCase):
+
+    def parse(self, src):
+        return css.CSSParser(mediumSet=["all"]).parse(src)[0]
+
+    def declarations(self, src):
+        (declarations,) = self.parse(src).values()
+        return declarations
+
+    def test_large_stylesheet(self):
+        src = "".join(".c%d { margin-left: %dpt; }\n" % (i, i) for i in range(2000))
+        rules = self.parse(src)
+        self.assertEqual(len(rules), 2000)
+        (rule,) = rules.getIndex().classes["c1999"]
+        self.assertEqual(rule[-1]["margin-left"], ("1999", "pt"))
+
+    def test_star_hack(self):
+        declarations = self.declarations("p { color: red; *zoom: 1 }")
+        self.assertEqual(declarations, {"color": "red", "-nothing-zoom": "1"})
+
+    def test_unknown_at_rule_statement_is_skipped(self):
+        self.assertEqual(self.declarations("@foo bar; p { color: red }"), {"color": "red"})
+
+    def test_unknown_at_rule_block_is_skipped(self):
+        self.assertEqual(self.declarations("@foo { width: 1px } p { color: red }"), {"color": "red"})
+
+    def test_at_rule_ident(self):
+        from xhtml2pdf.w3c.cssParser import is_at_rule_ident
+        self.assertTrue(is_at_rule_ident("p {} @media print {}", "media", 5))
+        self.assertFalse(is_at_rule_ident("p {} @media print {}", "media"))
+        self.assertFalse(is_at_rule_ident("@page {}", "media"))
+        self.assertEqual(self.declarations("@media all { p { color: red } }"), {"color": "red"})
+
+    def test_comments(self):
+        self.assertEqual(self.declarations("/* a */ p /* b */ { color: /* c */ red }"), {"color": "red"})
+
+    def test_parse_error(self):
+        try:
+            self.parse("p { color: red")
+        except css.CSSParseError as err:
+            self.assertEqual(err.src, "")
+            self.assertEqual(err.ctxsrc, "{ color: red")
+        else:
+            self.fail("CSSParseError not raised")
+
+
+def buildTestSuite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
+
+
+def main():
+    buildTestSuite()
+    unittest.main()
+
+if __name__ == "__main__":
+    main()
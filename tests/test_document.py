@@ -0,0 +1,118 @@
+import threading
+import unittest
+import six
+from xhtml2pdf.document import pisa_document, pisa_story
+
+_template = """
+<style>
+td { color: red; }
+.c%(n)d { font-weight: bold; font-size: %(size)dpt; }
+</style>
+<h1>Document %(n)d</h1>
+<table>
+%(rows)s
+</table>
+<p class="c%(n)d">Text <b>bold</b> <i>italic</i></p>
+"""
+
+
+def _document(n):
+    rows = "".join(
+        "<tr><td class='c%d'>%d</td><td bgcolor='#ff0000'>cell</td></tr>" % (n, i)
+        for i in range(20))
+    return (_template % {"n": n, "size": 8 + n, "rows": rows}).encode("utf-8")
+
+
+def _signature(c):
+    """
+    Describes the story, the pending fragments and the computed styles of a
+    context, object ids and other details which differ between two
+    identical renders are left out.
+    """
+    result = []
+    for flowable in c.story:
+        frags = getattr(flowable, "frags", [])
+        result.append((flowable.__class__.__name__,
+                       [(f.text, f.fontName, f.fontSize, str(f.textColor)) for f in frags]))
+    for f in c.fragList:
+        result.append((f.text, f.fontName, f.fontSize, str(f.textColor), str(f.backColor)))
+    for shareKey, cssAttrs in sorted(c.cssAttrCache.values(), key=lambda item: item[0]):
+        result.append(repr(sorted(cssAttrs.items())))
+    return result
+
+
+class ConcurrentRenderingTestCase(unittest.TestCase):
+
+    documents = 4
+    threads = 12
+
+    def render(self, n):
+        return _signature(pisa_story(_document(n)))
+
+    def test_concurrent_renders_equal_serial_renders(self):
+        serial = [self.render(n) for n in range(self.documents)]
+        results = {}
+        errors = []
+
+        def worker(i):
+            try:
+                results[i] = self.render(i % self.documents)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        for i in range(self.threads):
+            self.assertEqual(results[i], serial[i % self.documents])
+
+
+class _ReadOnce(object):
+    # Like a pipe, it can not seek
+
+    def __init__(self, data):
+        self.read = six.BytesIO(data).read
+
+
+class StreamTestCase(unittest.TestCase):
+
+    @unittest.skipIf(six.PY3, "reportlab_paragraph does not lay out paragraphs on Python 3 yet")
+    def test_stream(self):
+        src = b"<h1><a name='top'></a>Head</h1>" + b"".join(b"<p>%d <a href='#top'>top</a></p>" % i for i in range(200))
+        serial = pisa_story(src)
+        c = pisa_document(src, stream=True)
+        self.assertEqual(c.err, 0)
+        self.assertEqual(c.story, [])
+        self.assertEqual(c.anchorName, serial.anchorName)
+
+    @unittest.skipIf(six.PY3, "reportlab_paragraph does not lay out paragraphs on Python 3 yet")
+    def test_pagecount_is_rendered_in_two_passes(self):
+        src = six.BytesIO(b"".join(b"<p>%d of <pdf:pagecount></pdf:pagecount></p>" % i for i in range(200)))
+        c = pisa_document(src, stream=True)
+        self.assertEqual(c.err, 0)
+        self.assertTrue(c.multiBuild)
+        self.assertIsNone(c.storySink)
+
+    @unittest.skipIf(six.PY3, "reportlab_paragraph does not lay out paragraphs on Python 3 yet")
+    def test_pagecount_of_input_read_once_stays_empty(self):
+        src = _ReadOnce(b"".join(b"<p>%d of <pdf:pagecount></pdf:pagecount></p>" % i for i in range(200)))
+        c = pisa_document(src, stream=True)
+        self.assertEqual(c.err, 0)
+        self.assertFalse(c.storySink.restart)
+        self.assertEqual(c.warn, 1)
+
+
+def buildTestSuite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
+
+
+def main():
+    buildTestSuite()
+    unittest.main()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+import logging
+import unittest
+import xml.etree.ElementTree as ElementTree
+from reportlab.lib.colors import Color
+from xhtml2pdf import dom
+from xhtml2pdf.context import PisaContext
+from xhtml2pdf.document import pisa_story
+
+try:
+    import lxml
+except ImportError:
+    lxml = None
+
+_document = b"""<html>
+<head><title>T</title></head>
+<body><p class="a">x&amp;y&nbsp;<b>z</b><!-- c --></p><pdf:toc></pdf:toc></body></html>"""
+
+
+def _xml(document):
+    return document.documentElement.toxml()
+
+
+def _text(c):
+    # html5lib splits text at entities, the fragments differ but not the text
+    return [u"".join(f.text for f in getattr(flowable, "frags", [])) for flowable in c.story]
+
+
+class ParserTestCase(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.WARNING)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_expat_builds_the_same_tree(self):
+        self.assertEqual(_xml(dom.parse(_document, parser="expat")), _xml(dom.parse(_document)))
+
+    def test_body_is_added(self):
+        for src in (b"<p>a</p>", b"<html><p>a</p></html>", b"<html><head/><p>a</p></html>"):
+            self.assertEqual(_xml(dom.parse(src, parser="expat")), "<html><head/><body><p>a</p></body></html>")
+
+    def test_expat_falls_back_to_html5lib(self):
+        self.assertEqual(_xml(dom.parse(b"<p>a<br>b", parser="expat")), _xml(dom.parse(b"<p>a<br>b")))
+
+    def test_encoding(self):
+        src = u"<p>ä</p>".encode("latin-1")
+        self.assertEqual(_xml(dom.parse(src, encoding="latin-1", parser="expat")),
+                         u"<html><head/><body><p>ä</p></body></html>")
+
+    def test_unknown_parser(self):
+        self.assertRaises(ValueError, dom.parse, _document, parser="sgml")
+
+    def test_lxml(self):
+        # Without lxml html5lib is used
+        document = dom.parse(_document, parser="lxml")
+        self.assertEqual(document.getElementsByTagName("b")[0].firstChild.data, "z")
+        if lxml is not None:
+            body = dom.parse(_document).getElementsByTagName("body")[0]
+            self.assertEqual(document.getElementsByTagName("body")[0].toxml(), body.toxml())
+
+    def test_story(self):
+        self.assertEqual(_text(pisa_story(_document, parser="expat")), _text(pisa_story(_document)))
+
+
+_tree = b"""<html xmlns="http://www.w3.org/1999/xhtml">
+<head><title>T</title></head>
+<body><p class="a">x&amp;y&#160;<b>z</b><!-- c --></p><p>b</p></body></html>"""
+
+
+def _body(document):
+    return document.getElementsByTagName("body")[0].toxml()
+
+
+class ParseTreeTestCase(unittest.TestCase):
+
+    def test_element_tree(self):
+        if hasattr(ElementTree.TreeBuilder, "comment"):
+            parser = ElementTree.XMLParser(target=ElementTree.TreeBuilder(insert_comments=True))
+        else:
+            parser = None
+        tree = ElementTree.ElementTree(ElementTree.fromstring(_tree, parser))
+        expected = _body(dom.parse(_tree, parser="expat"))
+        if parser is None:
+            expected = expected.replace("<!-- c -->", "")
+        self.assertEqual(_body(dom.parse(tree)), expected)
+        self.assertEqual(_body(dom.parse(tree.getroot())), expected)
+
+    def test_minidom(self):
+        document = dom.parse(_document)
+        copy = dom.parse(document)
+        self.assertFalse(copy is document)
+        self.assertEqual(copy.toxml(), document.toxml())
+
+    def test_minidom_is_not_changed(self):
+        document = dom.parse(b'<p class="a">a<pdf:toc></pdf:toc></p>')
+        xml = document.toxml()
+        pisa_story(document)
+        self.assertEqual(document.toxml(), xml)
+        self.assertFalse(hasattr(document.getElementsByTagName("p")[0], "cssElement"))
+
+    def test_element_tree_prefix(self):
+        src = b'<html xmlns:pdf="urn:pdf"><body><p>a</p><pdf:nextpage/><p>b</p></body></html>'
+        tree = ElementTree.fromstring(src)
+        self.assertRaises(ValueError, dom.parse_tree, tree)
+        document = dom.parse_tree(tree, namespaces={"pdf": "urn:pdf"})
+        self.assertEqual(len(document.getElementsByTagName("pdf:nextpage")), 1)
+        c = pisa_story(document)
+        self.assertEqual([flowable.__class__.__name__ for flowable in c.story][1:2], ["PageBreak"])
+
+    def test_lxml(self):
+        if lxml is None:
+            return
+        from lxml import etree
+        tree = etree.fromstring(_document, etree.HTMLParser())
+        self.assertEqual(dom.parse(tree).getElementsByTagName("body")[0].toxml(),
+                         dom.parse(_document).getElementsByTagName("body")[0].toxml())
+
+    def test_story(self):
+        tree = ElementTree.fromstring(_tree)
+        expected = _text(pisa_story(_tree))
+        self.assertEqual(_text(pisa_story(tree)), expected)
+        self.assertEqual(_text(pisa_story(tree, xhtml=True)), expected)
+
+
+_xhtml = b"""<?xml version="1.0"?>
+<html><head><style>p:first-child { color: red } p:last-child { color: blue } h1 + p { color: green }</style></head>
+<body>
+<p>first</p><h1>T</h1><p>x&amp;y&nbsp;</p>%s<table><tr><td>c</td></tr></table><p>last</p></body></html>
+""" % b"".join(b"<p>%d <b>b</b></p>" % i for i in range(20))
+
+
+def _styles(c):
+    return [[(f.text, f.textColor) for f in getattr(flowable, "frags", [])] for flowable in c.story]
+
+
+class XHTMLStreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        dom.XHTMLStream.chunk_size = 32
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        del dom.XHTMLStream.chunk_size
+
+    def test_same_story(self):
+        self.assertEqual(_styles(pisa_story(_xhtml, xhtml=True, stream=True)),
+                         _styles(pisa_story(_xhtml, parser="expat")))
+
+    def test_xhtml_is_not_streamed_by_default(self):
+        src = b"""<html><head/><body><h1>a</h1><p>b</p><p>c</p>
+<style>h1 + p + p { color: red }</style><p>d</p></body></html>"""
+        c = pisa_story(src, xhtml=True)
+        # The style in the body and the selector reaching back two siblings
+        self.assertEqual([p.frags[0].textColor for p in c.story], [Color(0, 0, 0)] * 2 + [Color(1, 0, 0), Color(0, 0, 0)])
+        c = pisa_story(b"<html><head/><body><p>a</p><p>b<br></p></body></html>", xhtml=True)
+        self.assertEqual([p.text for p in c.story], ["a", "b"])
+
+    def test_body_is_streamed(self):
+        stream = dom.XHTMLStream(_xhtml)
+        document = stream.parse_head()
+        self.assertTrue(stream.streaming)
+        self.assertEqual(document.getElementsByTagName("style")[0].parentNode.tagName, "head")
+        body = document.getElementsByTagName("body")[0]
+        stream.stream_body()
+        names = []
+        for node in body.childNodes:
+            self.assertTrue(len(body.childNodes) <= 4)
+            if node.nodeType == node.ELEMENT_NODE:
+                names.append(node.tagName)
+        self.assertEqual(names, ["p", "h1"] + ["p"] * 21 + ["table", "p"])
+        self.assertEqual(len(body.childNodes), 0)
+        self.assertFalse(stream.streaming)
+
+    def test_head_is_added(self):
+        html = dom.XHTMLStream(b"<html>\n<body><p>a</p></body></html>").parse_head().documentElement
+        self.assertEqual([node.tagName for node in html.childNodes], ["head", "body"])
+
+    def test_not_well_formed_uses_html5lib(self):
+        src = b"<html><head><title>a</head><body><p>a<br>b</body></html>"
+        stream = dom.XHTMLStream(src)
+        self.assertEqual(_xml(stream.parse_head()), _xml(dom.parse(src)))
+        self.assertFalse(stream.streaming)
+
+    def test_xhtml_uses_expat(self):
+        document = dom.parse(b"<p>a</p>", xhtml=True)
+        self.assertEqual(_xml(document), "<html><head/><body><p>a</p></body></html>")
+
+
+class HTMLStreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        dom.HTMLStream.queue_size = 2
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        del dom.HTMLStream.queue_size
+
+    def test_same_story(self):
+        self.assertEqual(_styles(pisa_story(_xhtml, stream=True)), _styles(pisa_story(_xhtml)))
+
+    def test_body_is_streamed(self):
+        stream = dom.HTMLStream(_xhtml)
+        document = stream.parse_head()
+        self.assertTrue(stream.streaming)
+        self.assertEqual(document.getElementsByTagName("style")[0].parentNode.tagName, "head")
+        body = document.getElementsByTagName("body")[0]
+        stream.stream_body()
+        names = []
+        for node in body.childNodes:
+            if node.nodeType == node.ELEMENT_NODE:
+                names.append(node.tagName)
+        self.assertEqual(names, ["p", "h1"] + ["p"] * 21 + ["table", "p"])
+        self.assertEqual(len(body.childNodes), 0)
+        self.assertFalse(stream.streaming)
+
+    def test_nodes_are_detached(self):
+        # The parser thread does not change a node after handing it over
+        stream = dom.HTMLStream(_xhtml)
+        body = stream.parse_head().getElementsByTagName("body")[0]
+        stream.stream_body()
+        for node in body.childNodes:
+            self.assertIs(node.parentNode, body)
+            self.assertIsNone(node.previousSibling)
+            self.assertIsNone(node.nextSibling)
+            self.assertNotIn(node, body.childNodes)
+
+    def test_close_stops_the_parser(self):
+        stream = dom.HTMLStream(_xhtml)
+        body = stream.parse_head().getElementsByTagName("body")[0]
+        stream.stream_body()
+        for node in body.childNodes:
+            break
+        stream.close()
+        stream.thread.join(5)
+        self.assertFalse(stream.thread.is_alive())
+
+    def test_document_without_body(self):
+        stream = dom.HTMLStream(b"<frameset><frame src='a.html'></frameset>")
+        stream.parse_head()
+        self.assertFalse(stream.streaming)
+
+    def test_story_is_handed_over_in_parts(self):
+        parts = []
+        c = PisaContext(None)
+        c.storySink = parts.append
+        pisa_story(_xhtml, context=c, stream=True)
+        self.assertTrue(len(parts) > 20)
+        self.assertEqual(c.story, [])
+
+
+def buildTestSuite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
+
+
+def main():
+    buildTestSuite()
+    unittest.main()
+
+if __name__ == "__main__":
+    main()
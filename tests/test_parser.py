@@ -1,6 +1,14 @@
 import unittest
-from xhtml2pdf.parser import pisaParser
+import xml.dom.minidom
+import sys
+from random import Random
+from xhtml2pdf import dom
+from xhtml2pdf.parser import pisaParser, getCSSAttrCacheKey, TAG_HANDLERS, pisaTagPDFNEXTPAGE, pisaTagTD
+from xhtml2pdf.parser import pisaGetAttributes, pisaPreLoop, attrNameSet
 from xhtml2pdf.context import PisaContext
+from xhtml2pdf.default import DEFAULT_CSS, TAGS
+from xhtml2pdf.w3c import css, cssDOMElementInterface
+from xhtml2pdf.w3c.cssDOMElementInterface import CSSDOMElementInterface
 
 _data = b"""
 <!doctype html>
@@ -33,6 +41,374 @@ class TestCase(unittest.TestCase):
         self.assertEqual(c, r)
 
 
+_table = """
+<table>
+<tr><td>A</td><td align="right">B</td></tr>
+<tr><td>A</td><td align="right">B</td></tr>
+</table>
+"""
+
+
+class StyleSharingTestCase(unittest.TestCase):
+
+    def keys(self, dependencies):
+        document = xml.dom.minidom.parseString(_table.strip())
+        keys = []
+        for tr in document.getElementsByTagName("tr"):
+            tr.parentNode.cssShareKey = 1
+            tr.cssShareKey = 2
+            for td in tr.getElementsByTagName("td"):
+                td.cssShareKey = getCSSAttrCacheKey(td, dependencies)
+                keys.append(td.cssShareKey)
+        return keys
+
+    def test_cells_of_rows_share_style(self):
+        keys = self.keys(((), False, False))
+        self.assertEqual(keys[0], keys[1])
+        self.assertEqual(keys[0], keys[2])
+
+    def test_attribute_selectors(self):
+        keys = self.keys((("align",), False, False))
+        self.assertNotEqual(keys[0], keys[1])
+        self.assertEqual(keys[1], keys[3])
+
+    def test_pseudo_classes(self):
+        keys = self.keys(((), True, False))
+        self.assertNotEqual(keys[0], keys[1])
+        self.assertEqual(keys[0], keys[2])
+
+    def test_adjacent_siblings(self):
+        keys = self.keys(((), False, True))
+        self.assertNotEqual(keys[0], keys[1])
+        self.assertEqual(keys[0], keys[2])
+
+    def test_bgcolor_is_not_shared(self):
+        c = PisaContext(".")
+        pisaParser(b"<table><tr><td bgcolor='red'>A</td><td>B</td></tr></table>", c)
+        for shareKey, cssAttrs in c.cssAttrCache.values():
+            self.assertFalse("background-color" in cssAttrs)
+
+
+
+_pruning = b"""
+<style>
+p.used { color: red; }
+p.unused { color: blue; }
+#unused, div p { color: green; }
+pdftoclevel0 { color: red; }
+</style>
+<p class="used">A</p>
+"""
+
+
+class RulePruningTestCase(unittest.TestCase):
+
+    def test_unused_rules_are_pruned(self):
+        c = PisaContext(".")
+        pisaParser(_pruning, c)
+        tags, classes, ids = c.cssDocumentNames
+        self.assertTrue("p" in tags)
+        self.assertTrue("used" in classes)
+        self.assertEqual(c.cssPrunedRules, 3)
+        # Only the rightmost compound selector is looked at
+        normal, important = c.cssCascade.user
+        self.assertEqual(sorted(str(selector) for selector in normal), ["div p", "p.used"])
+
+    def test_pruned_stylesheet_is_shared(self):
+        c1 = PisaContext(".")
+        pisaParser(_pruning, c1)
+        c2 = PisaContext(".")
+        pisaParser(_pruning, c2)
+        self.assertEqual(c2.cssPrunedRules, 3)
+        self.assertTrue(c1.cssCascade.user is c2.cssCascade.user)
+        # Other names prune the stylesheet again
+        c3 = PisaContext(".")
+        pisaParser(_pruning.replace(b'class="used"', b'class="unused"'), c3)
+        self.assertFalse(c3.cssCascade.user is c1.cssCascade.user)
+        normal, important = c3.cssCascade.user
+        self.assertEqual(sorted(str(selector) for selector in normal), ["div p", "p.unused"])
+
+    def test_parsed_stylesheet_is_not_changed(self):
+        c = PisaContext(".")
+        pisaParser(_pruning, c)
+        self.assertEqual(len(c.css[0]), 5)
+
+    def test_used_rules_apply(self):
+        c = PisaContext(".")
+        pisaParser(_pruning, c)
+        colors = [cssAttrs.get("color") for shareKey, cssAttrs in c.cssAttrCache.values()]
+        self.assertTrue("red" in colors)
+        self.assertFalse("blue" in colors)
+
+    def test_toc_classes_are_kept(self):
+        c = PisaContext(".")
+        pisaParser(b"<style>.pdftoclevel3 { color: red; }</style><pdf:toc />", c)
+        self.assertTrue("pdftoclevel3" in c.cssDocumentNames[1])
+
+
+_inherit = b"""
+<style>
+div { width: 10cm; border-left-style: solid; font-size: 20pt; }
+p { width: inherit; border-left-style: inherit; font-size: inherit; }
+span { width: inherit; color: inherit; }
+</style>
+<div><p><span>A</span></p></div>
+"""
+
+
+class InheritTestCase(unittest.TestCase):
+
+    def styles(self):
+        c = PisaContext(".")
+        pisaParser(_inherit, c)
+        styles = sorted(c.cssAttrCache.values(), key=lambda item: item[0])
+        return [cssAttrs for shareKey, cssAttrs in styles[-3:]]
+
+    def test_parent_value_is_used(self):
+        div, p, span = self.styles()
+        self.assertEqual(p["width"], div["width"])
+        self.assertEqual(p["border-left-style"], "solid")
+        # Resolved through p, which inherited it itself
+        self.assertEqual(span["width"], div["width"])
+
+    def test_missing_parent_value(self):
+        div, p, span = self.styles()
+        self.assertFalse("color" in span)
+
+    def test_font_size_is_left_to_the_fragment(self):
+        div, p, span = self.styles()
+        self.assertEqual(div["font-size"], ("20", "pt"))
+        self.assertFalse("font-size" in p)
+
+    def test_relative_sizes_are_computed_by_the_parent(self):
+        data = b"""
+<style>
+body { font-size: 10pt; }
+div { font-size: 1.5em; margin-left: 1.5em; }
+p { font-size: 2em; margin-left: inherit; }
+span { display: block; font-size: inherit; margin-left: inherit; }
+</style>
+<div>a<p>b<span>c</span></p></div>
+"""
+        c = pisaParser(data, PisaContext("."), DEFAULT_CSS)
+        self.assertEqual([(p.text, p.frags[0].fontSize, p.style.leftIndent) for p in c.story],
+                         [("a", 15, 22.5), ("b", 30, 45), ("c", 30, 67.5)])
+
+
+def _walkEveryRule(rulesets, element, attrNames):
+    """
+    The cascade as CSSCascadeStrategy.findCSSRulesFor did it before the
+    rules were indexed: for every property the most specific matching rule
+    of each ruleset, the last of these with the highest specificity wins.
+    Every rule is matched, once for all properties.
+    """
+    matching = []
+    for ruleset in rulesets:
+        rules = [(selector.specificity(), declarations)
+                 for selector, declarations in ruleset.orderedItems()
+                 if selector.matches(element)]
+        # sort is stable, the later rule wins among equals
+        rules.sort(key=lambda rule: rule[0])
+        matching.append(rules)
+    styles = {}
+    for attrName in attrNames:
+        rules = []
+        for ruleset in matching:
+            rules += [rule for rule in ruleset if attrName in rule[1]][-1:]
+        rules.sort(key=lambda rule: rule[0])
+        if rules:
+            styles[attrName] = rules[-1][1][attrName]
+    return styles
+
+
+def _elements(node):
+    for child in node.childNodes:
+        if child.nodeType == child.ELEMENT_NODE:
+            yield child
+            for element in _elements(child):
+                yield element
+
+
+_cascadeTags = ["div", "p", "span", "table", "tr", "td", "ul", "li", "a", "b", "h1", "pdf:toc"]
+
+
+def _cascadeSelector(random):
+    compounds = []
+    for i in range(random.randint(1, 3)):
+        compound = random.choice(["", "", "*"] + _cascadeTags).replace(":", "")
+        for j in range(random.randint(0 if compound else 1, 2)):
+            compound += random.choice([
+                ".c%d" % random.randint(0, 9),
+                "#i%d" % random.randint(0, 7),
+                "[title]",
+                '[lang="en"]',
+                ":first-child"])
+        compounds.append(compound)
+    selector = compounds[0]
+    for compound in compounds[1:]:
+        # Not the child combinator: CSSSelectorCombinationQualifier matches
+        # it against the element itself and fails without a qualifier
+        selector += random.choice([" ", " ", " + "]) + compound
+    return selector
+
+
+def _cascadeDocument(seed):
+    """A stylesheet with all kinds of selectors, some of them repeated, and
+    a document with the names they use."""
+    random = Random(seed)
+    rules = []
+    selectors = []
+    for i in range(300):
+        if selectors and random.random() < 0.1:
+            selector = random.choice(selectors)
+        else:
+            selector = _cascadeSelector(random)
+            selectors.append(selector)
+        rules.append("%s { color: #%06x; margin-left: %dpt%s; font-weight: %s }" % (
+            selector, i, i, random.choice(["", "", " !important"]), random.choice(["bold", "normal"])))
+
+    def element(depth):
+        tag = random.choice(_cascadeTags)
+        attrs = ""
+        if random.random() < 0.6:
+            attrs += ' class="%s"' % " ".join("c%d" % random.randint(0, 7) for i in range(random.randint(1, 3)))
+        if random.random() < 0.2:
+            attrs += ' id="i%d"' % random.randint(0, 5)
+        if random.random() < 0.2:
+            attrs += ' title="t"'
+        if random.random() < 0.2:
+            attrs += ' lang="%s"' % random.choice(["en", "de"])
+        children = ""
+        if depth < 6:
+            children = "".join(element(depth + 1) for i in range(random.randint(0, 3)))
+        return "<%s%s>x%s</%s>" % (tag, attrs, children, tag)
+
+    body = "".join(element(0) for i in range(8))
+    return ("<html><head><style>%s</style></head><body>%s</body></html>" % ("\n".join(rules), body)).encode("utf-8")
+
+
+class CascadeTestCase(unittest.TestCase):
+
+    def compare(self, data):
+        """
+        Styles every element of the document like pisaLoop does, with the
+        rule index, the pruned stylesheet and the ancestor filter, and
+        compares the result with walking every rule of the stylesheets as
+        they were parsed.
+        """
+        c = PisaContext(".")
+        document = dom.parse(data)
+        c.add_default_css(DEFAULT_CSS)
+        cssDOMElementInterface.indexElements(document)
+        c.cssDocumentNames = (set(), set(), set())
+        pisaPreLoop(document, c)
+        c.parse_css()
+        rulesets = (c.cssDefault[0], c.cssDefault[1], c.css[0], c.css[1])
+        attrNames = sorted(attrNameSet)
+        ancestors = c.cssAncestorFilter
+        parents = []
+        for node in _elements(document):
+            # The ancestors, as pisaLoop pushes and pops them
+            while parents and parents[-1] is not node.parentNode:
+                parents.pop()
+                ancestors.pop()
+            node.tagName = node.tagName.replace(":", "").lower()
+            element = cssDOMElementInterface.getElementInterface(node)
+            element.setAncestorFilter(ancestors)
+            styles = c.cssCascade.findStylesForElement(element, attrNameSet)
+            # A new interface, which walks up the DOM for every selector
+            expected = _walkEveryRule(rulesets, CSSDOMElementInterface(node), attrNames)
+            self.assertEqual(styles, expected, node.toxml())
+            parents.append(node)
+            ancestors.push(element)
+        return c
+
+    def test_same_styles_as_walking_every_rule(self):
+        for seed in range(3):
+            c = self.compare(_cascadeDocument(seed))
+            self.assertTrue(c.cssPrunedRules > 0)
+
+
+class KeywordTestCase(unittest.TestCase):
+
+    def test_display_block_starts_a_paragraph(self):
+        data = b'<div>a<span style="display: block">b</span>c</div>'
+        c = pisaParser(data, PisaContext("."), DEFAULT_CSS)
+        self.assertEqual([p.text for p in c.story], ["a", "b", "c"])
+
+    def test_font_keywords(self):
+        data = b'<p style="font-weight: Bold; font-style: italic">a</p><p style="font-weight: normal">b</p>'
+        c = pisaParser(data, PisaContext("."), DEFAULT_CSS)
+        self.assertEqual([(p.frags[0].bold, p.frags[0].italic) for p in c.story], [(1, 1), (0, 0)])
+
+
+class LoopTestCase(unittest.TestCase):
+
+    def test_deep_nesting(self):
+        depth = sys.getrecursionlimit() + 100
+        data = b"<style>div { margin-left: 1pt }</style>" + b"<div>" * depth + b"x" + b"</div>" * depth
+        c = pisaParser(data, PisaContext("."), DEFAULT_CSS, parser="expat")
+        self.assertEqual(c.story[-1].style.leftIndent, depth)
+
+    def test_margins_are_restored(self):
+        data = b"<div style='margin-left: 10pt'><div style='margin-left: 5pt'>a</div>b</div><p>c</p>"
+        c = pisaParser(data, PisaContext("."), DEFAULT_CSS)
+        self.assertEqual([p.style.leftIndent for p in c.story], [15, 10, 0])
+
+    def test_tag_handlers(self):
+        self.assertTrue(TAG_HANDLERS["pdfnextpage"] is pisaTagPDFNEXTPAGE)
+        self.assertTrue(TAG_HANDLERS["td"] is pisaTagTD)
+        self.assertFalse("span" in TAG_HANDLERS)
+
+
+def _attributes(html, tag):
+    return dom.parse(html).getElementsByTagName(tag)[0].attributes
+
+
+class _FileContext(PisaContext):
+
+    def get_file(self, name, relative=None):
+        self.files.append(name)
+        return name
+
+
+class AttributesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.c = _FileContext(".")
+        self.c.files = []
+
+    def test_defaults(self):
+        attr = pisaGetAttributes(self.c, "table", _attributes(b"<table border='2'></table>", "table"))
+        self.assertEqual(attr.border, 2)
+        self.assertEqual(attr.cellpadding, 0)
+        self.assertEqual(attr.align, "left")
+        self.assertEqual(attr.repeat, 0)
+        self.assertEqual(attr.bgcolor, None)
+        self.assertEqual(attr["id"], None)
+
+    def test_choices(self):
+        html = b"<table><tr><td align=' Right ' valign='x'></td></tr></table>"
+        attr = pisaGetAttributes(self.c, "td", _attributes(html, "td"))
+        self.assertEqual(attr.align, "right")
+        self.assertEqual(attr.valign, None)
+
+    def test_files_are_read_when_used(self):
+        attr = pisaGetAttributes(self.c, "img", _attributes(b"<img src='a.png' width='10pt'>", "img"))
+        self.assertEqual(self.c.files, [])
+        self.assertEqual(attr.src, "a.png")
+        self.assertEqual(attr.get("src"), "a.png")
+        self.assertEqual(attr.width, 10)
+        self.assertEqual(self.c.files, ["a.png"])
+
+    def test_tags_without_schema(self):
+        self.assertEqual(pisaGetAttributes(self.c, "span", _attributes(b"<span id='a'></span>", "span")), {})
+
+    def test_tags_are_not_changed(self):
+        pisaGetAttributes(self.c, "p", _attributes(b"<p id='a'></p>", "p"))
+        self.assertFalse("id" in TAGS["p"][1])
+
+
 def buildTestSuite():
     return unittest.defaultTestLoader.loadTestsFromName(__name__)
 
@@ -2,7 +2,7 @@
 from reportlab.lib.colors import Color
 from unittest import TestCase
 from xhtml2pdf.util import get_coordinates, get_color, get_size, get_frame_dimensions, \
-    get_position, get_box, PisaTempFile
+    get_position, get_box, PisaTempFile, LRUCache, CSSValue, compile_css_value
 from xhtml2pdf.tags import int_to_roman
 
 class UtilsCoordTestCase(TestCase):
@@ -258,3 +258,63 @@ class TempFileTestCase(TestCase):
             src.write(value)
         except UnicodeDecodeError as error:
             self.fail(error)
+
+class LRUCacheTestCase(TestCase):
+    def test_get_and_set(self):
+        cache = LRUCache(maxsize=2)
+        self.assertEqual(cache.get("a", "TOKEN"), "TOKEN")
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_least_recently_used_is_dropped(self):
+        cache = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertTrue("a" in cache)
+        self.assertFalse("b" in cache)
+        self.assertEqual(len(cache), 2)
+
+
+class CompileCSSValueTestCase(TestCase):
+
+    def test_absolute_length(self):
+        value = compile_css_value("margin-top", (u"1", u"cm"))
+        self.assertTrue(isinstance(value, CSSValue))
+        self.assertEqual(value, (u"1", u"cm"))
+        self.assertEqual(value.points, get_size("1cm"))
+        self.assertEqual(value.get_size(12.0), get_size("1cm", 12.0))
+
+    def test_relative_length(self):
+        for raw, text in (((u"1.5", u"em"), "1.5em"), ((u"2", u"ex"), "2ex"),
+                          ((u"150", u"%"), "150%"), (u"larger", "larger"),
+                          (u"normal", "normal"), (u"1.2", "1.2"), (u"3", "3")):
+            value = compile_css_value("font-size", raw)
+            self.assertEqual(value.points, None)
+            self.assertEqual(value.get_size(10.0, 12.0), get_size(text, 10.0, 12.0))
+            self.assertEqual(value.get_size(), get_size(text))
+
+    def test_color(self):
+        self.assertEqual(compile_css_value("color", u"#f00").color, get_color("#f00"))
+        self.assertEqual(compile_css_value("background-color", u"transparent").color, None)
+
+    def test_keyword(self):
+        value = compile_css_value("font-weight", u"BOLD")
+        self.assertEqual(value, u"BOLD")
+        self.assertEqual(value.keyword, "bold")
+
+    def test_byte_strings(self):
+        # What the CSS parser returns on Python 2
+        value = compile_css_value("margin-top", (str("1"), str("cm")))
+        self.assertEqual(value.points, get_size("1cm"))
+        value = compile_css_value("color", str("red"))
+        self.assertEqual(value, str("red"))
+        self.assertEqual(value.color, get_color("red"))
+        self.assertEqual(compile_css_value("display", str("Block")).keyword, "block")
+
+    def test_other_values_are_kept(self):
+        self.assertEqual(type(compile_css_value("font-family", u"Helvetica")), type(u""))
+        self.assertEqual(type(compile_css_value("font-size", u"big")), type(u""))
+        self.assertEqual(type(compile_css_value("color", [u"red"])), list)
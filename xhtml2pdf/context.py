@@ -15,12 +15,19 @@
 # limitations under the License.
 
 import copy
+import hashlib
 import logging
 import os
 import re
 import reportlab
+import sys
+import tempfile
+import threading
+from stat import S_IWGRP, S_IWOTH
+from string import whitespace
 
 from six import text_type
+from six.moves import cPickle as pickle
 
 from reportlab.lib.enums import TA_LEFT
 from reportlab.lib.fonts import addMapping
@@ -35,9 +42,12 @@ import xhtml2pdf.default
 import xhtml2pdf.parser
 
 from xhtml2pdf.w3c import css
-from xhtml2pdf.util import (get_size, get_coordinates, get_file, PisaFileObject, get_frame_dimensions, get_color)
+from xhtml2pdf.w3c.cssDOMElementInterface import getElementInterface
+from xhtml2pdf.util import (get_size, get_coordinates, get_file, PisaFileObject, get_frame_dimensions, get_color,
+                           LRUCache, compile_css_declarations)
 from xhtml2pdf.xhtml2pdf_reportlab import (PmlPageTemplate, PmlTableOfContents, PmlParagraph, PmlParagraphAndImage,
                                            PmlPageCount)
+from xhtml2pdf.version import VERSION
 
 try:
     import urlparse
@@ -55,9 +65,121 @@ superFraction = 0.4
 NBSP = u"\u00a0"
 ListType = (list, tuple)
 
+_rxLineBreak = re.compile(r"(\r\n|\n|\r)")
+_rxNBSP = re.compile(u"(" + NBSP + u")")
+
+# Parsed stylesheets shared by all renders of this process, see
+# PisaCSSParser.parse
+stylesheet_cache = LRUCache(maxsize=64)
+
+# Bump when the parsed stylesheets change in a way older snapshots (see
+# StylesheetSnapshots) would not work with any more
+STYLESHEET_SNAPSHOT_FORMAT = 2
+
+
+class StylesheetSnapshots(object):
+    """
+    Keeps parsed stylesheets as files in `directory`, so that a new process
+    loads them instead of parsing them again (see PisaCSSParser.parse).
+    Nothing is read or written while `directory` is None.
+
+    A snapshot is only used for the same source and root path and by the
+    same versions of xhtml2pdf and Python, otherwise the stylesheet is
+    parsed and its snapshot written again. Snapshots are pickles, which
+    can run any code when they are loaded: where the operating system has
+    user ids, the directory and the snapshots must belong to the current
+    user and must not be writeable by anybody else (see is_trusted), or
+    they are not loaded. Elsewhere only use a directory nobody else can
+    write to.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def get_header(self, key):
+        src_hash, root_path = key
+        return ("xhtml2pdf-stylesheet %d %s %d.%d %s %r\n" % (
+            STYLESHEET_SNAPSHOT_FORMAT, VERSION, sys.version_info[0], sys.version_info[1],
+            src_hash, root_path)).encode("utf-8")
+
+    def get_path(self, key):
+        name = hashlib.sha1(("%s %r" % key).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name + ".css.pickle")
+
+    def is_trusted(self, stat):
+        """
+        Whether a file or directory with the os.stat result `stat` belongs
+        to the current user and nobody else can write to it.
+        """
+        if not hasattr(os, "getuid"):
+            return True
+        return stat.st_uid == os.getuid() and not stat.st_mode & (S_IWGRP | S_IWOTH)
+
+    def load(self, key):
+        """
+        Returns the (stylesheet, effects) saved for key or None.
+        """
+        if not self.directory:
+            return None
+        path = self.get_path(key)
+        value = None
+        try:
+            with open(path, "rb") as f:
+                if not (self.is_trusted(os.stat(self.directory)) and self.is_trusted(os.fstat(f.fileno()))):
+                    log.warning("Not loading stylesheet snapshot %s, it or its directory may be written "
+                                "by other users", path)
+                elif f.readline() == self.get_header(key):
+                    value = pickle.load(f)
+        except (IOError, OSError):
+            pass
+        except Exception:
+            log.debug("Broken stylesheet snapshot %s", path, exc_info=1)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def save(self, key, value):
+        if not self.directory:
+            return
+        path = self.get_path(key)
+        temp_path = None
+        try:
+            fd, temp_path = tempfile.mkstemp(prefix="css-", suffix=".tmp", dir=self.directory)
+            with os.fdopen(fd, "wb") as f:
+                f.write(self.get_header(key))
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            # Other processes only ever see complete snapshots
+            getattr(os, "replace", os.rename)(temp_path, path)
+        except Exception:
+            log.warning("Could not save stylesheet snapshot %s", path, exc_info=1)
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+
+# Snapshots of parsed stylesheets shared by all processes using the same
+# directory, switched off unless a directory is set
+stylesheet_snapshots = StylesheetSnapshots()
+
+# Author stylesheets without the rules the names of a document can not
+# match, see PisaContext.prune_css. Documents using the same names share the
+# pruned rulesets and with them their rule index and tag styles.
+pruned_stylesheet_cache = LRUCache(maxsize=64)
+
+# Parsed and expanded inline styles shared by all elements and renders of
+# this process, see PisaCSSParser.parse_inline
+inline_style_cache = LRUCache(maxsize=1024)
+
+# Fonts are registered in the process wide tables of reportlab, renders
+# running in other threads must not see a half registered font
+font_lock = threading.RLock()
+
 
 def clone(self, **kwargs):
-    n = ParaFrag(**self.__dict__)
+    n = self.__class__(**self.__dict__)
     if kwargs:
         d = n.__dict__
         d.update(kwargs)
@@ -71,6 +193,112 @@ def clone(self, **kwargs):
 ParaFrag.clone = clone
 
 
+class TextFragment(object):
+    """
+    A fragment of the text of a paragraph. The values it shares with the
+    other fragments of the same style are class attributes of a subclass
+    made by PisaContext._text_fragment, what differs from one fragment to
+    the next is kept in slots. Without an instance dictionary it takes a
+    fraction of the memory of a ParaFrag (see test/benchmark_fragments.py).
+
+    Reportlab reads the values like the attributes of a ParaFrag. There is
+    no slot for other attributes, clone returns a ParaFrag if it is given
+    one of them.
+    """
+
+    __slots__ = ("text", "leading", "link", "bulletText", "lineBreak")
+
+    # All values of the fragments of a subclass, see to_frag
+    _values = {}
+
+    def __init__(self, text=u"", leading=0, link=None):
+        self.text = text
+        self.leading = leading
+        self.link = link
+        self.bulletText = None
+
+    def clone(self, **kwargs):
+        if kwargs and not TEXT_FRAGMENT_SLOTS.issuperset(kwargs):
+            return self.to_frag().clone(**kwargs)
+        n = self.__class__(self.text, self.leading, self.link)
+        if hasattr(self, "lineBreak"):
+            n.lineBreak = self.lineBreak
+        for name, value in kwargs.items():
+            setattr(n, name, value)
+        n.bulletText = None
+        return n
+
+    def to_frag(self):
+        "The fragment as a ParaFrag"
+        values = dict(self._values, text=self.text, leading=self.leading, link=self.link,
+                      bulletText=self.bulletText)
+        if hasattr(self, "lineBreak"):
+            values["lineBreak"] = self.lineBreak
+        else:
+            values.pop("lineBreak", None)
+        return ParaFrag(**values)
+
+    def __repr__(self):
+        return repr(self.to_frag())
+
+
+TEXT_FRAGMENT_SLOTS = frozenset(TextFragment.__slots__)
+
+
+def _joinable(frag):
+    # Reportlab makes an empty word of a fragment of whitespace alone
+    return (isinstance(frag, TextFragment) and frag.link is None and not hasattr(frag, "lineBreak")
+            and not frag.pageNumber and not frag.pageCount
+            and (not frag.text or frag.text.strip(whitespace)))
+
+
+def coalesce_fragments(frags):
+    """
+    Joins the text of adjacent fragments of the same style, which are the
+    TextFragments of the same class, so Reportlab lays out fewer of them.
+    Fragments with a link, a line break or a page number stay on their
+    own, like whitespace Reportlab would make a word of.
+    """
+    result = []
+    texts = []
+    tail = u""
+    for frag in frags:
+        text = frag.text
+        if (texts and frag.__class__ is result[-1].__class__ and frag.leading == result[-1].leading
+                and _joinable(frag) and _joinable(result[-1])
+                and not (tail and text and tail[-1] in whitespace and text[0] in whitespace)):
+            texts.append(text)
+            tail = text or tail
+            continue
+        if len(texts) > 1:
+            result[-1] = result[-1].clone(text=u"".join(texts))
+        result.append(frag)
+        texts = [text]
+        tail = text
+    if len(texts) > 1:
+        result[-1] = result[-1].clone(text=u"".join(texts))
+    return result
+
+# The values of a fragment a paragraph style is made of, see
+# PisaContext.to_paragraph_style
+PARAGRAPH_STYLE_ATTRS = (
+    "keepWithNext", "fontName", "bold", "italic", "fontSize", "letterSpacing",
+    "leading", "leadingSpace", "backColor", "spaceBefore", "spaceAfter",
+    "leftIndent", "rightIndent", "firstLineIndent", "textColor", "alignment",
+    "bulletFontName", "bulletIndent", "wordWrap",
+    "borderTopStyle", "borderTopWidth", "borderTopColor",
+    "borderBottomStyle", "borderBottomWidth", "borderBottomColor",
+    "borderLeftStyle", "borderLeftWidth", "borderLeftColor",
+    "borderRightStyle", "borderRightWidth", "borderRightColor",
+    "borderPadding", "paddingTop", "paddingBottom", "paddingLeft",
+    "paddingRight")
+
+
+def _values_key(values):
+    # Equal values of different types, like 1 and 1.0, are kept apart
+    return values, tuple(map(type, values))
+
+
 def get_paragraph_fragment(style):
     frag = ParaFrag()
     frag.sub = 0
@@ -158,12 +386,69 @@ def get_dir_name(path):
         return os.path.dirname(os.path.abspath(path))
 
 
+def get_stylesheet_cache_key(src, root_path):
+    if isinstance(src, text_type):
+        src = src.encode("utf-8")
+    return hashlib.sha1(src).hexdigest(), root_path
+
+
 class PisaCSSBuilder(css.CSSBuilder):
+    # The context is only weakly referenced, see PisaContext.parse_css
+    c = property(lambda self: self._c())
+
+    def __init__(self, *args, **kwargs):
+        css.CSSBuilder.__init__(self, *args, **kwargs)
+        # One [effects, cacheable] pair for every stylesheet being parsed
+        self._recorders = []
+
+    # The @ rules below change the context instead of returning CSS rules.
+    # They are recorded while a stylesheet is parsed, so that a cached
+    # stylesheet can apply them again to the context of a later render.
+    def begin_recording(self):
+        self._recorders.append([[], True])
+
+    def end_recording(self):
+        return self._recorders.pop()
+
+    def _record(self, name, *args):
+        if self._recorders:
+            self._recorders[-1][0].append((name, copy.deepcopy(args)))
+
+    def replay(self, effects):
+        for name, args in effects:
+            getattr(self, name)(*copy.deepcopy(args))
+
+    # Values of the rules for elements are converted right away, see
+    # util.compile_css_value. The @ rules below work on the plain values,
+    # so they use css.CSSBuilder.ruleset.
+    def _compile(self, result):
+        for ruleset in (result if self.trackImportance else (result,)):
+            if isinstance(ruleset, css.CSSInlineRuleset):
+                compile_css_declarations(ruleset)
+            else:
+                for declarations in ruleset.values():
+                    compile_css_declarations(declarations)
+        return result
+
+    def ruleset(self, selectors, declarations):
+        return self._compile(css.CSSBuilder.ruleset(self, selectors, declarations))
+
+    def inline(self, declarations):
+        return self._compile(css.CSSBuilder.inline(self, declarations))
+
+    def at_import(self, import_, mediums, cssParser):
+        # The imported file may change, so stylesheets importing it are not
+        # cached. The imported stylesheet itself is cached by its content.
+        for recorder in self._recorders:
+            recorder[1] = False
+        return css.CSSBuilder.at_import(self, import_, mediums, cssParser)
+
     def at_font_face(self, declarations):
         """
         Embed fonts
         """
-        result = self.ruleset([self.selector('*')], declarations)
+        self._record("at_font_face", declarations)
+        result = css.CSSBuilder.ruleset(self, [self.selector('*')], declarations)
         data = result[0].values()[0]
         if "src" not in data:
             # invalid - source is required, ignore this specification
@@ -218,13 +503,14 @@ class PisaCSSBuilder(css.CSSBuilder):
             return default
 
     def at_page(self, name, pseudopage, declarations):
+        self._record("at_page", name, pseudopage, declarations)
         c = self.c
         data = {}
         name = name or "body"
         page_border = None
 
         if declarations:
-            result = self.ruleset([self.selector('*')], declarations)
+            result = css.CSSBuilder.ruleset(self, [self.selector('*')], declarations)
 
             if declarations:
                 try:
@@ -366,8 +652,9 @@ class PisaCSSBuilder(css.CSSBuilder):
         return {}, {}
 
     def at_frame(self, name, declarations):
+        self._record("at_frame", name, declarations)
         if declarations:
-            result = self.ruleset([self.selector('*')], declarations)
+            result = css.CSSBuilder.ruleset(self, [self.selector('*')], declarations)
             # print "@BOX", name, declarations, result
 
             data = result[0]
@@ -383,6 +670,57 @@ class PisaCSSBuilder(css.CSSBuilder):
 
 
 class PisaCSSParser(css.CSSParser):
+    rootPath = None
+    c = property(lambda self: self._c())
+
+    def parse(self, src):
+        """
+        Parses a stylesheet or takes the result of an earlier parse of the
+        same source from the process wide `stylesheet_cache`.
+        """
+        key = get_stylesheet_cache_key(src, self.rootPath)
+        cached = stylesheet_cache.get(key)
+        if cached is None:
+            cached = stylesheet_snapshots.load(key)
+            if cached is not None:
+                stylesheet_cache.set(key, cached)
+        if cached is not None:
+            stylesheet, effects = cached
+            self.css_builder.replay(effects)
+            return stylesheet
+
+        self.css_builder.begin_recording()
+        try:
+            stylesheet = css.CSSParser.parse(self, src)
+        finally:
+            effects, cacheable = self.css_builder.end_recording()
+        if cacheable:
+            if stylesheet_snapshots.directory:
+                # The snapshot comes with the rule indexes built. This
+                # happens before other renders can use the stylesheet.
+                for ruleset in (stylesheet if self.css_builder.trackImportance else (stylesheet,)):
+                    ruleset.getIndex()
+                stylesheet_snapshots.save(key, (stylesheet, effects))
+            stylesheet_cache.set(key, (stylesheet, effects))
+        return stylesheet
+
+    def parse_inline(self, src):
+        """
+        Parses the declarations of a style attribute. The results are kept
+        in the process wide `inline_style_cache` and can not be changed.
+        """
+        cached = inline_style_cache.get(src)
+        if cached is not None:
+            return cached
+
+        result = css.CSSParser.parse_inline(self, src)
+        if self.css_builder.trackImportance:
+            result = tuple(css.CSSImmutableInlineRuleset(declarations) for declarations in result)
+        else:
+            result = css.CSSImmutableInlineRuleset(result)
+        inline_style_cache.set(src, result)
+        return result
+
     def parseExternal(self, cssResourceName):
 
         oldRootPath = self.rootPath
@@ -413,12 +751,15 @@ class PisaContext(object):
         self.node = None
         self.toc = PmlTableOfContents()
         self.story = []
+        # Called with the parts of the story pisaLoop has finished, while
+        # the rest of the document is parsed, see pisa_document
+        self.storySink = None
         self.indexing_story = None
-        self.text = []
+        # The text of the current paragraph in pieces, see text
+        self.textList = []
         self.log = []
         self.err = 0
         self.warn = 0
-        self.text = u""
         self.uidctr = 0
         self.multiBuild = False
 
@@ -445,11 +786,29 @@ class PisaContext(object):
         self.fragAnchor = []
         self.fragStack = []
         self.fragStrip = True
+        # The style of the last whitespace add_fragment left out at the
+        # start of the paragraph
+        self.fragSkipped = None
+        # TextFragment classes holding the values of text fragments, shared
+        # by all fragments with the same values, see _text_fragment
+        self.fragStyles = {}
+        # Paragraph styles shared by all paragraphs with the same values,
+        # see to_paragraph_style
+        self.paragraphStyles = {}
 
         self.listCounter = 0
 
         self.cssText = ""
         self.cssDefaultText = ""
+        # Computed styles shared between elements, see parser.CSSCollect
+        self.cssAttrCache = {}
+        # Tag names, classes and ids used in the document as collected by
+        # parser.pisaPreLoop, None if unknown. Rules which can not match
+        # any of them are left out of the cascade.
+        self.cssDocumentNames = None
+        self.cssPrunedRules = 0
+        # The elements pisaLoop is inside of, see parser.CSSCollect
+        self.cssAncestorFilter = css.CSSAncestorFilter()
 
         self.image = None
         self.imageData = {}
@@ -505,29 +864,89 @@ class PisaContext(object):
 
         self.CSSBuilder = PisaCSSBuilder(mediumSet=["all", "print", "pdf"])
         self.CSSBuilder._c = weakref.ref(self)
-        PisaCSSBuilder.c = property(lambda self: self._c())
 
         self.CSSParser = PisaCSSParser(self.CSSBuilder)
         self.CSSParser.rootPath = self.pathDirectory
         self.CSSParser._c = weakref.ref(self)
-        PisaCSSParser.c = property(lambda self: self._c())
 
         self.css = self.CSSParser.parse(self.cssText)
         self.cssDefault = self.CSSParser.parse(self.cssDefaultText)
-        self.cssCascade = css.CSSCascadeStrategy(userAgent=self.cssDefault, user=self.css)
+        self.cssPrunedRules = 0
+        # The default stylesheet is not pruned: it is shared through the
+        # stylesheet cache, so its rule index and the styles of its plain
+        # tag selectors (see css.CSSRuleIndex.getTagStyle) are built once
+        self.cssCascade = css.CSSCascadeStrategy(userAgent=self.cssDefault,
+                                                 user=self.prune_css(self.css))
         self.cssCascade.parser = self.CSSParser
+        self.cssStyleDependencies = self.cssCascade.getStyleDependencies()
+
+    def prune_css(self, stylesheet):
+        """
+        Returns the normal and important rulesets of stylesheet without the
+        rules which can not match any element of the document. The parsed
+        stylesheets are shared through the stylesheet cache and are not
+        changed; the pruned ones are shared through
+        `pruned_stylesheet_cache` by the renders of documents with the same
+        tag names, classes and ids.
+        """
+        if self.cssDocumentNames is None:
+            return stylesheet
+        tags, classes, ids = self.cssDocumentNames
+        key = (id(stylesheet), frozenset(tags), frozenset(classes), frozenset(ids))
+        cached = pruned_stylesheet_cache.get(key)
+        # The id of a stylesheet which is gone may be taken by another one
+        if cached is None or cached[0] is not stylesheet:
+            result = []
+            count = 0
+            for ruleset in stylesheet:
+                ruleset, pruned = ruleset.prune(tags, classes, ids)
+                count += pruned
+                result.append(ruleset)
+            cached = (stylesheet, tuple(result), count)
+            pruned_stylesheet_cache.set(key, cached)
+        self.cssPrunedRules += cached[2]
+        return cached[1]
 
     # METHODS FOR STORY
     def add_story(self, data):
         self.story.append(data)
 
+    def flush_story(self):
+        """Hands the story built so far to storySink."""
+        if self.storySink is None or not self.story:
+            return
+        if self.keepInFrameIndex is not None or self.frag.insideStaticFrame:
+            return
+        story, self.story = self.story, []
+        self.storySink(story)
+
     def swap_story(self, story=None):
         if story is None:
             story = []
         self.story, story = story, self.story
         return story
 
-    def to_paragraph_style(self, first):
+    def to_paragraph_style(self, first, leading=None):
+        """
+        The paragraph style for the fragment `first`, with `leading`
+        instead of the leading of `first` if given. Paragraphs with the
+        same values share the style.
+        """
+        key = (_values_key(tuple(getattr(first, name) for name in PARAGRAPH_STYLE_ATTRS)), leading)
+        try:
+            style = self.paragraphStyles.get(key)
+        except TypeError:
+            # A value can not be hashed, the style is not shared
+            key = style = None
+        if style is None:
+            style = self._new_paragraph_style(first)
+            if leading is not None:
+                style.leading = leading
+            if key is not None:
+                self.paragraphStyles[key] = style
+        return style
+
+    def _new_paragraph_style(self, first):
         style = ParagraphStyle('default%d' % self.uid(), keepWithNext=first.keepWithNext)
         style.fontName = first.fontName
         style.fontSize = first.fontSize
@@ -587,14 +1006,9 @@ class PisaContext(object):
     def add_toc(self):
         styles = []
         for i in range(20):
-            self.node.attributes["class"] = "pdftoclevel%d" % i
+            getElementInterface(self.node).setAttr("class", "pdftoclevel%d" % i)
             self.cssAttr = xhtml2pdf.parser.CSSCollect(self.node, self)
-            xhtml2pdf.parser.CSS2Frag(self, {
-                "margin-top": 0,
-                "margin-bottom": 0,
-                "margin-left": 0,
-                "margin-right": 0,
-            }, True)
+            xhtml2pdf.parser.CSS2Frag(self, (0, 0), True)
             pstyle = self.to_paragraph_style(self.frag)
             styles.append(pstyle)
 
@@ -607,6 +1021,11 @@ class PisaContext(object):
             self.indexing_story = PmlPageCount()
             self.multiBuild = True
 
+    @property
+    def text(self):
+        """The text of the current paragraph."""
+        return u"".join(self.textList)
+
     def dump_paragraph(self, frags, style):
         return
 
@@ -631,16 +1050,17 @@ class PisaContext(object):
             maxLeading = max(leading, frag.fontSize + frag.leadingSpace, maxLeading)
             frag.leading = leading
 
-        if force or (self.text.strip() and self.fragList):
+        text = self.text
+        if force or (text.strip() and self.fragList):
 
             # Update paragraph style by style of first fragment
             first = self.fragBlock
-            style = self.to_paragraph_style(first)
             # style.leading = first.leading + first.leadingSpace
             if first.leadingSpace:
-                style.leading = maxLeading
+                leading = maxLeading
             else:
-                style.leading = get_size(first.leadingSource, first.fontSize) + first.leadingSpace
+                leading = get_size(first.leadingSource, first.fontSize) + first.leadingSpace
+            style = self.to_paragraph_style(first, leading)
 
             bulletText = copy.copy(first.bulletText)
             first.bulletText = None
@@ -648,6 +1068,13 @@ class PisaContext(object):
             # Add paragraph to story
             if force or len(self.fragAnchor + self.fragList) > 0:
 
+                if not self.fragList and self.fragSkipped is not None:
+                    # The paragraph has no text, add_fragment would have
+                    # added the whitespace as an empty fragment
+                    self.fragList.append(self._text_fragment(self.fragSkipped))
+
+                self.fragList = coalesce_fragments(self.fragList)
+
                 # We need this empty fragment to work around problems in
                 # Reportlab paragraphs regarding backGround etc.
                 if self.fragList:
@@ -660,7 +1087,7 @@ class PisaContext(object):
 
                 self.dump_paragraph(self.fragAnchor + self.fragList, style)
                 para = PmlParagraph(
-                    self.text,
+                    text,
                     style,
                     frags=self.fragAnchor + self.fragList,
                     bulletText=bulletText)
@@ -693,7 +1120,8 @@ class PisaContext(object):
     def clear_fragment(self):
         self.fragList = []
         self.fragStrip = True
-        self.text = u""
+        self.fragSkipped = None
+        self.textList = []
 
     def copy_fragment(self, **kw):
         return self.frag.clone(**kw)
@@ -707,10 +1135,9 @@ class PisaContext(object):
             self.anchorFrag.append((frag, frag.link[1:]))
         self.fragList.append(frag)
 
-    # XXX Argument frag is useless!
-    def add_fragment(self, text="", frag=None):
-
-        frag = baseFrag = self.frag.clone()
+    def _text_fragment(self, frag):
+        # The fragment for a text inside an element with the style frag
+        frag = frag.clone()
 
         # if sub and super are both on they will cancel each other out
         if frag.sub == 1 and frag.super == 1:
@@ -727,52 +1154,94 @@ class PisaContext(object):
 
        # bold, italic, and underline
         frag.fontName = frag.bulletFontName = tt2ps(frag.fontName, frag.bold, frag.italic)
+        frag.text = u""
+
+        # The values go to a TextFragment class shared by all text
+        # fragments with the same values, see TextFragment
+        values = frag.__dict__
+        try:
+            key = tuple(values), _values_key(tuple(values.values()))
+            fragStyle = self.fragStyles.get(key)
+        except TypeError:
+            # A value can not be hashed, the values are not shared
+            return frag
+        if fragStyle is None:
+            shared = dict((name, value) for name, value in values.items() if name not in TEXT_FRAGMENT_SLOTS)
+            shared["__slots__"] = ()
+            shared["_values"] = values
+            fragStyle = self.fragStyles[key] = type("TextFragment", (TextFragment,), shared)
+        fragment = fragStyle(u"", values["leading"], values["link"])
+        if "lineBreak" in values:
+            fragment.lineBreak = values["lineBreak"]
+        return fragment
+
+    def _add_text(self, baseFrag, text):
+        # Collapses the whitespace of a text without NBSP
+        words = text.split()
+        if words:
+            collapsed = u" ".join(words)
+            if text[0].isspace() and not self.fragStrip:
+                collapsed = u" " + collapsed
+            if text[-1].isspace():
+                collapsed += u" "
+            self.fragStrip = False
+        elif text and not self.fragStrip:
+            collapsed = u" "
+        else:
+            collapsed = u""
+        frag = baseFrag.clone()
+        frag.text = collapsed
+        self.textList.append(collapsed)
+        self._append_fragment(frag)
+
+    # XXX Argument frag is useless!
+    def add_fragment(self, text="", frag=None):
+
+        if (text and self.fragStrip and not self.fragList and self.frag.whiteSpace != "pre"
+                and self.frag.link is None and text.isspace() and NBSP not in text):
+            # Whitespace between blocks, left out unless the paragraph
+            # has nothing else, see add_paragraph
+            self.fragSkipped = self.frag
+            return
+
+        frag = baseFrag = self._text_fragment(self.frag)
 
         # Replace &shy; with empty and normalize NBSP
-        text = (text
-                .replace(u"\xad", u"")
-                .replace(u"\xc2\xa0", NBSP)
-                .replace(u"\xa0", NBSP))
+        if u"\xad" in text:
+            text = text.replace(u"\xad", u"")
+        if u"\xc2\xa0" in text:
+            text = text.replace(u"\xc2\xa0", NBSP)
 
         if frag.whiteSpace == "pre":
+            self.textList.append(text)
+
+            # Handle tabs in a simple way. Spaces become NBSP, which
+            # Reportlab does not break lines at, so every line is a single
+            # fragment and a single word with the spacing it has
+            text = text.replace(u"\t", 8 * u" ").replace(u" ", NBSP)
 
             # Handle by lines
-            for text in re.split(r'(\r\n|\n|\r)', text):
-                # This is an exceptionally expensive piece of code
-                self.text += text
+            for text in _rxLineBreak.split(text):
+                frag = baseFrag.clone()
                 if ("\n" in text) or ("\r" in text):
                     # If EOL insert a linebreak
-                    frag = baseFrag.clone()
                     frag.text = ""
                     frag.lineBreak = 1
-                    self._append_fragment(frag)
                 else:
-                    # Handle tabs in a simple way
-                    text = text.replace(u"\t", 8 * u" ")
-                    # Somehow for Reportlab NBSP have to be inserted
-                    # as single character fragments
-                    for text in re.split(r'(\ )', text):
-                        frag = baseFrag.clone()
-                        if text == " ":
-                            text = NBSP
-                        frag.text = text
-                        self._append_fragment(frag)
+                    frag.text = text
+                self._append_fragment(frag)
+        elif NBSP not in text:
+            self._add_text(baseFrag, text)
         else:
-            for text in re.split(u'(' + NBSP + u')', text):
-                frag = baseFrag.clone()
+            for text in _rxNBSP.split(text):
                 if text == NBSP:
+                    frag = baseFrag.clone()
                     self.force = True
                     frag.text = NBSP
-                    self.text += text
+                    self.textList.append(text)
                     self._append_fragment(frag)
                 else:
-                    frag.text = " ".join(("x" + text + "x").split())[1: - 1]
-                    if self.fragStrip:
-                        frag.text = frag.text.lstrip()
-                        if frag.text:
-                            self.fragStrip = False
-                    self.text += frag.text
-                    self._append_fragment(frag)
+                    self._add_text(baseFrag, text)
 
     def push_fragment(self):
         self.fragStack.append(self.frag)
@@ -902,13 +1371,14 @@ class PisaContext(object):
 
                     # Register TTF font and special name
                     filename = file.get_named_file()
-                    pdfmetrics.registerFont(TTFont(full_font_name, filename))
+                    with font_lock:
+                        pdfmetrics.registerFont(TTFont(full_font_name, filename))
 
-                    # Add or replace missing styles
-                    for bold in (0, 1):
-                        for italic in (0, 1):
-                            if ("%s_%d%d" % (font_name, bold, italic)) not in self.fontList:
-                                addMapping(font_name, bold, italic, full_font_name)
+                        # Add or replace missing styles
+                        for bold in (0, 1):
+                            for italic in (0, 1):
+                                if ("%s_%d%d" % (font_name, bold, italic)) not in self.fontList:
+                                    addMapping(font_name, bold, italic, full_font_name)
 
                     # Register "normal" name and the place holder for style
                     self.register_font(font_name, font_alias + [full_font_name])
@@ -935,16 +1405,17 @@ class PisaContext(object):
                     # Include font
                     face = pdfmetrics.EmbeddedType1Face(afm, pfb)
                     font_name_original = face.name
-                    pdfmetrics.registerTypeFace(face)
-                    # print fontName, fontNameOriginal, fullFontName
-                    just_font = pdfmetrics.Font(full_font_name, font_name_original, encoding)
-                    pdfmetrics.registerFont(just_font)
-
-                    # Add or replace missing styles
-                    for bold in (0, 1):
-                        for italic in (0, 1):
-                            if ("%s_%d%d" % (font_name, bold, italic)) not in self.fontList:
-                                addMapping(font_name, bold, italic, font_name_original)
+                    with font_lock:
+                        pdfmetrics.registerTypeFace(face)
+                        # print fontName, fontNameOriginal, fullFontName
+                        just_font = pdfmetrics.Font(full_font_name, font_name_original, encoding)
+                        pdfmetrics.registerFont(just_font)
+
+                        # Add or replace missing styles
+                        for bold in (0, 1):
+                            for italic in (0, 1):
+                                if ("%s_%d%d" % (font_name, bold, italic)) not in self.fontList:
+                                    addMapping(font_name, bold, italic, font_name_original)
 
                     # Register "normal" name and the place holder for style
                     self.register_font(font_name, font_alias + [full_font_name, font_name_original])
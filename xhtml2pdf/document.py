@@ -19,12 +19,15 @@ import logging
 
 from tempfile import NamedTemporaryFile, SpooledTemporaryFile
 
+from xhtml2pdf import dom
 from xhtml2pdf.context import PisaContext
 from xhtml2pdf.default import DEFAULT_CSS
 from xhtml2pdf.parser import pisaParser
 from xhtml2pdf.xhtml2pdf_reportlab import PmlBaseDoc, PmlPageTemplate
 from xhtml2pdf.util import PisaTempFile, get_box, PyPDF2
 
+from six import binary_type, text_type
+
 from reportlab.platypus.flowables import Spacer
 from reportlab.platypus.frames import Frame
 
@@ -47,7 +50,7 @@ def pisa_error_document(dest, c):
 
 
 def pisa_story(src, path=None, link_callback=None, debug=0, default_css=None, xhtml=False, encoding=None, context=None,
-               xml_output=None, **kwargs):
+               xml_output=None, parser=None, stream=False, **kwargs):
     # Prepare Context
     if not context:
         context = PisaContext(path, debug=debug)
@@ -58,10 +61,10 @@ def pisa_story(src, path=None, link_callback=None, debug=0, default_css=None, xh
         default_css = DEFAULT_CSS
 
     # Parse and fill the story
-    pisaParser(src, context, default_css, xhtml, encoding, xml_output)
+    pisaParser(src, context, default_css, xhtml, encoding, xml_output, parser, stream)
 
     # Avoid empty documents
-    if not context.story:
+    if not context.story and context.storySink is None:
         context.story = [Spacer(1, 1)]
 
     if context.indexing_story:
@@ -74,16 +77,7 @@ def pisa_story(src, path=None, link_callback=None, debug=0, default_css=None, xh
     return context
 
 
-def pisa_document(src, dest=None, path=None, link_callback=None, debug=0, default_css=None, xhtml=False, encoding=None,
-                  xml_output=None, raise_exception=True, capacity=100 * 1024, **kwargs):
-    log.debug("pisaDocument options:\n  src = %r\n  dest = %r\n  path = %r\n  link_callback = %r\n  xhtml = %r",
-              src, dest, path, link_callback, xhtml)
-    # Build story
-    context = pisa_story(src, path, link_callback, debug, default_css, xhtml, encoding,
-                         context=PisaContext(path, debug=debug, capacity=capacity), xml_output=xml_output)
-
-    # Buffer PDF into memory
-    out = NamedTemporaryFile()
+def _create_document(context, out):
     doc = PmlBaseDoc(out,
                      pagesize=context.pageSize,
                      author=context.meta["author"].strip(),
@@ -108,11 +102,114 @@ def pisa_document(src, dest=None, path=None, link_callback=None, debug=0, defaul
                                pagesize=context.pageSize)
 
     doc.addPageTemplates([body] + list(context.templateList.values()))
-    # Use multibuild e.g. if a TOC has to be created
-    if context.multiBuild:
-        doc.multiBuild(context.story)
+    return doc
+
+
+class _StoryStream(object):
+    """
+    The storySink of pisa_document with stream: lays out the parts of the
+    story while the rest of the document is parsed. The document is
+    created with the first part, when the <head> and the styles are known.
+
+    The layout is done in one pass, <pdf:toc> and <pdf:pagecount> need two.
+    Once one of them is found in a src that can be read again, the rest is
+    not laid out and restart is set, pisa_document then renders src once
+    more without streaming. Otherwise they stay empty. Links to anchors
+    which are not in the document point to the last page, they are laid
+    out before it is known.
+    """
+
+    def __init__(self, context, out, can_restart=False):
+        self.context = context
+        self.out = out
+        self.doc = None
+        self.templates = set()
+        self.can_restart = can_restart
+        self.restart = False
+
+    def __call__(self, story):
+        context = self.context
+        if context.multiBuild and self.can_restart:
+            self.restart = True
+        if self.restart:
+            return
+        if self.doc is None:
+            self.doc = _create_document(context, self.out)
+            self.templates = set(context.templateList)
+            self.doc.start_build()
+        else:
+            # Templates of <pdf:template> elements further down the body
+            names = set(context.templateList) - self.templates
+            if names:
+                self.templates.update(names)
+                self.doc.addPageTemplates([context.templateList[name] for name in names])
+        self.doc.add_flowables(story)
+
+    def close(self):
+        context = self.context
+        if self.doc is None or context.story:
+            self(context.story or [Spacer(1, 1)])
+        if self.restart:
+            return
+        if context.multiBuild:
+            log.warning(context.warning("Table of contents and page count stay empty, the streamed input can not be read twice"))
+        canv = self.doc.canv
+        for frag, anchor in context.anchorFrag:
+            if anchor not in context.anchorName:
+                context.anchorName.append(anchor)
+                canv.bookmarkPage(anchor)
+        self.doc.end_build()
+
+
+def _rewinder(src):
+    # A function which puts src back to its start for a second pass, None
+    # if src can only be read once like a pipe
+    if isinstance(src, (binary_type, text_type)) or dom.is_tree(src):
+        return lambda: None
+    try:
+        position = src.tell()
+    except (AttributeError, IOError, OSError):
+        return None
+    return lambda: src.seek(position)
+
+
+def pisa_document(src, dest=None, path=None, link_callback=None, debug=0, default_css=None, xhtml=False, encoding=None,
+                  xml_output=None, raise_exception=True, capacity=100 * 1024, parser=None, stream=False, **kwargs):
+    """
+    With `stream` the story is laid out while the document is parsed, the
+    whole document and story are never kept in memory; see _StoryStream
+    for what is not available then. A document with a table of contents
+    or a page count is rendered once more without streaming if src can be
+    read again.
+    """
+    log.debug("pisaDocument options:\n  src = %r\n  dest = %r\n  path = %r\n  link_callback = %r\n  xhtml = %r",
+              src, dest, path, link_callback, xhtml)
+    context = PisaContext(path, debug=debug, capacity=capacity)
+    out = NamedTemporaryFile()
+    rewind = None
+    if stream:
+        rewind = _rewinder(src)
+        context.storySink = _StoryStream(context, out, rewind is not None)
+
+    # Build story
+    context = pisa_story(src, path, link_callback, debug, default_css, xhtml, encoding,
+                         context=context, xml_output=xml_output, parser=parser, stream=stream)
+
+    # Buffer PDF into memory
+    if stream:
+        context.storySink.close()
+        if context.storySink.restart:
+            log.warning(context.warning("Table of contents and page count need two passes, rendering without streaming"))
+            rewind()
+            return pisa_document(src, dest, path, link_callback, debug, default_css, xhtml, encoding, xml_output,
+                                 raise_exception, capacity, parser, False, **kwargs)
     else:
-        doc.build(context.story)
+        doc = _create_document(context, out)
+        # Use multibuild e.g. if a TOC has to be created
+        if context.multiBuild:
+            doc.multiBuild(context.story)
+        else:
+            doc.build(context.story)
     # Add watermarks
     if PyPDF2:
         for bgouter in context.pisaBackgroundList:
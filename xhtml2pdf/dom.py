@@ -0,0 +1,705 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2010 Dirk Holtwick, holtwick.it
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Parsers for the documents pisaParser renders. They all return the
+xml.dom.minidom Document the rest of pisaParser works on:
+
+- "html5lib": the HTML5 parser written in Python, the default
+- "lxml": the HTML parser of libxml2, much faster on large documents
+- "expat": the XML parser of the standard library, for well-formed XHTML
+
+"lxml" and "expat" fall back to html5lib if lxml is not installed or the
+document is not well-formed. Both feed their events into a DOMTreeBuilder,
+which builds the same kind of tree as html5lib. XHTML documents are parsed
+with expat by default.
+
+XHTMLStream parses XHTML with expat while pisaParser renders it, HTMLStream
+does the same with html5lib, see there. pisaParser only uses them when it
+is asked to stream.
+
+Documents which are parsed already, as xml.etree.ElementTree or lxml
+elements or as a minidom Document, are taken by parse_tree.
+"""
+
+import codecs
+import io
+import logging
+import sys
+import threading
+import xml.dom.minidom
+from xml.dom.minicompat import NodeList
+from xml.parsers import expat
+
+import html5lib
+from html5lib import treebuilders, inputstream
+from six import reraise, string_types, text_type, unichr
+from six.moves import html_entities, queue
+
+from xhtml2pdf.default import TAGS
+from xhtml2pdf.w3c import cssDOMElementInterface
+
+log = logging.getLogger("xhtml2pdf")
+
+XHTML_NAMESPACE = "http://www.w3.org/1999/xhtml"
+
+
+def _local_name(name):
+    # ElementTree style names are "{namespace}name"
+    return name.rsplit("}", 1)[-1]
+
+
+class DOMTreeBuilder(object):
+    """
+    Builds a Document from the events of a parser. The methods are the
+    target interface of the xml.etree.ElementTree and lxml parsers.
+
+    Like html5lib, elements get the XHTML namespace and lower case tag
+    names, and the document always has <html>, <head> and <body> elements:
+    content without them is moved into new ones.
+    """
+
+    def __init__(self):
+        self.document = xml.dom.minidom.getDOMImplementation().createDocument(None, None, None)
+        self.stack = [self.document]
+        self.text = []
+
+    def flush(self):
+        if self.text:
+            # Text outside of the root element is dropped
+            if len(self.stack) > 1:
+                self.stack[-1].appendChild(self.document.createTextNode(u"".join(self.text)))
+            del self.text[:]
+
+    def start(self, tag, attrib):
+        self.flush()
+        element = self.document.createElementNS(XHTML_NAMESPACE, _local_name(tag).lower())
+        for name, value in attrib.items():
+            element.setAttribute(_local_name(name), value)
+        self.stack[-1].appendChild(element)
+        self.stack.append(element)
+
+    def end(self, tag):
+        self.flush()
+        self.stack.pop()
+
+    def data(self, data):
+        self.text.append(data)
+
+    def entity(self, name, is_parameter_entity=False):
+        """
+        Adds the text of an entity the parser does not know, like the HTML
+        entity &nbsp; in XML.
+        """
+        codepoint = html_entities.name2codepoint.get(name)
+        if codepoint is None:
+            self.text.append(u"&%s;" % name)
+        else:
+            self.text.append(unichr(codepoint))
+
+    def comment(self, text):
+        self.flush()
+        self.stack[-1].appendChild(self.document.createComment(text))
+
+    def close(self):
+        self.flush()
+        document = self.document
+        html = document.documentElement
+        if html is None or html.tagName != "html":
+            root = html
+            html = document.createElementNS(XHTML_NAMESPACE, "html")
+            if root is not None:
+                html.appendChild(document.removeChild(root))
+            document.appendChild(html)
+
+        head = body = None
+        for node in list(html.childNodes):
+            if node.nodeType == node.ELEMENT_NODE:
+                if node.tagName == "head" and head is None:
+                    head = node
+                elif node.tagName == "body" and body is None:
+                    body = node
+            elif node.nodeType == node.TEXT_NODE and not node.data.strip():
+                # Whitespace goes where html5lib puts it
+                if head is None and body is None:
+                    html.removeChild(node)
+                elif body is not None:
+                    body.appendChild(html.removeChild(node))
+
+        if body is None:
+            body = document.createElementNS(XHTML_NAMESPACE, "body")
+            for node in list(html.childNodes):
+                if node is not head:
+                    body.appendChild(html.removeChild(node))
+            html.appendChild(body)
+        if head is None:
+            html.insertBefore(document.createElementNS(XHTML_NAMESPACE, "head"), html.firstChild)
+        return document
+
+
+def _check_encoding(encoding):
+    # Test for the restrictions of html5lib
+    if encoding:
+        # Workaround for html5lib<0.11.1
+        if hasattr(inputstream, "isValidEncoding"):
+            if encoding.strip().lower() == "utf8":
+                encoding = "utf-8"
+            if not inputstream.isValidEncoding(encoding):
+                log.error("%r is not a valid encoding e.g. 'utf8' is not valid but 'utf-8' is!", encoding)
+        else:
+            if inputstream.codecName(encoding) is None:
+                log.error("%r is not a valid encoding", encoding)
+
+
+def parse_html5lib(src, encoding=None, xhtml=False):
+    # html5lib has no XHTML parser, documents that are not well-formed
+    # XHTML are parsed as HTML
+    parser = html5lib.HTMLParser(tree=treebuilders.getTreeBuilder("dom"))
+    _check_encoding(encoding)
+    return parser.parse(
+        src,
+        encoding=encoding)
+
+
+def parse_lxml(src, encoding=None, xhtml=False):
+    from lxml import etree
+
+    # With a target the parser returns the result of DOMTreeBuilder.close
+    return etree.fromstring(src, etree.HTMLParser(target=DOMTreeBuilder(), encoding=encoding))
+
+
+def _create_expat_parser(builder, encoding=None):
+    # Expat only knows a few encodings itself, other encodings are
+    # decoded before and handed to it as UTF-8
+    if encoding:
+        parser = expat.ParserCreate("utf-8")
+    else:
+        parser = expat.ParserCreate()
+    parser.buffer_text = True
+    # Entities not defined by the document are handed to
+    # DOMTreeBuilder.entity instead of being an error
+    parser.UseForeignDTD(True)
+    parser.StartElementHandler = builder.start
+    parser.EndElementHandler = builder.end
+    parser.CharacterDataHandler = builder.data
+    parser.CommentHandler = builder.comment
+    parser.SkippedEntityHandler = builder.entity
+    return parser
+
+
+def parse_expat(src, encoding=None, xhtml=False):
+    if encoding:
+        src = src.decode(encoding).encode("utf-8")
+    builder = DOMTreeBuilder()
+    _create_expat_parser(builder, encoding).Parse(src, True)
+    return builder.close()
+
+
+def is_tree(src):
+    """True if src is a parsed document parse_tree takes."""
+    return isinstance(src, xml.dom.minidom.Document) or hasattr(src, "getroot") or hasattr(src, "tag")
+
+
+def _prefix(element, prefixes):
+    """
+    The prefix the tag name of element needs, as in <pdf:toc>, or None.
+    lxml knows the prefix of an element, ElementTree only the namespace,
+    which is looked up in prefixes.
+    """
+    if hasattr(element, "nsmap"):
+        prefix = element.prefix
+        if prefix and element.nsmap.get(prefix) != XHTML_NAMESPACE:
+            return prefix
+        return None
+    tag = element.tag
+    if not tag.startswith("{"):
+        return None
+    namespace = tag[1:].split("}", 1)[0]
+    if namespace in prefixes:
+        return prefixes[namespace]
+    if namespace != XHTML_NAMESPACE and "pdf" + _local_name(tag).lower() in TAGS:
+        # Without its prefix the tag would silently be ignored
+        raise ValueError("The namespace %r of <%s> has no prefix, ElementTree does not keep them: use "
+                         "parse_tree(tree, namespaces={'pdf': %r})" % (namespace, _local_name(tag), namespace))
+    return None
+
+
+def parse_tree(tree, namespaces=None):
+    """
+    Returns the Document of a parsed document: an ElementTree, the root
+    element of one or an lxml element or tree. The elements are handed to a
+    DOMTreeBuilder, just like the events of the parsers.
+
+    ElementTree does not keep the prefixes of tag names, `namespaces` maps
+    the prefixes to their namespaces like in ElementTree.find, e.g.
+    {"pdf": "http://example.com/pdf"} for <pdf:toc>. A <pdf:*> tag in a
+    namespace that is not mapped raises a ValueError.
+
+    A minidom Document is copied, pisaParser changes the document it
+    renders.
+    """
+    if isinstance(tree, xml.dom.minidom.Document):
+        return tree.cloneNode(True)
+    if hasattr(tree, "getroot"):
+        tree = tree.getroot()
+    prefixes = dict((namespace, prefix) for prefix, namespace in (namespaces or {}).items())
+
+    builder = DOMTreeBuilder()
+    # The elements still to start and the tails of the elements to end
+    stack = [(tree, None)]
+    while stack:
+        element, tail = stack.pop()
+        if element is None:
+            builder.end(None)
+            if tail:
+                builder.data(tail)
+            continue
+
+        tag = element.tag
+        if isinstance(tag, string_types):
+            prefix = _prefix(element, prefixes)
+            if prefix:
+                tag = "%s:%s" % (prefix, _local_name(tag))
+            builder.start(tag, element.attrib)
+            if element.text:
+                builder.data(element.text)
+            stack.append((None, element.tail))
+            stack.extend((child, None) for child in reversed(element))
+            continue
+
+        # Comment, ProcessingInstruction or the Entity of lxml, they are
+        # factory functions in both ElementTree and lxml
+        kind = getattr(tag, "__name__", "")
+        if kind == "Comment":
+            builder.comment(element.text or u"")
+        elif kind == "Entity":
+            builder.entity(element.text.strip(u"&;"))
+        if element.tail:
+            builder.data(element.tail)
+    return builder.close()
+
+
+PARSERS = {
+    "html5lib": parse_html5lib,
+    "lxml": parse_lxml,
+    "expat": parse_expat,
+}
+
+
+def _read(src, encoding):
+    if hasattr(src, "read"):
+        src = src.read()
+    if isinstance(src, text_type):
+        src = src.encode(encoding or "utf-8")
+    return src
+
+
+def parse(src, encoding=None, xhtml=False, parser=None):
+    """
+    Parses src, a byte string or file, with the parser of that name in
+    PARSERS and returns the Document. A parsed document is converted by
+    parse_tree.
+    """
+    if is_tree(src):
+        return parse_tree(src)
+    if parser is None and xhtml:
+        parser = "expat"
+    if parser in (None, "html5lib"):
+        return parse_html5lib(src, encoding, xhtml)
+    if parser not in PARSERS:
+        raise ValueError("Unknown parser %r, use one of %s" % (parser, ", ".join(sorted(PARSERS))))
+
+    src = _read(src, encoding)
+    try:
+        return PARSERS[parser](src, encoding, xhtml)
+    except ImportError as e:
+        log.warning("Parser %r is not available (%s), using html5lib", parser, e)
+    except expat.ExpatError as e:
+        log.warning("Document is not well-formed (%s), using html5lib", e)
+    return parse_html5lib(src, encoding, xhtml)
+
+
+def _free(node):
+    # Breaks the reference cycles of a rendered node which was removed from
+    # the document, so that it is freed at once and not some time later by
+    # the garbage collector
+    nodes = [node]
+    while nodes:
+        element = nodes.pop()
+        if element.nodeType == element.ELEMENT_NODE:
+            element.cssElement = None
+            nodes.extend(element.childNodes)
+    node.unlink()
+
+
+class _StreamedNodeList(NodeList):
+    # The childNodes of the <body> of an XHTMLStream, iterating over them
+    # parses the body
+
+    __slots__ = ("stream",)
+
+    def __iter__(self):
+        return self.stream.iter_body()
+
+
+class XHTMLStream(object):
+    """
+    Parses a well-formed XHTML document with expat in pieces of chunk_size
+    bytes while it is rendered, so that a large document never has to be
+    kept in memory as a whole:
+
+    - parse_head parses the document up to the start of <body> and
+      returns the Document, with everything pisaParser needs before
+      pisaLoop: the <head> with its styles and links.
+    - stream_body replaces the childNodes of <body> by a list that
+      parses the rest of the document while pisaLoop iterates over it.
+      Every child of <body> is handed to pisaLoop once it is complete and
+      the next element has started, so :last-child and the sibling
+      selectors still see the next element, and is removed from the
+      document after pisaLoop is done with it.
+
+    Only the top level of <body> is streamed: one large table is kept as
+    a whole until it is rendered. <style> elements in the body are not
+    applied, styles of a streamed document belong into the <head>. A
+    selector like "h1 + p + p" does not match on the top level of <body>,
+    the element before the previous one is gone already.
+
+    A document that turns out not to be well-formed before <body> starts
+    is parsed with html5lib instead, after that the ExpatError is raised
+    by the iteration in pisaLoop. For these reasons pisaParser only
+    streams when it is asked to, otherwise XHTML is parsed as a whole.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, src, encoding=None):
+        if isinstance(src, text_type):
+            src = src.encode(encoding or "utf-8")
+        if not hasattr(src, "read"):
+            src = io.BytesIO(src)
+        self.src = src
+        self.encoding = encoding
+        self.decoder = None
+        if encoding:
+            self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.builder = DOMTreeBuilder()
+        self.parser = _create_expat_parser(self.builder, encoding)
+        self.parser.StartElementHandler = self.start
+        # The input read before <body>, for html5lib
+        self.chunks = []
+        self.body = None
+        self.done = False
+
+    def start(self, tag, attrib):
+        builder = self.builder
+        builder.start(tag, attrib)
+        if self.body is None and len(builder.stack) == 3:
+            html, body = builder.stack[1:]
+            if html.tagName == "html" and body.tagName == "body":
+                self.body = body
+
+    def feed(self):
+        """Parses the next chunk, returns False at the end of the input."""
+        if self.done:
+            return False
+        data = self.src.read(self.chunk_size)
+        if self.chunks is not None:
+            self.chunks.append(data)
+        self.done = not data
+        if self.decoder:
+            data = self.decoder.decode(data, self.done).encode("utf-8")
+        self.parser.Parse(data, self.done)
+        return not self.done
+
+    @property
+    def streaming(self):
+        """True if the <body> is not parsed completely."""
+        return self.body is not None and not self.is_body_closed()
+
+    def is_body_closed(self):
+        return len(self.builder.stack) < 3
+
+    def parse_head(self):
+        try:
+            while self.body is None and self.feed():
+                pass
+        except expat.ExpatError as e:
+            log.warning("Document is not well-formed (%s), using html5lib", e)
+            src = b"".join(self.chunks) + self.src.read()
+            self.chunks = None
+            self.done = True
+            return parse_html5lib(src, self.encoding)
+        self.chunks = None
+        if self.body is None:
+            # No <body>, the document is parsed completely
+            return self.builder.close()
+
+        # What DOMTreeBuilder.close would do for the <html>
+        document = self.builder.document
+        html = document.documentElement
+        for node in list(html.childNodes):
+            if node.nodeType == node.TEXT_NODE and not node.data.strip():
+                html.removeChild(node)
+        if html.firstChild is self.body:
+            html.insertBefore(document.createElementNS(XHTML_NAMESPACE, "head"), self.body)
+        return document
+
+    def stream_body(self):
+        if self.streaming:
+            nodes = _StreamedNodeList(self.body.childNodes)
+            nodes.stream = self
+            self.body.childNodes = nodes
+
+    def close(self):
+        pass
+
+    def iter_body(self):
+        body = self.body
+        nodes = body.childNodes
+        parent = cssDOMElementInterface.getElementInterface(body)
+        previous = None
+        while True:
+            # Text is complete when it is added, an element when the next
+            # element starts or the body ends
+            while True:
+                following = None
+                for node in nodes[1:]:
+                    if node.nodeType == node.ELEMENT_NODE:
+                        following = node
+                        break
+                if following is not None or self.is_body_closed():
+                    break
+                if nodes and nodes[0].nodeType != nodes[0].ELEMENT_NODE:
+                    break
+                if not self.feed():
+                    break
+            if not nodes:
+                break
+
+            node = nodes[0]
+            element = None
+            if node.nodeType == node.ELEMENT_NODE:
+                cssDOMElementInterface.indexElements(node)
+                element = cssDOMElementInterface.getElementInterface(node)
+                element._parent = parent
+                element._previous = previous
+                if following is None:
+                    element._next = None
+                else:
+                    element._next = cssDOMElementInterface.getElementInterface(following)
+            yield node
+
+            body.removeChild(node)
+            if element is None:
+                _free(node)
+            else:
+                # Only the previous element is kept for the next one
+                element._previous = None
+                if previous is not None:
+                    _free(previous.domElement)
+                previous = element
+        if previous is not None:
+            _free(previous.domElement)
+
+        # The rest of the document after </body>
+        while self.feed():
+            pass
+
+
+class _StreamingHTMLParser(html5lib.HTMLParser):
+
+    def __init__(self, stream):
+        super(_StreamingHTMLParser, self).__init__(tree=treebuilders.getTreeBuilder("dom"))
+        self.stream = stream
+
+    def normalizedTokens(self):
+        # The tree is complete up to the token which is processed next
+        for token in super(_StreamingHTMLParser, self).normalizedTokens():
+            self.stream.hand_over(self.tree)
+            yield token
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class HTMLStream(object):
+    """
+    Parses an HTML document with html5lib in a thread of its own while it
+    is rendered. It is used like XHTMLStream, see there, and has the same
+    limits.
+
+    html5lib can not be fed a piece at a time, its parser pulls the tokens
+    and builds the tree in one loop. Between two tokens the parser thread
+    puts the children of <body> which are complete into a queue of
+    queue_size nodes, from which iter_body takes them. A child is complete
+    once it is no longer an open element and the next element has
+    started; html5lib never changes an element after it was closed. The
+    parser thread removes a child from the document before it is put into
+    the queue, so the renderer gets a subtree the parser thread never
+    touches again, only its parentNode still is the <body>. iter_body
+    frees it when it is rendered. When the queue is full the parser waits,
+    so the document in memory stays small.
+    """
+
+    queue_size = 16
+    _end = object()
+
+    def __init__(self, src, encoding=None):
+        self.src = src
+        self.encoding = encoding
+        self.document = None
+        self.body = None
+        self.closed = False
+        self.error = None
+        # The parser thread sets head when the <body> has started or the
+        # document is parsed, and waits for resume
+        self.head = threading.Event()
+        self.resume = threading.Event()
+        self.queue = queue.Queue(self.queue_size)
+        self.thread = threading.Thread(target=self.run, name="xhtml2pdf.dom.HTMLStream")
+        self.thread.daemon = True
+
+    @property
+    def streaming(self):
+        """True if the <body> is not parsed completely."""
+        return self.body is not None and not self.closed
+
+    def run(self):
+        try:
+            parser = _StreamingHTMLParser(self)
+            _check_encoding(self.encoding)
+            document = parser.parse(self.src, encoding=self.encoding)
+            if self.body is not None:
+                self.hand_over(parser.tree, True)
+                self.put(self._end)
+            else:
+                self.document = document
+        except _Cancelled:
+            pass
+        except BaseException:
+            self.error = sys.exc_info()
+            try:
+                self.put(self._end)
+            except _Cancelled:
+                pass
+        finally:
+            self.head.set()
+
+    def put(self, item):
+        while not self.closed:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise _Cancelled()
+
+    def parse_head(self):
+        self.thread.start()
+        self.head.wait()
+        if self.body is None:
+            if self.error is not None:
+                reraise(*self.error)
+        return self.document
+
+    def stream_body(self):
+        if self.streaming:
+            nodes = _StreamedNodeList(self.body.childNodes)
+            nodes.stream = self
+            self.body.childNodes = nodes
+            self.resume.set()
+
+    def close(self):
+        """Stops the parser thread if the body was not rendered completely."""
+        self.closed = True
+        self.resume.set()
+
+    def hand_over(self, tree, end=False):
+        # In the parser thread
+        body = self.body
+        if body is None:
+            if len(tree.openElements) < 2 or tree.openElements[1].name != "body":
+                return
+            self.document = tree.getDocument()
+            self.body = body = tree.openElements[1].element
+            self.head.set()
+            self.resume.wait()
+            if self.closed:
+                raise _Cancelled()
+
+        nodes = body.childNodes
+        if end:
+            current = None
+        elif len(tree.openElements) > 2:
+            current = tree.openElements[2].element
+        else:
+            current = None
+
+        while nodes:
+            node = nodes[0]
+            following = None
+            if node.nodeType == node.ELEMENT_NODE:
+                if node is current:
+                    break
+                for sibling in nodes[1:]:
+                    if sibling.nodeType == sibling.ELEMENT_NODE:
+                        following = sibling
+                        break
+                else:
+                    if not end:
+                        break
+            # From here on the node belongs to the renderer
+            body.removeChild(node)
+            node.parentNode = body
+            self.put((node, following))
+
+    def iter_body(self):
+        parent = cssDOMElementInterface.getElementInterface(self.body)
+        previous = None
+        try:
+            while True:
+                item = self.queue.get()
+                if item is self._end:
+                    break
+                node, following = item
+                element = None
+                if node.nodeType == node.ELEMENT_NODE:
+                    cssDOMElementInterface.indexElements(node)
+                    element = cssDOMElementInterface.getElementInterface(node)
+                    element._parent = parent
+                    element._previous = previous
+                    if following is None:
+                        element._next = None
+                    else:
+                        element._next = cssDOMElementInterface.getElementInterface(following)
+                yield node
+
+                if element is None:
+                    _free(node)
+                else:
+                    # Only the previous element is kept for the next one
+                    element._previous = None
+                    if previous is not None:
+                        _free(previous.domElement)
+                    previous = element
+        finally:
+            self.close()
+        self.thread.join()
+        if self.error is not None:
+            reraise(*self.error)
+        if previous is not None:
+            _free(previous.domElement)
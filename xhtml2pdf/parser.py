@@ -14,10 +14,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from __future__ import print_function, unicode_literals
-from html5lib import treebuilders, inputstream
 from xhtml2pdf.default import TAGS, STRING, INT, BOOL, SIZE, COLOR, FILE
 from xhtml2pdf.default import BOX, POS, MUST, FONT
-from xhtml2pdf.util import get_size, str_to_bool, to_list, get_color, get_alignment
+from xhtml2pdf.util import get_size, str_to_bool, to_list, get_color, get_alignment, CSSValue, compile_css_value
 from xhtml2pdf.util import get_box, get_position, PisaTempFile
 from reportlab.platypus.doctemplate import NextPageTemplate, FrameBreak
 from reportlab.platypus.flowables import PageBreak, KeepInFrame
@@ -27,7 +26,6 @@ from xhtml2pdf.tables import * # TODO: Kill wild import!
 from xhtml2pdf.util import * # TODO: Kill wild import!
 from xml.dom import Node
 import copy
-import html5lib
 import logging
 import re
 
@@ -40,101 +38,190 @@ else:
     StringTypes = (str,)
 
 import xhtml2pdf.w3c.cssDOMElementInterface as cssDOMElementInterface
-import xml.dom.minidom
+from xhtml2pdf import dom
 from six import text_type
 
-CSSAttrCache = {}
-
 log = logging.getLogger("xhtml2pdf")
 
 rxhttpstrip = re.compile("https?://[^/]+(.*)", re.M | re.I)
 
 
 class AttrContainer(dict):
+    # Values which are converted when they are read first, see
+    # pisaGetAttributes: {name: (convert, context, value, default)}
+    _pending = None
+
     def __getattr__(self, name):
         try:
             return dict.__getattr__(self, name)
         except:
             return self[name]
 
+    def __getitem__(self, name):
+        if self._pending and name in self._pending:
+            self._convert(name)
+        return dict.__getitem__(self, name)
 
-def pisaGetAttributes(c, tag, attributes):
-    global TAGS
+    def get(self, name, default=None):
+        if self._pending and name in self._pending:
+            self._convert(name)
+        return dict.get(self, name, default)
 
-    attrs = {}
-    if attributes:
-        for k, v in attributes.items():
-            try:
-                attrs[str(k)] = str(v)  # XXX no Unicode! Reportlab fails with template names
-            except:
-                attrs[k] = v
-
-    nattrs = {}
-    if tag in TAGS:
-        block, adef = TAGS[tag]
-        adef["id"] = STRING
-        # print block, adef
-        try:
-            iteritems = adef.iteritems()
-        except Exception:
-            iteritems = iter(adef.items())
-
-        for k, v in iteritems:
-            nattrs[k] = None
-            # print k, v
-            # defaults, wenn vorhanden
-            if type(v) == tuple:
-                if v[1] == MUST:
-                    if k not in attrs:
-                        log.warn(c.warning("Attribute '%s' must be set!", k))
-                        nattrs[k] = None
-                        continue
-                nv = attrs.get(k, v[1])
-                dfl = v[1]
-                v = v[0]
-            else:
-                nv = attrs.get(k, None)
-                dfl = None
+    def items(self):
+        if self._pending:
+            for name in list(self._pending):
+                self._convert(name)
+        return dict.items(self)
+
+    def values(self):
+        if self._pending:
+            for name in list(self._pending):
+                self._convert(name)
+        return dict.values(self)
+
+    def _convert(self, name):
+        convert, c, value, default = self._pending.pop(name)
+        dict.__setitem__(self, name, convert(c, name, value, default))
+
+
+def _attrString(value):
+    try:
+        return str(value)  # XXX no Unicode! Reportlab fails with template names
+    except:
+        return value
+
+
+def _attrChoice(choices):
+    def convert(c, name, value, default):
+        value = value.strip().lower()
+        if value not in choices:
+            #~ raise PML_EXCEPTION, "attribute '%s' of wrong value, allowed is one of: %s" % (k, repr(v))
+            log.warn(c.warning("Attribute '%s' of wrong value, allowed is one of: %s", name, repr(choices)))
+            return default
+        return value
+    return convert
+
+
+def _attrBool(c, name, value, default):
+    value = value.strip().lower()
+    return value in ("1", "y", "yes", "true", str(name))
+
+
+def _attrSize(c, name, value, default):
+    try:
+        return get_size(value)
+    except:
+        log.warn(c.warning("Attribute '%s' expects a size value", name))
+        return value
+
+
+_attrConverters = {
+    BOOL: _attrBool,
+    SIZE: _attrSize,
+    BOX: lambda c, name, value, default: get_box(value, c.pageSize),
+    POS: lambda c, name, value, default: get_position(value, c.pageSize),
+    INT: lambda c, name, value, default: int(value),
+    COLOR: lambda c, name, value, default: get_color(value),
+    FILE: lambda c, name, value, default: c.get_file(value),
+    FONT: lambda c, name, value, default: c.get_font_name(value),
+}
+
+# Converted when a tag handler reads them, most are never read
+LAZY_ATTR_TYPES = frozenset([FILE, FONT, SIZE])
+
+# Converted without a context, their defaults are converted in advance
+_contextFreeAttrTypes = frozenset([BOOL, SIZE, INT, COLOR])
 
-            if nv is not None:
-                if type(v) == list:
-                    nv = nv.strip().lower()
-                    if nv not in v:
-                        #~ raise PML_EXCEPTION, "attribute '%s' of wrong value, allowed is one of: %s" % (k, repr(v))
-                        log.warn(c.warning("Attribute '%s' of wrong value, allowed is one of: %s", k, repr(v)))
-                        nv = dfl
 
-                elif v == BOOL:
-                    nv = nv.strip().lower()
-                    nv = nv in ("1", "y", "yes", "true", str(k))
+class AttrSchema(object):
+    """
+    The attributes TAGS defines for a tag, compiled once for
+    pisaGetAttributes:
+
+    - `defaults` has a value for every attribute, the converted default or
+      None
+    - `converters` has (convert, default, lazy) by attribute name, convert
+      is None for strings
+    - `pending` has (convert, default) of the defaults which can only be
+      converted with a context, they are converted when they are read
+    - `required` are the attributes which must be set
+    """
 
-                elif v == SIZE:
-                    try:
-                        nv = get_size(nv)
-                    except:
-                        log.warn(c.warning("Attribute '%s' expects a size value", k))
+    def __init__(self, adef):
+        self.defaults = {}
+        self.converters = {}
+        self.pending = {}
+        self.required = []
+        adef = dict(adef, id=STRING)
+        for name, kind in adef.items():
+            default = None
+            if type(kind) == tuple:
+                kind, default = kind
+                if default == MUST:
+                    self.required.append(name)
+                    default = None
+            if type(kind) == list:
+                convert = _attrChoice(kind)
+                contextFree = True
+                lazy = False
+            else:
+                convert = _attrConverters.get(kind)
+                contextFree = kind in _contextFreeAttrTypes
+                lazy = kind in LAZY_ATTR_TYPES
+            self.converters[name] = (convert, default, lazy)
+            if default is None or convert is None:
+                self.defaults[name] = default
+            elif contextFree:
+                self.defaults[name] = convert(None, name, _attrString(default), default)
+            else:
+                self.defaults[name] = None
+                self.pending[name] = (convert, _attrString(default))
 
-                elif v == BOX:
-                    nv = get_box(nv, c.pageSize)
 
-                elif v == POS:
-                    nv = get_position(nv, c.pageSize)
+def compileAttrSchemas(tags):
+    """
+    Returns an AttrSchema for every tag of `tags`, see xhtml2pdf.default.TAGS.
+    """
+    return dict((tag, AttrSchema(adef)) for tag, (block, adef) in tags.items())
 
-                elif v == INT:
-                    nv = int(nv)
 
-                elif v == COLOR:
-                    nv = get_color(nv)
+ATTR_SCHEMAS = compileAttrSchemas(TAGS)
 
-                elif v == FILE:
-                    nv = c.get_file(nv)
 
-                elif v == FONT:
-                    nv = c.get_font_name(nv)
+def pisaGetAttributes(c, tag, attributes):
+    schema = ATTR_SCHEMAS.get(tag)
+    if schema is None:
+        # Tags like <span> have no attributes for pisaLoop and the handlers
+        return AttrContainer()
 
-                nattrs[k] = nv
+    nattrs = AttrContainer(schema.defaults)
+    pending = {}
+    for name, (convert, default) in schema.pending.items():
+        pending[name] = (convert, c, default, default)
 
-    return AttrContainer(nattrs)
+    if attributes:
+        converters = schema.converters
+        for name, value in attributes.items():
+            if name not in converters:
+                continue
+            convert, default, lazy = converters[name]
+            value = _attrString(value)
+            if convert is None:
+                nattrs[name] = value
+            elif lazy:
+                pending[name] = (convert, c, value, default)
+            else:
+                nattrs[name] = convert(c, name, value, default)
+
+    for name in schema.required:
+        if not attributes or attributes.get(name) is None:
+            log.warn(c.warning("Attribute '%s' must be set!", name))
+            nattrs[name] = None
+            pending.pop(name, None)
+
+    if pending:
+        nattrs._pending = pending
+    return nattrs
 
 
 attrNames = '''
@@ -190,39 +277,27 @@ attrNames = '''
     -pdf-keep-in-frame-mode
     -pdf-word-wrap
     '''.strip().split()
+attrNameSet = frozenset(attrNames)
 
+# The computed font size travels with the fragment, the value the parent
+# specified is relative to the font size of its own parent.
+fragmentInheritedAttrNames = frozenset(["font-size"])
 
-def getCSSAttr(self, cssCascade, attrName, default=NotImplemented):
-    if attrName in self.cssAttrs:
-        return self.cssAttrs[attrName]
+# Units CSS2Frag resolves against the font size of the element itself. An
+# inherited value has to be resolved against the font size of the parent.
+relativeUnits = frozenset(["em", "ex", "%"])
 
-    try:
-        result = cssCascade.findStyleFor(self.cssElement, attrName, default)
-    except LookupError:
-        result = None
 
-    # XXX Workaround for inline styles
-    try:
-        style = self.cssStyle
-    except:
-        style = self.cssStyle = cssCascade.parser.parse_inline(self.cssElement.getStyleAttr() or '')[0]
-    if attrName in style:
-        result = style[attrName]
-
-    if result == 'inherit':
-        if hasattr(self.parentNode, 'getCSSAttr'):
-            result = self.parentNode.getCSSAttr(cssCascade, attrName, default)
-        elif default is not NotImplemented:
-            return default
-        raise LookupError("Could not find inherited CSS attribute value for '%s'" % (attrName,))
-
-    if result is not None:
-        self.cssAttrs[attrName] = result
-    return result
+def getComputedValue(cssAttrName, value, fontSize):
+    """
+    Returns value as it is inherited from an element with fontSize: relative
+    lengths become absolute, everything else is kept.
+    """
+    if isinstance(value, CSSValue) and value.points is None and value.unit in relativeUnits:
+        return compile_css_value(cssAttrName, "%spt" % value.get_size(fontSize))
+    return value
 
 
-#TODO: Monkeypatching standard lib should go away.
-xml.dom.minidom.Element.getCSSAttr = getCSSAttr
 
 # Create an aliasing system.  Many sources use non-standard tags, because browsers allow
 # them to.  This allows us to map a nonstandard name to the standard one.
@@ -233,10 +308,32 @@ nonStandardAttrNames = {
 def mapNonStandardAttrs(c, n, attrList):
     for attr in nonStandardAttrNames:
         if attr in attrList and nonStandardAttrNames[attr] not in c:
+            # The computed style may be shared with other elements
+            c = dict(c)
             c[nonStandardAttrNames[attr]] = attrList[attr]
     return c
 
-def getCSSAttrCacheKey(node):
+def getCSSAttrCacheKey(node, dependencies):
+    """
+    Returns the key under which the computed style of node is shared with
+    other elements, or None if it may not be shared.
+
+    Elements share their style if the styles of their parents are shared
+    and they have the same tag name, class, id, inline style, values of
+    the attributes used in selectors and, if the selectors need it, the
+    same position among their siblings. As the styles of the ancestors are
+    shared too, descendant and child selectors match all of them alike.
+    """
+    attrNames, pseudoClasses, adjacentSiblings = dependencies
+
+    parent = node.parentNode
+    if parent.nodeType == Node.ELEMENT_NODE:
+        parentKey = getattr(parent, "cssShareKey", None)
+        if parentKey is None:
+            return None
+    else:
+        parentKey = 0
+
     _cl = _id = _st = ''
     for k, v in node.attributes.items():
         if k == 'class':
@@ -245,7 +342,31 @@ def getCSSAttrCacheKey(node):
             _id = v
         elif k == 'style':
             _st = v
-    return "%s#%s#%s#%s#%s" % (id(node.parentNode), node.tagName.lower(), _cl, _id, _st)
+    key = (parentKey, node.tagName, _cl, _id, _st)
+
+    if attrNames:
+        attrs = node.attributes
+        for name in attrNames:
+            attr = attrs.get(name)
+            key += (None if attr is None else attr.value,)
+
+    if pseudoClasses or adjacentSiblings:
+        element = cssDOMElementInterface.getElementInterface(node)
+        previous = element.getPreviousSibling()
+        if adjacentSiblings:
+            # Share keys start at 1
+            previousKey = 0
+            if previous is not None:
+                previousKey = getattr(previous.domElement, "cssShareKey", None)
+                if previousKey is None:
+                    return None
+            key += (previousKey,)
+        else:
+            key += (previous is None,)
+        if pseudoClasses:
+            key += (element.getNextSibling() is None,)
+
+    return key
 
 def CSSCollect(node, c):
     #node.cssAttrs = {}
@@ -253,165 +374,234 @@ def CSSCollect(node, c):
 
     if c.css:
 
-        _key = getCSSAttrCacheKey(node)
+        _key = getCSSAttrCacheKey(node, c.cssStyleDependencies)
 
-        if hasattr(node.parentNode, "tagName"):
-            if node.parentNode.tagName.lower() != "html":
-                CachedCSSAttr = CSSAttrCache.get(_key, None)
-                if CachedCSSAttr is not None:
-                    node.cssAttrs = CachedCSSAttr
-                    return CachedCSSAttr
+        if _key is not None:
+            CachedCSSAttr = c.cssAttrCache.get(_key, None)
+            if CachedCSSAttr is not None:
+                node.cssShareKey, node.cssAttrs = CachedCSSAttr
+                return node.cssAttrs
 
-        node.cssElement = cssDOMElementInterface.CSSDOMElementInterface(node)
+        element = cssDOMElementInterface.getElementInterface(node)
+        element.setAncestorFilter(c.cssAncestorFilter)
         node.cssAttrs = {}
         # node.cssElement.onCSSParserVisit(c.cssCascade.parser)
-        cssAttrMap = {}
-        for cssAttrName in attrNames:
-            try:
-                cssAttrMap[cssAttrName] = node.getCSSAttr(c.cssCascade, cssAttrName)
-            #except LookupError:
-            #    pass
-            except Exception: # TODO: Kill this catch-all!
-                log.debug("CSS error '%s'", cssAttrName, exc_info=1)
 
-        CSSAttrCache[_key] = node.cssAttrs
+        # Match all selectors once and collect every property in one pass
+        try:
+            styles = c.cssCascade.findStylesForElement(element, attrNameSet)
+        except Exception: # TODO: Kill this catch-all!
+            log.debug("CSS error", exc_info=1)
+            styles = {}
+
+        # XXX Workaround for inline styles
+        try:
+            style = node.cssStyle = c.cssCascade.parser.parse_inline(element.getStyleAttr() or '')[0]
+        except Exception: # TODO: Kill this catch-all!
+            log.debug("CSS error in inline style", exc_info=1)
+            style = {}
+
+        # pisaLoop styles the parent first, so its values are resolved
+        # already and 'inherit' does not need to walk up the tree. The
+        # fragment is still the one of the parent, with its computed font
+        # size.
+        parentAttrs = getattr(node.parentNode, "cssAttrs", {})
+        computed = False
+
+        for cssAttrName in attrNames:
+            if cssAttrName in style:
+                result = style[cssAttrName]
+            else:
+                result = styles.get(cssAttrName)
+            if result == 'inherit':
+                if cssAttrName in fragmentInheritedAttrNames:
+                    continue
+                result = parentAttrs.get(cssAttrName)
+                if result is not None:
+                    value = getComputedValue(cssAttrName, result, c.frag.fontSize)
+                    computed = computed or value is not result
+                    result = value
+            if result is not None:
+                node.cssAttrs[cssAttrName] = result
+
+        # Elements with the same parent style may have parents of other font
+        # sizes, set by attributes or tags
+        if _key is None or computed:
+            node.cssShareKey = None
+        else:
+            node.cssShareKey = len(c.cssAttrCache) + 1
+            c.cssAttrCache[_key] = (node.cssShareKey, node.cssAttrs)
 
     return node.cssAttrs
 
 def lower(sequence):
-    if sequence in StringTypes:
+    if isinstance(sequence, StringTypes):
         return sequence.lower()
     else:
         return sequence[0].lower()
 
-def CSS2Frag(c, kw, isBlock):
+# Values of the stylesheets are converted when the stylesheet is built (see
+# util.compile_css_value), values from elsewhere still need the conversion.
+
+def css_color(value):
+    if isinstance(value, CSSValue):
+        return value.color
+    return get_color(value)
+
+def css_size(value, relative=0, base=None):
+    if isinstance(value, CSSValue):
+        return value.get_size(relative, base)
+    return get_size(value, relative, base)
+
+def str_lower(value):
+    return str(value).lower()
+
+def css_keyword(value, convert=lower):
+    if isinstance(value, CSSValue) and value.keyword is not None:
+        return value.keyword
+    return convert(value)
+
+def css_text(value):
+    if isinstance(value, CSSValue) and value.text is not None:
+        return value.text
+    try:
+        return "".join(to_list(value))
+    except TypeError:
+        # sequence item 0: expected string, tuple found
+        return "".join(to_list(value[0]))
+
+def CSS2Frag(c, margins, isBlock):
+    """
+    Maps c.cssAttr to c.frag. `margins` are the left and right margins
+    of the parent block, the margins of this element are returned.
+    """
+    cssAttr = c.cssAttr
+    frag = c.frag
     # COLORS
-    if "color" in c.cssAttr:
-        c.frag.textColor = get_color(c.cssAttr["color"])
-    if "background-color" in c.cssAttr:
-        c.frag.backColor = get_color(c.cssAttr["background-color"])
+    if "color" in cssAttr:
+        frag.textColor = css_color(cssAttr["color"])
+    if "background-color" in cssAttr:
+        frag.backColor = css_color(cssAttr["background-color"])
         # FONT SIZE, STYLE, WEIGHT
-    if "font-family" in c.cssAttr:
-        c.frag.fontName = c.get_font_name(c.cssAttr["font-family"])
-    if "font-size" in c.cssAttr:
+    if "font-family" in cssAttr:
+        frag.fontName = c.get_font_name(cssAttr["font-family"])
+    if "font-size" in cssAttr:
         # XXX inherit
-        c.frag.fontSize = max(get_size("".join(c.cssAttr["font-size"]), c.frag.fontSize, c.baseFontSize), 1.0)
-    if "line-height" in c.cssAttr:
-        leading = "".join(c.cssAttr["line-height"])
-        c.frag.leading = get_size(leading, c.frag.fontSize)
-        c.frag.leadingSource = leading
+        frag.fontSize = max(css_size(cssAttr["font-size"], frag.fontSize, c.baseFontSize), 1.0)
+    if "line-height" in cssAttr:
+        leading = cssAttr["line-height"]
+        if not isinstance(leading, CSSValue):
+            leading = "".join(leading)
+        frag.leading = css_size(leading, frag.fontSize)
+        frag.leadingSource = leading
     else:
-        c.frag.leading = get_size(c.frag.leadingSource, c.frag.fontSize)
-    if "letter-spacing" in c.cssAttr:
-        c.frag.letterSpacing = c.cssAttr["letter-spacing"]
-    if "-pdf-line-spacing" in c.cssAttr:
-        c.frag.leadingSpace = get_size("".join(c.cssAttr["-pdf-line-spacing"]))
-        # print "line-spacing", c.cssAttr["-pdf-line-spacing"], c.frag.leading
-    if "font-weight" in c.cssAttr:
-        value = lower(c.cssAttr["font-weight"])
+        frag.leading = css_size(frag.leadingSource, frag.fontSize)
+    if "letter-spacing" in cssAttr:
+        frag.letterSpacing = cssAttr["letter-spacing"]
+    if "-pdf-line-spacing" in cssAttr:
+        frag.leadingSpace = css_size(cssAttr["-pdf-line-spacing"])
+        # print "line-spacing", cssAttr["-pdf-line-spacing"], frag.leading
+    if "font-weight" in cssAttr:
+        value = css_keyword(cssAttr["font-weight"])
         if value in ("bold", "bolder", "500", "600", "700", "800", "900"):
-            c.frag.bold = 1
+            frag.bold = 1
         else:
-            c.frag.bold = 0
-    for value in to_list(c.cssAttr.get("text-decoration", "")):
+            frag.bold = 0
+    for value in to_list(cssAttr.get("text-decoration", "")):
         if "underline" in value:
-            c.frag.underline = 1
+            frag.underline = 1
         if "line-through" in value:
-            c.frag.strike = 1
+            frag.strike = 1
         if "none" in value:
-            c.frag.underline = 0
-            c.frag.strike = 0
-    if "font-style" in c.cssAttr:
-        value = lower(c.cssAttr["font-style"])
+            frag.underline = 0
+            frag.strike = 0
+    if "font-style" in cssAttr:
+        value = css_keyword(cssAttr["font-style"])
         if value in ("italic", "oblique"):
-            c.frag.italic = 1
+            frag.italic = 1
         else:
-            c.frag.italic = 0
-    if "white-space" in c.cssAttr:
+            frag.italic = 0
+    if "white-space" in cssAttr:
         # normal | pre | nowrap
-        c.frag.whiteSpace = str(c.cssAttr["white-space"]).lower()
+        frag.whiteSpace = css_keyword(cssAttr["white-space"], str_lower)
         # ALIGN & VALIGN
-    if "text-align" in c.cssAttr:
-        c.frag.alignment = get_alignment(c.cssAttr["text-align"])
-    if "vertical-align" in c.cssAttr:
-        c.frag.vAlign = c.cssAttr["vertical-align"]
+    if "text-align" in cssAttr:
+        frag.alignment = get_alignment(css_keyword(cssAttr["text-align"], str))
+    if "vertical-align" in cssAttr:
+        frag.vAlign = cssAttr["vertical-align"]
         # HEIGHT & WIDTH
-    if "height" in c.cssAttr:
-        try:
-            c.frag.height = "".join(to_list(c.cssAttr["height"]))  # XXX Relative is not correct!
-        except TypeError:
-            # sequence item 0: expected string, tuple found
-            c.frag.height = "".join(to_list(c.cssAttr["height"][0]))
-        if c.frag.height in ("auto",):
-            c.frag.height = None
-    if "width" in c.cssAttr:
-        try:
-            c.frag.width = "".join(to_list(c.cssAttr["width"]))  # XXX Relative is not correct!
-        except TypeError:
-            c.frag.width = "".join(to_list(c.cssAttr["width"][0]))
-        if c.frag.width in ("auto",):
-            c.frag.width = None
+    if "height" in cssAttr:
+        frag.height = css_text(cssAttr["height"])  # XXX Relative is not correct!
+        if frag.height in ("auto",):
+            frag.height = None
+    if "width" in cssAttr:
+        frag.width = css_text(cssAttr["width"])  # XXX Relative is not correct!
+        if frag.width in ("auto",):
+            frag.width = None
         # ZOOM
-    if "zoom" in c.cssAttr:
-        zoom = "".join(to_list(c.cssAttr["zoom"]))  # XXX Relative is not correct!
+    if "zoom" in cssAttr:
+        zoom = css_text(cssAttr["zoom"])  # XXX Relative is not correct!
         if zoom.endswith("%"):
             zoom = float(zoom[: - 1]) / 100.0
-        c.frag.zoom = float(zoom)
+        frag.zoom = float(zoom)
         # MARGINS & LIST INDENT, STYLE
     if isBlock:
-        if "margin-top" in c.cssAttr:
-            c.frag.spaceBefore = get_size(c.cssAttr["margin-top"], c.frag.fontSize)
-        if "margin-bottom" in c.cssAttr:
-            c.frag.spaceAfter = get_size(c.cssAttr["margin-bottom"], c.frag.fontSize)
-        if "margin-left" in c.cssAttr:
-            c.frag.bulletIndent = kw["margin-left"]  # For lists
-            kw["margin-left"] += get_size(c.cssAttr["margin-left"], c.frag.fontSize)
-            c.frag.leftIndent = kw["margin-left"]
-        if "margin-right" in c.cssAttr:
-            kw["margin-right"] += get_size(c.cssAttr["margin-right"], c.frag.fontSize)
-            c.frag.rightIndent = kw["margin-right"]
-        if "text-indent" in c.cssAttr:
-            c.frag.firstLineIndent = get_size(c.cssAttr["text-indent"], c.frag.fontSize)
-        if "list-style-type" in c.cssAttr:
-            c.frag.listStyleType = str(c.cssAttr["list-style-type"]).lower()
-        if "list-style-image" in c.cssAttr:
-            c.frag.listStyleImage = c.get_file(c.cssAttr["list-style-image"])
+        if "margin-top" in cssAttr:
+            frag.spaceBefore = css_size(cssAttr["margin-top"], frag.fontSize)
+        if "margin-bottom" in cssAttr:
+            frag.spaceAfter = css_size(cssAttr["margin-bottom"], frag.fontSize)
+        marginLeft, marginRight = margins
+        if "margin-left" in cssAttr:
+            frag.bulletIndent = marginLeft  # For lists
+            marginLeft += css_size(cssAttr["margin-left"], frag.fontSize)
+            frag.leftIndent = marginLeft
+        if "margin-right" in cssAttr:
+            marginRight += css_size(cssAttr["margin-right"], frag.fontSize)
+            frag.rightIndent = marginRight
+        margins = (marginLeft, marginRight)
+        if "text-indent" in cssAttr:
+            frag.firstLineIndent = css_size(cssAttr["text-indent"], frag.fontSize)
+        if "list-style-type" in cssAttr:
+            frag.listStyleType = css_keyword(cssAttr["list-style-type"], str_lower)
+        if "list-style-image" in cssAttr:
+            frag.listStyleImage = c.get_file(cssAttr["list-style-image"])
         # PADDINGS
     if isBlock:
-        if "padding-top" in c.cssAttr:
-            c.frag.paddingTop = get_size(c.cssAttr["padding-top"], c.frag.fontSize)
-        if "padding-bottom" in c.cssAttr:
-            c.frag.paddingBottom = get_size(c.cssAttr["padding-bottom"], c.frag.fontSize)
-        if "padding-left" in c.cssAttr:
-            c.frag.paddingLeft = get_size(c.cssAttr["padding-left"], c.frag.fontSize)
-        if "padding-right" in c.cssAttr:
-            c.frag.paddingRight = get_size(c.cssAttr["padding-right"], c.frag.fontSize)
+        if "padding-top" in cssAttr:
+            frag.paddingTop = css_size(cssAttr["padding-top"], frag.fontSize)
+        if "padding-bottom" in cssAttr:
+            frag.paddingBottom = css_size(cssAttr["padding-bottom"], frag.fontSize)
+        if "padding-left" in cssAttr:
+            frag.paddingLeft = css_size(cssAttr["padding-left"], frag.fontSize)
+        if "padding-right" in cssAttr:
+            frag.paddingRight = css_size(cssAttr["padding-right"], frag.fontSize)
         # BORDERS
     if isBlock:
-        if "border-top-width" in c.cssAttr:
-            c.frag.borderTopWidth = get_size(c.cssAttr["border-top-width"], c.frag.fontSize)
-        if "border-bottom-width" in c.cssAttr:
-            c.frag.borderBottomWidth = get_size(c.cssAttr["border-bottom-width"], c.frag.fontSize)
-        if "border-left-width" in c.cssAttr:
-            c.frag.borderLeftWidth = get_size(c.cssAttr["border-left-width"], c.frag.fontSize)
-        if "border-right-width" in c.cssAttr:
-            c.frag.borderRightWidth = get_size(c.cssAttr["border-right-width"], c.frag.fontSize)
-        if "border-top-style" in c.cssAttr:
-            c.frag.borderTopStyle = c.cssAttr["border-top-style"]
-        if "border-bottom-style" in c.cssAttr:
-            c.frag.borderBottomStyle = c.cssAttr["border-bottom-style"]
-        if "border-left-style" in c.cssAttr:
-            c.frag.borderLeftStyle = c.cssAttr["border-left-style"]
-        if "border-right-style" in c.cssAttr:
-            c.frag.borderRightStyle = c.cssAttr["border-right-style"]
-        if "border-top-color" in c.cssAttr:
-            c.frag.borderTopColor = get_color(c.cssAttr["border-top-color"])
-        if "border-bottom-color" in c.cssAttr:
-            c.frag.borderBottomColor = get_color(c.cssAttr["border-bottom-color"])
-        if "border-left-color" in c.cssAttr:
-            c.frag.borderLeftColor = get_color(c.cssAttr["border-left-color"])
-        if "border-right-color" in c.cssAttr:
-            c.frag.borderRightColor = get_color(c.cssAttr["border-right-color"])
+        if "border-top-width" in cssAttr:
+            frag.borderTopWidth = css_size(cssAttr["border-top-width"], frag.fontSize)
+        if "border-bottom-width" in cssAttr:
+            frag.borderBottomWidth = css_size(cssAttr["border-bottom-width"], frag.fontSize)
+        if "border-left-width" in cssAttr:
+            frag.borderLeftWidth = css_size(cssAttr["border-left-width"], frag.fontSize)
+        if "border-right-width" in cssAttr:
+            frag.borderRightWidth = css_size(cssAttr["border-right-width"], frag.fontSize)
+        if "border-top-style" in cssAttr:
+            frag.borderTopStyle = cssAttr["border-top-style"]
+        if "border-bottom-style" in cssAttr:
+            frag.borderBottomStyle = cssAttr["border-bottom-style"]
+        if "border-left-style" in cssAttr:
+            frag.borderLeftStyle = cssAttr["border-left-style"]
+        if "border-right-style" in cssAttr:
+            frag.borderRightStyle = cssAttr["border-right-style"]
+        if "border-top-color" in cssAttr:
+            frag.borderTopColor = css_color(cssAttr["border-top-color"])
+        if "border-bottom-color" in cssAttr:
+            frag.borderBottomColor = css_color(cssAttr["border-bottom-color"])
+        if "border-left-color" in cssAttr:
+            frag.borderLeftColor = css_color(cssAttr["border-left-color"])
+        if "border-right-color" in cssAttr:
+            frag.borderRightColor = css_color(cssAttr["border-right-color"])
+    return margins
 
 
 def pisaPreLoop(node, context, collect=False):
@@ -419,259 +609,326 @@ def pisaPreLoop(node, context, collect=False):
     Collect all CSS definitions
     """
 
-    data = u""
-    if node.nodeType == Node.TEXT_NODE and collect:
-        data = node.data
+    data = []
+    nodes = [node]
+    while nodes:
+        node = nodes.pop()
+        if node.nodeType == Node.TEXT_NODE and collect:
+            data.append(node.data)
+
+        elif node.nodeType == Node.ELEMENT_NODE:
+            name = node.tagName.lower()
+
+            if context.cssDocumentNames is not None:
+                tags, classes, ids = context.cssDocumentNames
+                # Same tag name as in pisaLoop
+                tagName = node.tagName.replace(":", "").lower()
+                tags.add(tagName)
+                classes.update(node.getAttribute("class").split())
+                ids.add(node.getAttribute("id"))
+                if tagName == "pdftoc":
+                    # See PisaContext.add_toc
+                    classes.update("pdftoclevel%d" % i for i in range(20))
+
+            if name in ("style", "link"):
+                attr = pisaGetAttributes(context, name, node.attributes)
+                media = [x.strip() for x in attr.media.lower().split(",") if x.strip()]
+
+                if attr.get("type", "").lower() in ("", "text/css") and \
+                        (not media or "all" in media or "print" in media or "pdf" in media):
+
+                    if name == "style":
+                        context.add_css(u"".join(
+                            pisaPreLoop(child, context, collect=True) for child in node.childNodes))
+                        continue
+
+                    if name == "link" and attr.href and attr.rel.lower() == "stylesheet":
+                        # print "CSS LINK", attr
+                        context.add_css('\n@import "%s" %s;' % (attr.href, ",".join(media)))
+
+        # Children in document order
+        nodes.extend(reversed(node.childNodes))
 
-    elif node.nodeType == Node.ELEMENT_NODE:
-        name = node.tagName.lower()
+    return u"".join(data)
 
-        if name in ("style", "link"):
-            attr = pisaGetAttributes(context, name, node.attributes)
-            media = [x.strip() for x in attr.media.lower().split(",") if x.strip()]
 
-            if attr.get("type", "").lower() in ("", "text/css") and \
-                    (not media or "all" in media or "print" in media or "pdf" in media):
+# Page breaks after a block
+PAGE_BREAK = 1
+PAGE_BREAK_RIGHT = 2
+PAGE_BREAK_LEFT = 3
 
-                if name == "style":
-                    for node in node.childNodes:
-                        data += pisaPreLoop(node, context, collect=True)
-                    context.add_css(data)
-                    return u""
 
-                if name == "link" and attr.href and attr.rel.lower() == "stylesheet":
-                    # print "CSS LINK", attr
-                    context.add_css('\n@import "%s" %s;' % (attr.href, ",".join(media)))
+class _PisaElement(object):
+    # What pisaLoop needs to end an element once its children are rendered
 
-    for node in node.childNodes:
-        result = pisaPreLoop(node, context, collect=collect)
-        if collect:
-            data += result
+    __slots__ = ("node", "obj", "isBlock", "pageBreakAfter", "frameBreakAfter", "keepInFrame",
+                 "keepInFrameMaxWidth", "keepInFrameMaxHeight", "staticFrame", "oldStory",
+                 "fragBlock", "margins", "flushStory")
 
-    return data
 
+def pisaStartElement(node, context, margins):
+    """
+    Styles an element and starts its tag, returns the _PisaElement to end
+    it with or None if it is not rendered.
+    """
 
-def pisaLoop(node, context, path=None, **kw):
+    node.tagName = tagName = node.tagName.replace(":", "").lower()
 
-    if path is None:
-        path = []
+    if tagName in ("style", "script"):
+        return None
 
-    # Initialize KW
-    if not kw:
-        kw = {
-            "margin-top": 0,
-            "margin-bottom": 0,
-            "margin-left": 0,
-            "margin-right": 0,
-        }
-    else:
-        kw = copy.copy(kw)
-
-    #indent = len(path) * "  " # only used for debug print statements
-
-    # TEXT
-    if node.nodeType == Node.TEXT_NODE:
-        # print indent, "#", repr(node.data) #, context.frag
-        context.add_fragment(node.data)
-
-        # context.text.append(node.value)
-
-    # ELEMENT
-    elif node.nodeType == Node.ELEMENT_NODE:
-
-        node.tagName = node.tagName.replace(":", "").lower()
-
-        if node.tagName in ("style", "script"):
-            return
-
-        path = copy.copy(path) + [node.tagName]
-
-        # Prepare attributes
-        attr = pisaGetAttributes(context, node.tagName, node.attributes)
-        #log.debug(indent + "<%s %s>" % (node.tagName, attr) + repr(node.attributes.items())) #, path
-
-        # Calculate styles
-        context.cssAttr = CSSCollect(node, context)
-        context.cssAttr = mapNonStandardAttrs(context.cssAttr, node, attr)
-        context.node = node
-
-        # Block?
-        PAGE_BREAK = 1
-        PAGE_BREAK_RIGHT = 2
-        PAGE_BREAK_LEFT = 3
-
-        pageBreakAfter = False
-        frameBreakAfter = False
-        display = lower(context.cssAttr.get("display", "inline"))
-        # print indent, node.tagName, display, context.cssAttr.get("background-color", None), attr
-        isBlock = (display == "block")
-
-        if isBlock:
-            context.add_paragraph()
-
-            # Page break by CSS
-            if "-pdf-next-page" in context.cssAttr:
-                context.add_story(NextPageTemplate(str(context.cssAttr["-pdf-next-page"])))
-            if "-pdf-page-break" in context.cssAttr:
-                if str(context.cssAttr["-pdf-page-break"]).lower() == "before":
-                    context.add_story(PageBreak())
-            if "-pdf-frame-break" in context.cssAttr:
-                if str(context.cssAttr["-pdf-frame-break"]).lower() == "before":
-                    context.add_story(FrameBreak())
-                if str(context.cssAttr["-pdf-frame-break"]).lower() == "after":
-                    frameBreakAfter = True
-            if "page-break-before" in context.cssAttr:
-                if str(context.cssAttr["page-break-before"]).lower() == "always":
-                    context.add_story(PageBreak())
-                if str(context.cssAttr["page-break-before"]).lower() == "right":
-                    context.add_story(PageBreak())
-                    context.add_story(PmlRightPageBreak())
-                if str(context.cssAttr["page-break-before"]).lower() == "left":
-                    context.add_story(PageBreak())
-                    context.add_story(PmlLeftPageBreak())
-            if "page-break-after" in context.cssAttr:
-                if str(context.cssAttr["page-break-after"]).lower() == "always":
-                    pageBreakAfter = PAGE_BREAK
-                if str(context.cssAttr["page-break-after"]).lower() == "right":
-                    pageBreakAfter = PAGE_BREAK_RIGHT
-                if str(context.cssAttr["page-break-after"]).lower() == "left":
-                    pageBreakAfter = PAGE_BREAK_LEFT
-
-        if display == "none":
-            # print "none!"
-            return
-
-        # Translate CSS to frags
-
-        # Save previous frag styles
-        context.push_fragment()
-
-        # Map styles to Reportlab fragment properties
-        CSS2Frag(context, kw, isBlock)
-
-        # EXTRAS
-        if "-pdf-keep-with-next" in context.cssAttr:
-            context.frag.keepWithNext = str_to_bool(context.cssAttr["-pdf-keep-with-next"])
-        if "-pdf-outline" in context.cssAttr:
-            context.frag.outline = str_to_bool(context.cssAttr["-pdf-outline"])
-        if "-pdf-outline-level" in context.cssAttr:
-            context.frag.outlineLevel = int(context.cssAttr["-pdf-outline-level"])
-        if "-pdf-outline-open" in context.cssAttr:
-            context.frag.outlineOpen = str_to_bool(context.cssAttr["-pdf-outline-open"])
-        if "-pdf-word-wrap" in context.cssAttr:
-            context.frag.wordWrap = context.cssAttr["-pdf-word-wrap"]
-
-        # handle keep-in-frame
-        keepInFrameMode = None
-        keepInFrameMaxWidth = 0
-        keepInFrameMaxHeight = 0
-        if "-pdf-keep-in-frame-mode" in context.cssAttr:
-            value = str(context.cssAttr["-pdf-keep-in-frame-mode"]).strip().lower()
-            if value in ("shrink", "error", "overflow", "truncate"):
-                keepInFrameMode = value
-        if "-pdf-keep-in-frame-max-width" in context.cssAttr:
-            keepInFrameMaxWidth = get_size("".join(context.cssAttr["-pdf-keep-in-frame-max-width"]))
-        if "-pdf-keep-in-frame-max-height" in context.cssAttr:
-            keepInFrameMaxHeight = get_size("".join(context.cssAttr["-pdf-keep-in-frame-max-height"]))
-
-        # ignore nested keep-in-frames, tables have their own KIF handling
-        keepInFrame = keepInFrameMode is not None and context.keepInFrameIndex is None
-        if keepInFrame:
-            # keep track of current story index, so we can wrap everythink
-            # added after this point in a KeepInFrame
-            context.keepInFrameIndex = len(context.story)
-
-        # BEGIN tag
-        klass = globals().get("pisaTag%s" % node.tagName.replace(":", "").upper(), None)
-        obj = None
-
-        # Static block
-        elementId = attr.get("id", None)
-        staticFrame = context.frameStatic.get(elementId, None)
-        if staticFrame:
-            context.frag.insideStaticFrame += 1
-            oldStory = context.swap_story()
-
-        # Tag specific operations
-        if klass is not None:
-            obj = klass(node, attr)
-            obj.start(context)
-
-        # Visit child nodes
-        context.fragBlock = fragBlock = copy.copy(context.frag)
-        for nnode in node.childNodes:
-            pisaLoop(nnode, context, path, **kw)
-        context.fragBlock = fragBlock
-
-        # END tag
-        if obj:
-            obj.end(context)
-
-        # Block?
-        if isBlock:
-            context.add_paragraph()
-
-            # XXX Buggy!
-
-            # Page break by CSS
-            if pageBreakAfter:
+    # Prepare attributes
+    attr = pisaGetAttributes(context, tagName, node.attributes)
+
+    # Calculate styles
+    context.cssAttr = cssAttr = mapNonStandardAttrs(CSSCollect(node, context), node, attr)
+    context.node = node
+
+    # Block?
+    pageBreakAfter = False
+    frameBreakAfter = False
+    display = css_keyword(cssAttr.get("display", "inline"))
+    isBlock = (display == "block")
+
+    if isBlock:
+        context.add_paragraph()
+
+        # Page break by CSS
+        if "-pdf-next-page" in cssAttr:
+            context.add_story(NextPageTemplate(str(cssAttr["-pdf-next-page"])))
+        if "-pdf-page-break" in cssAttr:
+            if css_keyword(cssAttr["-pdf-page-break"], str_lower) == "before":
                 context.add_story(PageBreak())
-                if pageBreakAfter == PAGE_BREAK_RIGHT:
-                    context.add_story(PmlRightPageBreak())
-                if pageBreakAfter == PAGE_BREAK_LEFT:
-                    context.add_story(PmlLeftPageBreak())
-            if frameBreakAfter:
+        if "-pdf-frame-break" in cssAttr:
+            if css_keyword(cssAttr["-pdf-frame-break"], str_lower) == "before":
                 context.add_story(FrameBreak())
+            if css_keyword(cssAttr["-pdf-frame-break"], str_lower) == "after":
+                frameBreakAfter = True
+        if "page-break-before" in cssAttr:
+            if css_keyword(cssAttr["page-break-before"], str_lower) == "always":
+                context.add_story(PageBreak())
+            if css_keyword(cssAttr["page-break-before"], str_lower) == "right":
+                context.add_story(PageBreak())
+                context.add_story(PmlRightPageBreak())
+            if css_keyword(cssAttr["page-break-before"], str_lower) == "left":
+                context.add_story(PageBreak())
+                context.add_story(PmlLeftPageBreak())
+        if "page-break-after" in cssAttr:
+            if css_keyword(cssAttr["page-break-after"], str_lower) == "always":
+                pageBreakAfter = PAGE_BREAK
+            if css_keyword(cssAttr["page-break-after"], str_lower) == "right":
+                pageBreakAfter = PAGE_BREAK_RIGHT
+            if css_keyword(cssAttr["page-break-after"], str_lower) == "left":
+                pageBreakAfter = PAGE_BREAK_LEFT
+
+    if display == "none":
+        return None
+
+    # Translate CSS to frags
+
+    # Save previous frag styles
+    context.push_fragment()
+
+    # Map styles to Reportlab fragment properties
+    margins = CSS2Frag(context, margins, isBlock)
+
+    # EXTRAS
+    if "-pdf-keep-with-next" in cssAttr:
+        context.frag.keepWithNext = str_to_bool(cssAttr["-pdf-keep-with-next"])
+    if "-pdf-outline" in cssAttr:
+        context.frag.outline = str_to_bool(cssAttr["-pdf-outline"])
+    if "-pdf-outline-level" in cssAttr:
+        context.frag.outlineLevel = int(cssAttr["-pdf-outline-level"])
+    if "-pdf-outline-open" in cssAttr:
+        context.frag.outlineOpen = str_to_bool(cssAttr["-pdf-outline-open"])
+    if "-pdf-word-wrap" in cssAttr:
+        context.frag.wordWrap = cssAttr["-pdf-word-wrap"]
+
+    # handle keep-in-frame
+    keepInFrameMode = None
+    keepInFrameMaxWidth = 0
+    keepInFrameMaxHeight = 0
+    if "-pdf-keep-in-frame-mode" in cssAttr:
+        value = str(cssAttr["-pdf-keep-in-frame-mode"]).strip().lower()
+        if value in ("shrink", "error", "overflow", "truncate"):
+            keepInFrameMode = value
+    if "-pdf-keep-in-frame-max-width" in cssAttr:
+        keepInFrameMaxWidth = get_size("".join(cssAttr["-pdf-keep-in-frame-max-width"]))
+    if "-pdf-keep-in-frame-max-height" in cssAttr:
+        keepInFrameMaxHeight = get_size("".join(cssAttr["-pdf-keep-in-frame-max-height"]))
+
+    # ignore nested keep-in-frames, tables have their own KIF handling
+    keepInFrame = keepInFrameMode is not None and context.keepInFrameIndex is None
+    if keepInFrame:
+        # keep track of current story index, so we can wrap everythink
+        # added after this point in a KeepInFrame
+        context.keepInFrameIndex = len(context.story)
+
+    # BEGIN tag
+    klass = TAG_HANDLERS.get(tagName)
+    obj = None
+
+    # Static block
+    elementId = attr.get("id", None)
+    staticFrame = context.frameStatic.get(elementId, None)
+    oldStory = None
+    if staticFrame:
+        context.frag.insideStaticFrame += 1
+        oldStory = context.swap_story()
+
+    # Tag specific operations
+    if klass is not None:
+        obj = klass(node, attr)
+        obj.start(context)
+
+    element = _PisaElement()
+    element.node = node
+    element.obj = obj
+    element.isBlock = isBlock
+    element.pageBreakAfter = pageBreakAfter
+    element.frameBreakAfter = frameBreakAfter
+    element.keepInFrame = keepInFrame
+    element.keepInFrameMaxWidth = keepInFrameMaxWidth
+    element.keepInFrameMaxHeight = keepInFrameMaxHeight
+    element.staticFrame = staticFrame
+    element.oldStory = oldStory
+    element.margins = margins
+    element.flushStory = tagName == "body" and context.storySink is not None
+
+    # Before the child nodes
+    context.fragBlock = element.fragBlock = copy.copy(context.frag)
+    context.cssAncestorFilter.push(cssDOMElementInterface.getElementInterface(node))
+    return element
+
+
+def pisaEndElement(element, context):
+    """
+    Ends an element started by pisaStartElement after its child nodes.
+    """
 
-        if keepInFrame:
-            # get all content added after start of -pdf-keep-in-frame and wrap
-            # it in a KeepInFrame
-            substory = context.story[context.keepInFrameIndex:]
-            context.story = context.story[:context.keepInFrameIndex]
-            context.story.append(
-                KeepInFrame(
-                    content=substory,
-                    maxWidth=keepInFrameMaxWidth,
-                    maxHeight=keepInFrameMaxHeight))
-            context.keepInFrameIndex = None
-
-        # Static block, END
-        if staticFrame:
-            context.add_paragraph()
-            for frame in staticFrame:
-                frame.pisaStaticStory = context.story
-            context.swap_story(oldStory)
-            context.frag.insideStaticFrame -= 1
-
-        # context.debug(1, indent, "</%s>" % (node.tagName))
-
-        # Reset frag style
-        context.pull_fragment()
-
-    # Unknown or not handled
-    else:
-        # context.debug(1, indent, "???", node, node.nodeType, repr(node))
-        # Loop over children
-        for node in node.childNodes:
-            pisaLoop(node, context, path, **kw)
+    context.cssAncestorFilter.pop()
+    context.fragBlock = element.fragBlock
+
+    # END tag
+    if element.obj:
+        element.obj.end(context)
+
+    # Block?
+    if element.isBlock:
+        context.add_paragraph()
+
+        # XXX Buggy!
+
+        # Page break by CSS
+        pageBreakAfter = element.pageBreakAfter
+        if pageBreakAfter:
+            context.add_story(PageBreak())
+            if pageBreakAfter == PAGE_BREAK_RIGHT:
+                context.add_story(PmlRightPageBreak())
+            if pageBreakAfter == PAGE_BREAK_LEFT:
+                context.add_story(PmlLeftPageBreak())
+        if element.frameBreakAfter:
+            context.add_story(FrameBreak())
+
+    if element.keepInFrame:
+        # get all content added after start of -pdf-keep-in-frame and wrap
+        # it in a KeepInFrame
+        substory = context.story[context.keepInFrameIndex:]
+        context.story = context.story[:context.keepInFrameIndex]
+        context.story.append(
+            KeepInFrame(
+                content=substory,
+                maxWidth=element.keepInFrameMaxWidth,
+                maxHeight=element.keepInFrameMaxHeight))
+        context.keepInFrameIndex = None
+
+    # Static block, END
+    if element.staticFrame:
+        context.add_paragraph()
+        for frame in element.staticFrame:
+            frame.pisaStaticStory = context.story
+        context.swap_story(element.oldStory)
+        context.frag.insideStaticFrame -= 1
+
+    # Reset frag style
+    context.pull_fragment()
+
+
+def pisaLoop(node, context):
+    """
+    Renders node and all nodes below it. The tree is walked with a stack
+    instead of recursion, so there is no limit to the nesting depth: for
+    every element that is entered the stack keeps the iterator over the
+    remaining siblings, the margins and the _PisaElement to end it with.
+    """
 
+    TEXT_NODE = Node.TEXT_NODE
+    ELEMENT_NODE = Node.ELEMENT_NODE
+
+    stack = []
+    # (margin-left, margin-right), each element gets a new tuple
+    margins = (0, 0)
+    element = None
+    nodes = iter((node,))
+    while True:
+        for node in nodes:
+            nodeType = node.nodeType
+
+            # TEXT
+            if nodeType == TEXT_NODE:
+                context.add_fragment(node.data)
+                if element is not None and element.flushStory:
+                    context.flush_story()
+
+            # ELEMENT
+            elif nodeType == ELEMENT_NODE:
+                child = pisaStartElement(node, context, margins)
+                if child is not None:
+                    stack.append((nodes, margins, element))
+                    nodes, margins, element = iter(node.childNodes), child.margins, child
+                    break
+                if element is not None and element.flushStory:
+                    context.flush_story()
+
+            # Unknown or not handled, loop over children
+            else:
+                stack.append((nodes, margins, element))
+                nodes = iter(node.childNodes)
+                break
 
-def pisaParser(src, context, default_css="", xhtml=False, encoding=None, xml_output=None):
+        else:
+            # All children are done
+            if not stack:
+                return
+            child = element
+            nodes, margins, element = stack.pop()
+            if child is not None and child is not element:
+                pisaEndElement(child, context)
+                if element is not None and element.flushStory:
+                    context.flush_story()
+
+
+# The tag handlers of pisaLoop by tag name: pisaTagPDFNEXTPAGE handles <pdf:nextpage>
+TAG_HANDLERS = dict(
+    (name[len("pisaTag"):].lower(), klass)
+    for name, klass in list(globals().items())
+    if name.startswith("pisaTag") and name != "pisaTag")
+
+
+def pisaParser(src, context, default_css="", xhtml=False, encoding=None, xml_output=None, parser=None,
+               stream=False):
     """
     - Parse HTML and get miniDOM
     - Extract CSS informations, add default CSS, parse CSS
     - Handle the document DOM itself and build reportlab story
     - Return Context object
-    """
-
-    global CSSAttrCache
-    CSSAttrCache = {}
 
-    if xhtml:
-        #TODO: XHTMLParser doesn't see to exist...
-        parser = html5lib.XHTMLParser(tree=treebuilders.getTreeBuilder("dom"))
-    else:
-        parser = html5lib.HTMLParser(tree=treebuilders.getTreeBuilder("dom"))
+    `src` may also be a parsed document, see xhtml2pdf.dom.parse_tree.
+    `parser` is the name of the HTML parser to use, see xhtml2pdf.dom.
+    With `stream` the document is parsed while it is rendered: XHTML with
+    expat, see xhtml2pdf.dom.XHTMLStream, HTML with html5lib, see
+    xhtml2pdf.dom.HTMLStream.
+    """
 
     if isinstance(src, text_type):
         # If an encoding was provided, do not change it.
@@ -680,40 +937,50 @@ def pisaParser(src, context, default_css="", xhtml=False, encoding=None, xml_out
         src = src.encode(encoding)
         src = PisaTempFile(src, capacity=context.capacity)
 
-    # Test for the restrictions of html5lib
-    if encoding:
-        # Workaround for html5lib<0.11.1
-        if hasattr(inputstream, "isValidEncoding"):
-            if encoding.strip().lower() == "utf8":
-                encoding = "utf-8"
-            if not inputstream.isValidEncoding(encoding):
-                log.error("%r is not a valid encoding e.g. 'utf8' is not valid but 'utf-8' is!", encoding)
-        else:
-            if inputstream.codecName(encoding) is None:
-                log.error("%r is not a valid encoding", encoding)
-    document = parser.parse(
-        src,
-        encoding=encoding)
-
-    if xml_output:
-        if encoding:
-            xml_output.write(document.toprettyxml(encoding=encoding))
+    body_stream = None
+    if xml_output or dom.is_tree(src):
+        pass
+    elif stream and xhtml and parser in (None, "expat"):
+        body_stream = dom.XHTMLStream(src, encoding)
+    elif stream and not xhtml and parser in (None, "html5lib"):
+        body_stream = dom.HTMLStream(src, encoding)
+
+    try:
+        if body_stream is not None:
+            document = body_stream.parse_head()
         else:
-            xml_output.write(document.toprettyxml(encoding="utf8"))
+            document = dom.parse(src, encoding=encoding, xhtml=xhtml, parser=parser)
 
+        if xml_output:
+            if encoding:
+                xml_output.write(document.toprettyxml(encoding=encoding))
+            else:
+                xml_output.write(document.toprettyxml(encoding="utf8"))
 
-    if default_css:
-        context.add_default_css(default_css)
 
-    pisaPreLoop(document, context)
-    #try:
-    context.parse_css()
-    #except:
-    #    context.cssText = DEFAULT_CSS
-    #    context.parseCSS()
-    # context.debug(9, pprint.pformat(context.css))
+        if default_css:
+            context.add_default_css(default_css)
 
-    pisaLoop(document, context)
+        cssDOMElementInterface.indexElements(document)
+        if body_stream is not None and body_stream.streaming:
+            # The names used in the body are not known yet
+            context.cssDocumentNames = None
+        else:
+            context.cssDocumentNames = (set(), set(), set())
+        pisaPreLoop(document, context)
+        #try:
+        context.parse_css()
+        #except:
+        #    context.cssText = DEFAULT_CSS
+        #    context.parseCSS()
+        # context.debug(9, pprint.pformat(context.css))
+
+        if body_stream is not None:
+            body_stream.stream_body()
+        pisaLoop(document, context)
+    finally:
+        if body_stream is not None:
+            body_stream.close()
     return context
 
 
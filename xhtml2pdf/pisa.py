@@ -20,6 +20,7 @@ import os
 import sys
 import tempfile
 
+from xhtml2pdf.context import stylesheet_snapshots
 from xhtml2pdf.default import DEFAULT_CSS
 from xhtml2pdf.document import pisa_document
 from xhtml2pdf.util import get_file
@@ -65,6 +66,10 @@ DEST
     Path to default CSS file
   --css-dump:
     Dumps the default CSS definitions to STDOUT
+  --cache-dir:
+    Directory to keep parsed stylesheets in, so that later runs
+    do not parse them again. It must belong to the current user
+    and only be writeable by them, it is created if it is missing
   --debug, -d:
     Show debugging informations
   --encoding:
@@ -82,10 +87,17 @@ DEST
   --warn, -w:
     Show warnings
   --xml, --xhtml, -x:
-    Force parsing in XML Mode
-    (automatically used if file ends with ".xml")
+    Force parsing in XML Mode, the document is parsed with expat
+    while it is rendered (automatically used if file ends with ".xml")
   --html:
     Force parsing in HTML Mode (default)
+  --parser:
+    The parser for SRC: "html5lib" (default), "lxml" (needs lxml
+    to be installed) or "expat" (well-formed XHTML only)
+  --stream:
+    Lay out the PDF while SRC is parsed, so large documents are not
+    kept in memory as a whole. Tables of contents and page counts
+    stay empty
 """).strip()
 
 COPYRIGHT = VERSION_STR
@@ -169,6 +181,7 @@ def execute():
             "tempdir=",
             "format=",
             "css=",
+            "cache-dir=",
             "base=",
             "css-dump",
             "xml-dump",
@@ -176,6 +189,8 @@ def execute():
             "xml",
             "html",
             "encoding=",
+            "parser=",
+            "stream",
             "system",
             "profile",
         ])
@@ -194,6 +209,9 @@ def execute():
     encoding = None
     xml_output = None
     base_dir = None
+    parser = None
+    stream = False
+    cache_dir = None
 
     log_level = logging.ERROR
     log_format = LOG_FORMAT
@@ -257,6 +275,9 @@ def execute():
             # CSS
             css = open(a, "r").read()
 
+        if o in ("--cache-dir",):
+            cache_dir = a
+
         if o in ("--css-dump",):
             # CSS dump
             print (DEFAULT_CSS)
@@ -265,6 +286,12 @@ def execute():
         if o in ("--xml-dump",):
             xml_output = sys.stdout
 
+        if o in ("--parser",):
+            parser = a
+
+        if o in ("--stream",):
+            stream = True
+
         if o in ("-x", "--xml", "--xhtml"):
             xhtml = True
         elif o in ("--html",):
@@ -283,6 +310,11 @@ def execute():
         usage()
         sys.exit(2)
 
+    if cache_dir:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0o700)
+        stylesheet_snapshots.directory = cache_dir
+
     if len(args) == 2:
         a_src, a_dest = args
     else:
@@ -369,6 +401,8 @@ def execute():
             xhtml=xhtml,
             encoding=encoding,
             xml_output=xml_output,
+            parser=parser,
+            stream=stream,
         )
 
         if xml_output:
@@ -501,7 +501,9 @@ def _getFragWords(frags):
         if text != '':
             if hangingStrip:
                 hangingStrip = False
-                text = text.lstrip()
+                # Preformatted lines keep their leading spaces
+                if getattr(f, 'whiteSpace', None) != 'pre':
+                    text = text.lstrip()
 
             S = split(text)
             if S == []:
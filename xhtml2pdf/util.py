@@ -22,12 +22,15 @@ import reportlab
 import shutil
 import sys
 import tempfile
+import threading
 import gzip
+import itertools
 
+from collections import OrderedDict
 from functools import wraps
 from io import UnsupportedOperation
 
-from six import binary_type, StringIO
+from six import binary_type, string_types, text_type, StringIO
 
 from reportlab.lib.colors import Color, toColor
 from reportlab.lib.enums import TA_LEFT, TA_CENTER, TA_RIGHT, TA_JUSTIFY
@@ -108,6 +111,7 @@ class Memoized(object):
     def __init__(self, func):
         self.cache = {}
         self.func = func
+        self.lock = threading.Lock()
 
     def __call__(self, *args, **kwargs):
         # Make sure the following line is not actually slower than what you're
@@ -118,13 +122,66 @@ class Memoized(object):
             args_plus = tuple(iter(kwargs.items()))
         key = (args, args_plus)
         try:
-            if key not in self.cache:
-                res = self.func(*args, **kwargs)
-                self.cache[key] = res
-            return self.cache[key]
+            with self.lock:
+                if key in self.cache:
+                    return self.cache[key]
         except TypeError:
             # happens if any of the parameters is a list
             return self.func(*args, **kwargs)
+        # The function runs outside of the lock, if two threads compute the
+        # same value the first one wins
+        res = self.func(*args, **kwargs)
+        with self.lock:
+            return self.cache.setdefault(key, res)
+
+
+class LRUCache(object):
+    """
+    A size-bounded mapping that discards the least recently used entries
+    first. It is safe to use from several threads at once and keeps hit and
+    miss counters, so callers can check how well the cache works for them.
+
+    Values are shared by everybody who looks them up, so only put objects
+    into it that are not modified afterwards.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # Re-insert to mark the entry as the most recently used one
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
 
 
 def format_error_message():
@@ -141,7 +198,7 @@ def format_error_message():
 
 
 def to_list(value):
-    if type(value) not in (list, tuple):
+    if not isinstance(value, (list, tuple)):
         return [value]
     return list(value)
 
@@ -237,7 +294,7 @@ def get_size(value, relative=0, base=None, default=0.0):
             return value
         elif isinstance(value, int):
             return float(value)
-        elif type(value) in (tuple, list):
+        elif isinstance(value, (tuple, list)):
             value = "".join(value)
         value = str(value).strip().lower().replace(",", ".")
         if value[-2:] == 'cm':
@@ -293,6 +350,156 @@ def get_size(value, relative=0, base=None, default=0.0):
         return default
 
 
+class CSSValue(object):
+    """
+    Mixin for CSS values that are converted once, when the stylesheet is
+    built, instead of every time an element uses them (see
+    compile_css_value). The values still compare equal to and behave like
+    the term the CSS parser returned.
+
+    Depending on the property they carry:
+
+    - `color`: the Color, or None for "transparent" and "none"
+    - `keyword`: the lower case keyword
+    - `points`: an absolute length in points, relative lengths keep their
+      `number` and `unit` ("em", "ex", "%", "normal", "scale" or "number")
+    - `text`: the joined text of a length like ("50", "%")
+    """
+
+    color = None
+    keyword = None
+    points = None
+    number = None
+    unit = None
+    text = None
+
+    def get_size(self, relative=0, base=None):
+        """
+        Same as get_size(value, relative, base), but only relative lengths
+        need any work.
+        """
+        if self.points is not None:
+            return self.points
+        unit = self.unit
+        if not relative or unit is None:
+            return get_size(self, relative, base)
+        if unit == "em":
+            return self.number * relative
+        if unit == "ex":
+            return self.number * (relative / 2.0)
+        if unit == "%":
+            return (relative * self.number) / 100.0
+        if unit == "normal":
+            return relative
+        if unit == "scale":
+            return max(MIN_FONT_SIZE, (base or relative) * self.number)
+        return max(MIN_FONT_SIZE, relative * self.number)
+
+
+class CSSText(CSSValue, text_type):
+    pass
+
+
+class CSSBytes(CSSValue, binary_type):
+    # The byte strings of Python 2
+    pass
+
+
+class CSSTuple(CSSValue, tuple):
+    pass
+
+
+_css_color_properties = frozenset("""
+    color background-color
+    border-top-color border-bottom-color border-left-color border-right-color
+    """.split())
+
+_css_size_properties = frozenset("""
+    font-size line-height -pdf-line-spacing text-indent
+    margin-top margin-bottom margin-left margin-right
+    padding-top padding-bottom padding-left padding-right
+    border-top-width border-bottom-width border-left-width border-right-width
+    """.split())
+
+_css_keyword_properties = frozenset("""
+    display font-weight font-style white-space text-align list-style-type
+    page-break-before page-break-after -pdf-page-break -pdf-frame-break
+    """.split())
+
+_css_text_properties = frozenset("""
+    width height zoom
+    """.split())
+
+_absolute_units = ("cm", "mm", "in", "pt", "pc", "px")
+
+
+def _compile_size(result, text):
+    value = text.strip().lower().replace(",", ".")
+    if value[-2:] in _absolute_units or value[-1:] == "i" or value in ("none", "0", "auto"):
+        result.points = get_size(text)
+    elif value[-2:] in ("em", "ex"):
+        result.number, result.unit = float(value[:-2].strip()), value[-2:]
+    elif value[-1:] == "%":
+        result.number, result.unit = float(value[:-1].strip()), "%"
+    elif value in ("normal", "inherit"):
+        result.unit = "normal"
+    elif value in _relative_size_table:
+        result.number, result.unit = _relative_size_table[value], "scale"
+    elif value in _absolute_size_table:
+        result.number, result.unit = _absolute_size_table[value], "scale"
+    else:
+        result.number, result.unit = float(value), "number"
+
+
+def compile_css_value(name, value):
+    """
+    Converts the value of a CSS property into a CSSValue. Values of other
+    properties and values that can not be converted are returned as they
+    are.
+    """
+    if isinstance(value, CSSValue):
+        return value
+    if isinstance(value, text_type):
+        result = CSSText(value)
+    elif isinstance(value, string_types):
+        result = CSSBytes(value)
+    elif type(value) is tuple and all(isinstance(x, string_types) for x in value):
+        result = CSSTuple(value)
+    else:
+        return value
+    text = "".join(to_list(value))
+    try:
+        if name in _css_color_properties:
+            if result.__class__ is CSSTuple:
+                return value
+            result.color = get_color(value)
+        elif name in _css_size_properties:
+            _compile_size(result, text)
+        elif name in _css_keyword_properties:
+            if result.__class__ is CSSTuple:
+                return value
+            result.keyword = value.lower()
+        elif name in _css_text_properties:
+            result.text = text
+        else:
+            return value
+    except ValueError:
+        return value
+    return result
+
+
+def compile_css_declarations(declarations):
+    """
+    Replaces the values of a dict of CSS declarations by their compiled
+    versions, see compile_css_value.
+    """
+    for name, value in list(declarations.items()):
+        compiled = compile_css_value(name, value)
+        if compiled is not value:
+            declarations[name] = compiled
+    return declarations
+
+
 @memoized
 def get_coordinates(x, y, w, h, pagesize):
     """
@@ -384,14 +591,12 @@ def str_to_bool(s):
     return str(s).lower() in ("y", "yes", "1", "true")
 
 
-_uid = 0
+_uid = itertools.count(1)
 
 
 def get_uid():
     """Unique ID"""
-    global _uid
-    _uid += 1
-    return str(_uid)
+    return str(next(_uid))
 
 
 _alignments = {
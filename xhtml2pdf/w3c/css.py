@@ -88,6 +88,10 @@ class CSSElementInterfaceAbstract(object):
         return self.getAttr('class', '')
 
 
+    def getClassNames(self):
+        return self.getClassAttr().split()
+
+
     def getInlineStyle(self):
         raise NotImplementedError('Subclass responsibility')
 
@@ -108,6 +112,82 @@ class CSSElementInterfaceAbstract(object):
     def getPreviousSibling(self):
         raise NotImplementedError('Subclass responsibility')
 
+
+    def getTagName(self):
+        raise NotImplementedError('Subclass responsibility')
+
+
+    def getAncestorFilter(self):
+        """Returns a CSSAncestorFilter holding the ancestors of the element,
+        or None if the ancestors have to be found with iterXMLParents"""
+        return None
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class CSSAncestorFilter(object):
+    """Counts the classes and ids of the ancestors of the elements being
+    styled. A tree walk pushes every element before visiting its children
+    and pops it afterwards.
+
+    The descendant combinator tests the qualifiers of its ancestor selector
+    against each ancestor, so for selectors like ".report td" the counts
+    tell whether any ancestor matches without walking up the tree.
+    """
+
+    def __init__(self):
+        self.elements = []
+        self.classes = {}
+        self.ids = {}
+
+
+    def push(self, element):
+        classes = element.getClassNames()
+        hashId = element.getIdAttr()
+        for className in classes:
+            self.classes[className] = self.classes.get(className, 0) + 1
+        self.ids[hashId] = self.ids.get(hashId, 0) + 1
+        self.elements.append((element, classes, hashId))
+
+
+    def pop(self):
+        element, classes, hashId = self.elements.pop()
+        for className in classes:
+            self._discard(self.classes, className)
+        self._discard(self.ids, hashId)
+        return element
+
+
+    def _discard(self, counts, key):
+        count = counts[key] - 1
+        if count:
+            counts[key] = count
+        else:
+            del counts[key]
+
+
+    def getParent(self):
+        if self.elements:
+            return self.elements[-1][0]
+        return None
+
+
+    def matchesAny(self, qualifiers):
+        """Returns whether any ancestor matches any of qualifiers, or None if
+        that can only be found out by walking up the tree."""
+        unknown = False
+        for qualifier in qualifiers:
+            if qualifier.isClass():
+                if qualifier.classId in self.classes:
+                    return True
+            elif qualifier.isHash():
+                if qualifier.hashId in self.ids:
+                    return True
+            else:
+                unknown = True
+        if unknown:
+            return None
+        return False
+
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 class CSSCascadeStrategy(object):
@@ -156,6 +236,21 @@ class CSSCascadeStrategy(object):
             yield self.user[1]
 
 
+    def getStyleDependencies(self):
+        """Returns (attrNames, pseudoClasses, adjacentSiblings) for all
+        rulesets, see CSSRuleIndex. Two elements with equal tag name, id,
+        class and ancestors that also agree on these get the same style.
+        """
+        attrNames = set()
+        pseudoClasses = adjacentSiblings = False
+        for ruleset in self.iterCSSRulesets():
+            index = ruleset.getIndex()
+            attrNames.update(index.attrNames)
+            pseudoClasses = pseudoClasses or index.pseudoClasses
+            adjacentSiblings = adjacentSiblings or index.adjacentSiblings
+        return tuple(sorted(attrNames)), pseudoClasses, adjacentSiblings
+
+
     #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def findStyleFor(self, element, attrName, default=NotImplemented):
@@ -179,12 +274,28 @@ class CSSCascadeStrategy(object):
         implement these semantics.
         """
         rules = self.findCSSRulesForEach(element, attrNames)
-        if sys.version[0] == '2':
-            iteritems = rules.iteritems()
-        else:
-            iteritems = iter(rules.items())
         return [(attrName, self._extractStyleForRule(rule, attrName, default))
-                for attrName, rule in iteritems]
+                for attrName, rule in rules.items()]
+
+
+    def findStylesForElement(self, element, attrNames=None):
+        """Finds the style settings of all properties of element in one
+        pass, matching every selector against it only once. Returns a dict
+        of property names and values, properties without a rule are left
+        out. If attrNames is given only these properties are looked up.
+
+        The same notes as for findStyleFor apply.
+        """
+        winners = {}
+        for ruleset in self.iterCSSRulesets(element.getInlineStyle()):
+            # A later ruleset wins with at least the same specificity
+            for attrName, (specificity, order, value) in ruleset.findMatchingStyles(element).items():
+                if attrNames is not None and attrName not in attrNames:
+                    continue
+                current = winners.get(attrName)
+                if current is None or current[0] <= specificity:
+                    winners[attrName] = (specificity, value)
+        return dict((attrName, value) for attrName, (specificity, value) in winners.items())
 
 
     def findCSSRulesFor(self, element, attrName):
@@ -214,7 +325,9 @@ class CSSCascadeStrategy(object):
         if self.user is not None:
             rules += self.user[1].findCSSRuleFor(element, attrName)
 
-        rules.sort()
+        # The sort is stable, so for the same specificity the later
+        # ruleset wins
+        rules.sort(key=_selectorSpecificity)
         return rules
 
 
@@ -223,15 +336,15 @@ class CSSCascadeStrategy(object):
 
         inline = element.getInlineStyle()
         for ruleset in self.iterCSSRulesets(inline):
-            if sys.version[0] == '2':
-                iteritems = rules.iteritems()
-            else:
-                iteritems = iter(rules.items())    
-            for attrName, attrRules in iteritems:
-                attrRules += ruleset.findCSSRuleFor(element, attrName)
-
-        for attrRules in rules.itervalues():
-            attrRules.sort()
+            matchingRules = ruleset.findMatchingRules(element)
+            for attrName, attrRules in rules.items():
+                for specificity, order, nodeFilter, declarations in reversed(matchingRules):
+                    if attrName in declarations:
+                        attrRules.append((nodeFilter, declarations))
+                        break
+
+        for attrRules in rules.values():
+            attrRules.sort(key=_selectorSpecificity)
         return rules
 
 
@@ -310,6 +423,18 @@ class CSSSelectorBase(object):
         return self.asString()
 
 
+    # A selector is only equal to itself, as on Python 3 which does not use
+    # __cmp__. Otherwise Python 2 would merge the rules of equal selectors
+    # into one key of a CSSRuleset, at the position of the first of them.
+
+    def __eq__(self, other):
+        return self is other
+
+
+    def __ne__(self, other):
+        return self is not other
+
+
     def __cmp__(self, other):
         result = cmp(self.specificity(), other.specificity())
         if result != 0:
@@ -384,6 +509,7 @@ class CSSSelectorBase(object):
 
 class CSSInlineSelector(CSSSelectorBase):
     inline = True
+    qualifiers = ()
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -449,6 +575,13 @@ class CSSImmutableSelector(CSSSelectorBase):
         self._updateHash()
 
 
+    def __setstate__(self, state):
+        # String hashes differ between processes, so the hash of a pickled
+        # selector is computed again
+        self.__dict__.update(state)
+        self._updateHash()
+
+
     def fromSelector(klass, selector):
         return klass(selector.completeName, selector.qualifiers)
 
@@ -529,11 +662,7 @@ class CSSSelectorClassQualifier(CSSSelectorQualifierBase):
 
 
     def matches(self, element):
-        #return self.classId in element.getClassAttr().split()
-        attrValue = element.domElement.attributes.get('class')
-        if attrValue is not None:
-            return self.classId in attrValue.value.split()
-        return False
+        return self.classId in element.getClassNames()
 
 
 class CSSSelectorAttributeQualifier(CSSSelectorQualifierBase):
@@ -633,6 +762,11 @@ class CSSSelectorCombinationQualifier(CSSSelectorQualifierBase):
         if self.op == ' ':
             if element is not None:
                 if element.matchesNode(self.selector.fullName):
+                    ancestors = element.getAncestorFilter()
+                    if ancestors is not None:
+                        result = ancestors.matchesAny(self.selector.qualifiers)
+                        if result is not None:
+                            return result
                     try:
                         for parent in element.iterXMLParents():
                             [None for qualifier in self.selector.qualifiers if
@@ -679,16 +813,249 @@ class CSSDeclarations(dict):
     pass
 
 
+def _ruleSortKey(rule):
+    return rule[0], rule[1]
+
+
+def _orderedItems(rules):
+    # The (key, value) pairs of a mapping or sequence of pairs, CSSRulesets
+    # in the order their rules were added
+    if isinstance(rules, CSSRuleset):
+        return rules.orderedItems()
+    if hasattr(rules, 'keys'):
+        return list(rules.items())
+    return rules
+
+
+def _selectorSpecificity(rule):
+    return rule[0].specificity()
+
+
+def _selectorMayMatch(selector, tags, classes, ids):
+    if selector.name != '*' and selector.name not in tags:
+        return False
+    for qualifier in selector.qualifiers:
+        if qualifier.isHash():
+            if qualifier.hashId not in ids:
+                return False
+        elif qualifier.isClass():
+            if qualifier.classId not in classes:
+                return False
+    return True
+
+
+class CSSRuleIndex(object):
+    """Buckets the rules of a CSSRuleset by the rightmost id, class or tag
+    name of their selectors, so a lookup only has to test the rules that
+    can possibly match an element.
+
+    Rules are stored as (specificity, order, selector, declarations), where
+    order is the position of the rule in the ruleset.
+
+    Rules whose selector is nothing but a tag name (or '*') match every
+    element with that tag name. Their declarations are combined once per
+    tag name (see getTagStyle), the other rules of the tags and universal
+    buckets are also kept in qualifiedTags and qualifiedUniversal.
+
+    The index also records what else the selectors look at: the names of
+    tested attributes, whether pseudo classes (which all depend on the
+    siblings of an element) and whether the adjacent sibling combinator
+    are used.
+    """
+
+    def __init__(self, ruleset):
+        self.ids = {}
+        self.classes = {}
+        self.tags = {}
+        self.universal = []
+        self.qualifiedTags = {}
+        self.qualifiedUniversal = []
+        self.plainTags = {}
+        self.plainUniversal = []
+        self.tagStyles = {}
+        self.attrNames = set()
+        self.pseudoClasses = False
+        self.adjacentSiblings = False
+        for order, (selector, declarations) in enumerate(ruleset.orderedItems()):
+            rule = (selector.specificity(), order, selector, declarations)
+            kind, key = self.getSelectorKey(selector)
+            if kind is None:
+                self.universal.append(rule)
+            else:
+                getattr(self, kind).setdefault(key, []).append(rule)
+            if kind in (None, 'tags'):
+                if self.isPlainSelector(selector):
+                    prefix = 'plain'
+                else:
+                    prefix = 'qualified'
+                if kind is None:
+                    getattr(self, prefix + 'Universal').append(rule)
+                else:
+                    getattr(self, prefix + 'Tags').setdefault(key, []).append(rule)
+            self.addDependencies(selector)
+
+
+    def isPlainSelector(self, selector):
+        """Returns whether selector matches on the tag name alone."""
+        return not selector.qualifiers and selector.namespace in (None, '', '*')
+
+
+    def addDependencies(self, selector):
+        for qualifier in selector.qualifiers:
+            if qualifier.isAttr():
+                self.attrNames.add(qualifier.name)
+            elif qualifier.isPseudo():
+                self.pseudoClasses = True
+            elif qualifier.isCombiner():
+                if qualifier.op == '+':
+                    self.adjacentSiblings = True
+                self.addDependencies(qualifier.selector)
+
+
+    def getSelectorKey(self, selector):
+        """Returns the bucket name and key for a selector. Only the
+        qualifiers of the rightmost compound selector are used, combined
+        selectors are qualifiers themselves."""
+        className = None
+        for qualifier in selector.qualifiers:
+            if qualifier.isHash():
+                return 'ids', qualifier.hashId
+            if className is None and qualifier.isClass():
+                className = qualifier.classId
+        if className is not None:
+            return 'classes', className
+        if selector.name != '*':
+            return 'tags', selector.name
+        return None, None
+
+
+    def findCandidateRules(self, element):
+        rules = self.universal + self.tags.get(element.getTagName(), [])
+        return self.addClassAndIdRules(element, rules)
+
+
+    def findQualifiedCandidateRules(self, element):
+        """Same as findCandidateRules without the rules of getTagStyle."""
+        rules = self.qualifiedUniversal + self.qualifiedTags.get(element.getTagName(), [])
+        return self.addClassAndIdRules(element, rules)
+
+
+    def addClassAndIdRules(self, element, rules):
+        if self.classes:
+            for className in element.getClassNames():
+                rules += self.classes.get(className, [])
+        if self.ids:
+            rules += self.ids.get(element.getIdAttr(), [])
+        return rules
+
+
+    def getTagStyle(self, tagName):
+        """Returns the declarations of the rules matching every element
+        with tagName as {attrName: (specificity, order, value)}, for each
+        property the one of the most specific and, among these, the last
+        rule. The result is computed once per tag name and must not be
+        changed."""
+        style = self.tagStyles.get(tagName)
+        if style is None:
+            rules = self.plainUniversal + self.plainTags.get(tagName, [])
+            rules.sort(key=_ruleSortKey)
+            style = {}
+            for specificity, order, selector, declarations in rules:
+                for attrName, value in declarations.items():
+                    style[attrName] = (specificity, order, value)
+            self.tagStyles[tagName] = style
+        return style
+
+
 class CSSRuleset(dict):
+    _index = None
+    _order = None
+    _nextOrder = 0
+
+    # The rule index is built on first use and dropped whenever the rules
+    # change.
+    #
+    # The position of every rule is kept in _order: the order of a dict is
+    # arbitrary on Python 2, but of rules with the same specificity the
+    # last one in the source wins. A rule which is set again moves to the
+    # end.
+
+    def __init__(self, rules=(), **kw):
+        dict.__init__(self)
+        for key, value in _orderedItems(rules):
+            CSSRuleset.__setitem__(self, key, value)
+        for key, value in kw.items():
+            CSSRuleset.__setitem__(self, key, value)
+
+
+    def __setitem__(self, key, value):
+        self._index = None
+        if self._order is None:
+            self._order = {}
+        self._order[key] = self._nextOrder
+        self._nextOrder += 1
+        dict.__setitem__(self, key, value)
+
+
+    def __delitem__(self, key):
+        self._index = None
+        dict.__delitem__(self, key)
+        del self._order[key]
+
+
+    def clear(self):
+        self._index = None
+        dict.clear(self)
+        self._order = None
+
+
+    def pop(self, key, *args):
+        if key in self:
+            self._index = None
+            del self._order[key]
+        return dict.pop(self, key, *args)
+
+
+    def popitem(self):
+        self._index = None
+        key, value = dict.popitem(self)
+        del self._order[key]
+        return key, value
+
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+
+    def update(self, *args, **kw):
+        for rules in args + (kw,):
+            for key, value in _orderedItems(rules):
+                self[key] = value
+
+
+    def orderedItems(self):
+        """Returns the rules as (selector, declarations) in the order they
+        were added."""
+        order = self._order
+        return sorted(self.items(), key=lambda item: order[item[0]])
+
+
+    def getIndex(self):
+        index = self._index
+        if index is None:
+            index = self._index = CSSRuleIndex(self)
+        return index
+
+
     def findCSSRulesFor(self, element, attrName):
-        if sys.version[0] == '2':
-            iteritems = self.iteritems()
-        else:
-            iteritems = iter(self.items())
-        ruleResults = [(nodeFilter, declarations) for nodeFilter, declarations in iteritems if
-                       (attrName in declarations) and (nodeFilter.matches(element))]
-        ruleResults.sort()
-        return ruleResults
+        ruleResults = [rule for rule in self.getIndex().findCandidateRules(element) if
+                       (attrName in rule[3]) and (rule[2].matches(element))]
+        # Sort by specificity, rules with the same specificity stay in
+        # source order
+        ruleResults.sort(key=_ruleSortKey)
+        return [(nodeFilter, declarations) for _, _, nodeFilter, declarations in ruleResults]
 
 
     def findCSSRuleFor(self, element, attrName):
@@ -697,13 +1064,49 @@ class CSSRuleset(dict):
         return self.findCSSRulesFor(element, attrName)[-1:]
 
 
+    def findMatchingRules(self, element):
+        """Returns all rules matching element as (specificity, order,
+        selector, declarations), least specific first."""
+        ruleResults = [rule for rule in self.getIndex().findCandidateRules(element) if rule[2].matches(element)]
+        ruleResults.sort(key=_ruleSortKey)
+        return ruleResults
+
+
+    def findMatchingStyles(self, element):
+        """Returns the declarations of the rules matching element as
+        {attrName: (specificity, order, value)}, for each property the value
+        of the last rule of findMatchingRules declaring it. Rules matching
+        on the tag name alone come from CSSRuleIndex.getTagStyle instead of
+        being matched. The result must not be changed."""
+        index = self.getIndex()
+        style = index.getTagStyle(element.getTagName())
+        ruleResults = [rule for rule in index.findQualifiedCandidateRules(element) if rule[2].matches(element)]
+        if not ruleResults:
+            return style
+        style = dict(style)
+        ruleResults.sort(key=_ruleSortKey)
+        for specificity, order, selector, declarations in ruleResults:
+            for attrName, value in declarations.items():
+                current = style.get(attrName)
+                if current is None or current[:2] <= (specificity, order):
+                    style[attrName] = (specificity, order, value)
+        return style
+
+
+    def prune(self, tags, classes, ids):
+        """Returns a copy of the ruleset without the rules whose rightmost
+        compound selector needs a tag name, class or id that is not in
+        tags, classes or ids, and the number of rules left out."""
+        result = self.__class__()
+        for selector, declarations in self.orderedItems():
+            if _selectorMayMatch(selector, tags, classes, ids):
+                result[selector] = declarations
+        return result, len(self) - len(result)
+
+
     def mergeStyles(self, styles):
         " XXX Bugfix for use in PISA "
-        if sys.version[0] == '2':
-            iteritems = styles.iteritems()
-        else:
-            iteritems = iter(styles.items())
-        for k, v in iteritems:
+        for k, v in _orderedItems(styles):
             if k in self and self[k]:
                 self[k] = copy.copy(self[k])
                 self[k].update(v)
@@ -723,6 +1126,37 @@ class CSSInlineRuleset(CSSRuleset, CSSDeclarations):
         # whose value evalutates as False"
         return self.findCSSRulesFor(*args, **kw)[-1:]
 
+
+    def findMatchingRules(self, element):
+        if self:
+            selector = CSSInlineSelector()
+            return [(selector.specificity(), 0, selector, self)]
+        return []
+
+
+    def findMatchingStyles(self, element):
+        specificity = CSSInlineSelector().specificity()
+        return dict((attrName, (specificity, 0, value)) for attrName, value in self.items())
+
+
+class CSSImmutableInlineRuleset(CSSInlineRuleset):
+    """A CSSInlineRuleset that can not be changed any more, so that one
+    parsed inline style can be shared by many elements."""
+
+    def _immutable(self, *args, **kw):
+        raise TypeError("%s can not be changed" % self.__class__.__name__)
+
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+
+
+    def __copy__(self):
+        return self
+
+
+    def __deepcopy__(self, memo):
+        return self
+
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 #~ CSS Builder
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -30,6 +30,12 @@ class CSSDOMElementInterface(css.CSSElementInterfaceAbstract):
     #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     style = None
+    ancestorFilter = None
+
+    # Filled in by indexElements or on first use, the DOM does not change
+    # while it is styled.
+    _parent = _previous = _next = NotImplemented
+    _classNames = _idAttr = None
 
     _pseudoStateHandlerLookup = {
         'first-child':
@@ -90,51 +96,111 @@ class CSSDOMElementInterface(css.CSSElementInterfaceAbstract):
             return default
 
 
+    def setAttr(self, name, value):
+        self.domElement.setAttribute(name, value)
+        self._classNames = self._idAttr = None
+
+
     def getIdAttr(self):
-        return self.getAttr('id', '')
+        idAttr = self._idAttr
+        if idAttr is None:
+            idAttr = self._idAttr = self.getAttr('id', '')
+        return idAttr
 
 
     def getClassAttr(self):
         return self.getAttr('class', '')
 
 
+    def getClassNames(self):
+        classNames = self._classNames
+        if classNames is None:
+            classNames = self._classNames = frozenset(self.getClassAttr().split())
+        return classNames
+
+
     def getStyleAttr(self):
         return self.getAttr('style', None)
 
 
+    def getTagName(self):
+        return self.domElement.tagName
+
+
     def inPseudoState(self, name, params=()):
         handler = self._pseudoStateHandlerLookup.get(name, lambda self: False)
         return handler(self)
 
 
     def iterXMLParents(self, includeSelf=False):
-        klass = self.__class__
-        current = self.domElement
-        if not includeSelf:
-            current = current.parentNode
-        while (current is not None) and (current.nodeType == current.ELEMENT_NODE):
-            yield klass(current)
-            current = current.parentNode
+        if includeSelf:
+            current = self
+        else:
+            current = self.getParentElement()
+        while current is not None:
+            yield current
+            current = current.getParentElement()
+
+
+    def getAncestorFilter(self):
+        """Returns the css.CSSAncestorFilter set with setAncestorFilter if it
+        currently holds the parents of this element."""
+        ancestors = self.ancestorFilter
+        if ancestors is not None:
+            parent = ancestors.getParent()
+            if parent is None:
+                if self.getParentElement() is None:
+                    return ancestors
+            elif parent.domElement is self.domElement.parentNode:
+                return ancestors
+        return None
 
 
-    def getPreviousSibling(self):
-        sibling = self.domElement.previousSibling
-        while sibling:
-            if sibling.nodeType == sibling.ELEMENT_NODE:
-                return sibling
+    def setAncestorFilter(self, ancestors):
+        """Uses the css.CSSAncestorFilter ancestors, which pisaLoop keeps
+        changing, for this element. getAncestorFilter checks that they are
+        still the parents of this element each time it is asked."""
+        self.ancestorFilter = ancestors
+
+
+    def getParentElement(self):
+        parent = self._parent
+        if parent is NotImplemented:
+            parentNode = self.domElement.parentNode
+            if parentNode is not None and parentNode.nodeType == parentNode.ELEMENT_NODE:
+                parent = getElementInterface(parentNode)
             else:
+                parent = None
+            self._parent = parent
+        return parent
+
+
+    def getPreviousSibling(self):
+        previous = self._previous
+        if previous is NotImplemented:
+            sibling = self.domElement.previousSibling
+            while sibling is not None and sibling.nodeType != sibling.ELEMENT_NODE:
                 sibling = sibling.previousSibling
-        return None
+            if sibling is not None:
+                previous = getElementInterface(sibling)
+            else:
+                previous = None
+            self._previous = previous
+        return previous
 
 
     def getNextSibling(self):
-        sibling = self.domElement.nextSibling
-        while sibling:
-            if sibling.nodeType == sibling.ELEMENT_NODE:
-                return sibling
-            else:
+        next = self._next
+        if next is NotImplemented:
+            sibling = self.domElement.nextSibling
+            while sibling is not None and sibling.nodeType != sibling.ELEMENT_NODE:
                 sibling = sibling.nextSibling
-        return None
+            if sibling is not None:
+                next = getElementInterface(sibling)
+            else:
+                next = None
+            self._next = next
+        return next
 
 
     def getInlineStyle(self):
@@ -144,3 +210,35 @@ class CSSDOMElementInterface(css.CSSElementInterfaceAbstract):
     def setInlineStyle(self, style):
         self.style = style
 
+
+def getElementInterface(domElement):
+    """Returns the CSSDOMElementInterface of domElement. It is created on
+    first use and kept as domElement.cssElement."""
+    element = getattr(domElement, 'cssElement', None)
+    if element is None:
+        element = domElement.cssElement = CSSDOMElementInterface(domElement)
+    return element
+
+
+def indexElements(domNode):
+    """Links the CSSDOMElementInterface of every element below domNode to the
+    interfaces of its parent and sibling elements in one pass, so selector
+    matching never has to search the DOM for them."""
+    nodes = [domNode]
+    while nodes:
+        node = nodes.pop()
+        if node.nodeType == node.ELEMENT_NODE:
+            parent = getElementInterface(node)
+        else:
+            parent = None
+        previous = None
+        for child in node.childNodes:
+            if child.nodeType == child.ELEMENT_NODE:
+                element = getElementInterface(child)
+                element._parent = parent
+                element._previous = previous
+                element._next = None
+                if previous is not None:
+                    previous._next = element
+                previous = element
+                nodes.append(child)
@@ -36,14 +36,17 @@ import six
 from xhtml2pdf.w3c.cssSpecial import cleanup_css
 
 
-def is_at_rule_ident(src, ident):
+def is_at_rule_ident(src, ident, pos=0):
     """
 
     :param src:
     :param ident:
-    :return:
+    :param pos: offset into src to look at
+    :return: whether src has "@" + ident at pos
     """
-    return re.match(r'^@' + ident + r'\s*', src)
+    # What matching re.compile(r'@' + ident + r'\s*') at pos found, without
+    # building the pattern for every at-rule
+    return src.startswith('@' + ident, pos)
 
 
 def strip_at_rule_ident(src):
@@ -351,6 +354,11 @@ class CSSParser(object):
     re_comment = re.compile(i_comment, _reflags)
     i_important = u'!\s*(important)'
     re_important = re.compile(i_important, _reflags)
+    re_nmchars = re.compile('(?:%s)*' % i_nmchar, _reflags)
+    re_s = re.compile(r'\s*', re.U)
+    re_at_rule_ident = re.compile(r'@[a-z\-]+\s*')
+    re_media_and = re.compile('.*({.*)')
+    re_term_end = re.compile(r'[;{}\[\])]')
     del _orRule
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -405,8 +413,10 @@ class CSSParser(object):
         try:
             # XXX Some simple preprocessing
             src = cleanup_css(src)
+            # Get rid of the comments
+            src = self.re_comment.sub(six.u(''), src)
             try:
-                src, stylesheet = self._parse_stylesheet(src)
+                pos, stylesheet = self._parse_stylesheet(src)
             except self.ParseError as err:
                 err.setFullCSSSource(src)
                 raise
@@ -420,7 +430,7 @@ class CSSParser(object):
         self.css_builder.begin_inline()
         try:
             try:
-                src, properties = self._parse_declaration_group(src.strip(), braces=False)
+                pos, properties = self._parse_declaration_group(src.strip(), 0, braces=False)
             except self.ParseError as err:
                 err.setFullCSSSource(src, inline=True)
                 raise
@@ -446,7 +456,7 @@ class CSSParser(object):
             properties = []
             for propertyName, src in kwAttributes.items():
                 try:
-                    src, property = self._parse_declaration_property(src.strip(), propertyName)
+                    pos, property = self._parse_declaration_property(src.strip(), 0, propertyName)
                     properties.append(property)
                 except self.ParseError as err:
                     err.setFullCSSSource(src, inline=True)
@@ -472,94 +482,96 @@ class CSSParser(object):
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     # ~ Internal _parse methods
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #
+    # The _parse methods never slice the source, they take the complete
+    # source text together with the offset to start at and return the
+    # offset following the parsed construct.  Copying the remaining source
+    # for every token made parsing quadratic in the size of the stylesheet.
 
-    def _parse_stylesheet(self, src):
+    def _parse_stylesheet(self, src, pos=0):
         """stylesheet
         : [ CHARSET_SYM S* STRING S* ';' ]?
             [S|CDO|CDC]* [ import [S|CDO|CDC]* ]*
             [ [ ruleset | media | page | font_face ] [S|CDO|CDC]* ]*
         ;
         """
-        # Get rid of the comments
-        src = self.re_comment.sub(six.u(''), src)
-
         # [ CHARSET_SYM S* STRING S* ';' ]?
-        src = self._parse_at_charset(src)
+        pos = self._parse_at_charset(src, pos)
 
         # [S|CDO|CDC]*
-        src = self._parse_s_cdo_cdc(src)
+        pos = self._parse_s_cdo_cdc(src, pos)
         #  [ import [S|CDO|CDC]* ]*
-        src, stylesheet_imports = self._parse_at_imports(src)
+        pos, stylesheet_imports = self._parse_at_imports(src, pos)
 
         # [ namespace [S|CDO|CDC]* ]*
-        src = self._parse_at_namespace(src)
+        pos = self._parse_at_namespace(src, pos)
 
         stylesheet_elements = []
 
         # [ [ ruleset | atkeywords ] [S|CDO|CDC]* ]*
-        while src:  # due to ending with ]*
-            if src.startswith('@'):
+        while pos < len(src):  # due to ending with ]*
+            if src.startswith('@', pos):
                 # @media, @page, @font-face
-                src, at_results = self._parse_at_keyword(src)
+                pos, at_results = self._parse_at_keyword(src, pos)
                 if at_results is not None and at_results != NotImplemented:
                     stylesheet_elements.extend(at_results)
             else:
                 # ruleset
-                src, ruleset = self._parse_ruleset(src)
+                pos, ruleset = self._parse_ruleset(src, pos)
                 stylesheet_elements.append(ruleset)
 
             # [S|CDO|CDC]*
-            src = self._parse_s_cdo_cdc(src)
+            pos = self._parse_s_cdo_cdc(src, pos)
 
         stylesheet = self.css_builder.stylesheet(stylesheet_elements, stylesheet_imports)
-        return src, stylesheet
+        return pos, stylesheet
 
-    def _parse_s_cdo_cdc(self, src):
+    def _parse_s_cdo_cdc(self, src, pos):
         """[S|CDO|CDC]*"""
         while True:
-            src = src.lstrip()
-            if src.startswith('<!--'):
-                src = src[4:]
-            elif src.startswith('-->'):
-                src = src[3:]
+            pos = self._skip_s(src, pos)
+            if src.startswith('<!--', pos):
+                pos += 4
+            elif src.startswith('-->', pos):
+                pos += 3
             else:
                 break
-        return src
+        return pos
 
     # ~ CSS @ directives ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-    def _parse_at_charset(self, src):
+    def _parse_at_charset(self, src, pos):
         """[ CHARSET_SYM S* STRING S* ';' ]?"""
-        if is_at_rule_ident(src, 'charset'):
-            ctxsrc = src
-            src = strip_at_rule_ident(src)
-            charset, src = self._get_string(src)
-            src = src.lstrip()
-            if src[:1] != ';':
-                raise self.ParseError('@charset expected a terminating \';\'', src, ctxsrc)
-            src = src[1:].lstrip()
+        if is_at_rule_ident(src, 'charset', pos):
+            ctxpos = pos
+            pos = self.re_at_rule_ident.match(src, pos).end()
+            charset, pos = self._get_string(src, pos)
+            pos = self._skip_s(src, pos)
+            if not src.startswith(';', pos):
+                raise self._error('@charset expected a terminating \';\'', src, pos, ctxpos)
+            pos = self._skip_s(src, pos + 1)
 
             self.css_builder.at_charset(charset)
-        return src
+        return pos
 
-    def _parse_at_imports(self, src):
+    def _parse_at_imports(self, src, pos):
         """[ import [S|CDO|CDC]* ]*"""
         result = []
-        while is_at_rule_ident(src, 'import'):
-            ctxsrc = src
-            src = strip_at_rule_ident(src)
+        while is_at_rule_ident(src, 'import', pos):
+            ctxpos = pos
+            pos = self.re_at_rule_ident.match(src, pos).end()
 
-            import_, src = self._get_string_or_uri(src)
+            import_, pos = self._get_string_or_uri(src, pos)
             if import_ is None:
-                raise self.ParseError('Import expecting string or url', src, ctxsrc)
+                raise self._error('Import expecting string or url', src, pos, ctxpos)
 
             mediums = []
-            medium, src = self._get_ident(src.lstrip())
+            medium, pos = self._get_ident(src, self._skip_s(src, pos))
             while medium is not None:
                 mediums.append(medium)
-                if src[:1] == ',':
-                    src = src[1:].lstrip()
-                    medium, src = self._get_ident(src)
+                if src.startswith(',', pos):
+                    pos = self._skip_s(src, pos + 1)
+                    medium, pos = self._get_ident(src, pos)
                 else:
                     break
 
@@ -567,97 +579,95 @@ class CSSParser(object):
             if not mediums:
                 mediums = ["all"]
 
-            if src[:1] != ';':
-                raise self.ParseError('@import expected a terminating \';\'', src, ctxsrc)
-            src = src[1:].lstrip()
+            if not src.startswith(';', pos):
+                raise self._error('@import expected a terminating \';\'', src, pos, ctxpos)
+            pos = self._skip_s(src, pos + 1)
 
             stylesheet = self.css_builder.at_import(import_, mediums, self)
             if stylesheet is not None:
                 result.append(stylesheet)
 
-            src = self._parse_s_cdo_cdc(src)
-        return src, result
+            pos = self._parse_s_cdo_cdc(src, pos)
+        return pos, result
 
-    def _parse_at_namespace(self, src):
+    def _parse_at_namespace(self, src, pos):
         """namespace :
 
         @namespace S* [IDENT S*]? [STRING|URI] S* ';' S*
         """
 
-        src = self._parse_s_cdo_cdc(src)
-        while is_at_rule_ident(src, 'namespace'):
-            ctxsrc = src
-            src = strip_at_rule_ident(src)
+        pos = self._parse_s_cdo_cdc(src, pos)
+        while is_at_rule_ident(src, 'namespace', pos):
+            ctxpos = pos
+            pos = self.re_at_rule_ident.match(src, pos).end()
 
-            namespace, src = self._get_string_or_uri(src)
+            namespace, pos = self._get_string_or_uri(src, pos)
             if namespace is None:
-                nsPrefix, src = self._get_ident(src)
+                nsPrefix, pos = self._get_ident(src, pos)
                 if nsPrefix is None:
-                    raise self.ParseError('@namespace expected an identifier or a URI', src, ctxsrc)
-                namespace, src = self._get_string_or_uri(src.lstrip())
+                    raise self._error('@namespace expected an identifier or a URI', src, pos, ctxpos)
+                namespace, pos = self._get_string_or_uri(src, self._skip_s(src, pos))
                 if namespace is None:
-                    raise self.ParseError('@namespace expected a URI', src, ctxsrc)
+                    raise self._error('@namespace expected a URI', src, pos, ctxpos)
             else:
                 nsPrefix = None
 
-            src = src.lstrip()
-            if src[:1] != ';':
-                raise self.ParseError('@namespace expected a terminating \';\'', src, ctxsrc)
-            src = src[1:].lstrip()
+            pos = self._skip_s(src, pos)
+            if not src.startswith(';', pos):
+                raise self._error('@namespace expected a terminating \';\'', src, pos, ctxpos)
+            pos = self._skip_s(src, pos + 1)
 
             self.css_builder.at_namespace(nsPrefix, namespace)
 
-            src = self._parse_s_cdo_cdc(src)
-        return src
+            pos = self._parse_s_cdo_cdc(src, pos)
+        return pos
 
-    def _parse_at_keyword(self, src):
+    def _parse_at_keyword(self, src, pos):
         """[media | page | font_face | unknown_keyword]"""
-        ctxsrc = src
-        if is_at_rule_ident(src, 'media'):
-            src, result = self._parse_at_media(src)
-        elif is_at_rule_ident(src, 'page'):
-            src, result = self._parse_at_page(src)
-        elif is_at_rule_ident(src, 'font-face'):
-            src, result = self._parse_at_font_face(src)
+        ctxpos = pos
+        if is_at_rule_ident(src, 'media', pos):
+            pos, result = self._parse_at_media(src, pos)
+        elif is_at_rule_ident(src, 'page', pos):
+            pos, result = self._parse_at_page(src, pos)
+        elif is_at_rule_ident(src, 'font-face', pos):
+            pos, result = self._parse_at_font_face(src, pos)
         # XXX added @import, was missing!
-        elif is_at_rule_ident(src, 'import'):
-            src, result = self._parse_at_imports(src)
-        elif is_at_rule_ident(src, 'frame'):
-            src, result = self._parse_at_frame(src)
-        elif src.startswith('@'):
-            src, result = self._parse_at_ident(src)
+        elif is_at_rule_ident(src, 'import', pos):
+            pos, result = self._parse_at_imports(src, pos)
+        elif is_at_rule_ident(src, 'frame', pos):
+            pos, result = self._parse_at_frame(src, pos)
+        elif src.startswith('@', pos):
+            pos, result = self._parse_at_ident(src, pos)
         else:
-            raise self.ParseError('Unknown state in atKeyword', src, ctxsrc)
-        return src, result
+            raise self._error('Unknown state in atKeyword', src, pos, ctxpos)
+        return pos, result
 
-    def _parse_at_media(self, src):
+    def _parse_at_media(self, src, pos):
         """media
         : MEDIA_SYM S* medium [ ',' S* medium ]* '{' S* ruleset* '}' S*
         ;
         """
-        ctxsrc = src
-        src = src[len('@media '):].lstrip()
+        ctxpos = pos
+        pos = self._skip_s(src, pos + len('@media '))
         mediums = []
-        while src and src[0] != '{':
-            medium, src = self._get_ident(src)
+        while pos < len(src) and src[pos] != '{':
+            medium, pos = self._get_ident(src, pos)
             if medium is None:
-                raise self.ParseError('@media rule expected media identifier', src, ctxsrc)
+                raise self._error('@media rule expected media identifier', src, pos, ctxpos)
             # make "and ... {" work
             if medium == u'and':
                 # strip up to curly bracket
-                pattern = re.compile('.*({.*)')
-                match = re.match(pattern, src)
-                src = src[match.end()-1:]
+                match = self.re_media_and.match(src, pos)
+                pos = match.end() - 1
                 break
             mediums.append(medium)
-            if src[0] == ',':
-                src = src[1:].lstrip()
-            else:
-                src = src.lstrip()
+            if src.startswith(',', pos):
+                pos += 1
+            pos = self._skip_s(src, pos)
 
-        if not src.startswith('{'):
-            raise self.ParseError('Ruleset opening \'{\' not found', src, ctxsrc)
-        src = src[1:].lstrip()
+        if not src.startswith('{', pos):
+            raise self._error('Ruleset opening \'{\' not found', src, pos, ctxpos)
+        pos = self._skip_s(src, pos + 1)
 
         stylesheet_elements = []
         # while src and not src.startswith('}'):
@@ -666,37 +676,37 @@ class CSSParser(object):
         #    src = src.lstrip()
 
         # Containing @ where not found and parsed
-        while src and not src.startswith('}'):
-            if src.startswith('@'):
+        while pos < len(src) and not src.startswith('}', pos):
+            if src.startswith('@', pos):
                 # @media, @page, @font-face
-                src, atResults = self._parse_at_keyword(src)
+                pos, atResults = self._parse_at_keyword(src, pos)
                 if atResults is not None:
                     stylesheet_elements.extend(atResults)
             else:
                 # ruleset
-                src, ruleset = self._parse_ruleset(src)
+                pos, ruleset = self._parse_ruleset(src, pos)
                 stylesheet_elements.append(ruleset)
-            src = src.lstrip()
+            pos = self._skip_s(src, pos)
 
-        if not src.startswith('}'):
-            raise self.ParseError('Ruleset closing \'}\' not found', src, ctxsrc)
+        if not src.startswith('}', pos):
+            raise self._error('Ruleset closing \'}\' not found', src, pos, ctxpos)
         else:
-            src = src[1:].lstrip()
+            pos = self._skip_s(src, pos + 1)
 
         result = self.css_builder.at_media(mediums, stylesheet_elements)
-        return src, result
+        return pos, result
 
-    def _parse_at_page(self, src):
+    def _parse_at_page(self, src, pos):
         """page
         : PAGE_SYM S* IDENT? pseudo_page? S*
             '{' S* declaration [ ';' S* declaration ]* '}' S*
         ;
         """
-        ctxsrc = src
-        src = src[len('@page '):].lstrip()
-        page, src = self._get_ident(src)
-        if src[:1] == ':':
-            pseudopage, src = self._get_ident(src[1:])
+        ctxpos = pos
+        pos = self._skip_s(src, pos + len('@page '))
+        page, pos = self._get_ident(src, pos)
+        if src.startswith(':', pos):
+            pseudopage, pos = self._get_ident(src, pos + 1)
             page = page + '_' + pseudopage
         else:
             pseudopage = None
@@ -705,336 +715,339 @@ class CSSParser(object):
 
         # Containing @ where not found and parsed
         stylesheet_elements = []
-        src = src.lstrip()
+        pos = self._skip_s(src, pos)
         properties = []
 
         # XXX Extended for PDF use
-        if not src.startswith('{'):
-            raise self.ParseError('Ruleset opening \'{\' not found', src, ctxsrc)
+        if not src.startswith('{', pos):
+            raise self._error('Ruleset opening \'{\' not found', src, pos, ctxpos)
         else:
-            src = src[1:].lstrip()
+            pos = self._skip_s(src, pos + 1)
 
-        while src and not src.startswith('}'):
-            if src.startswith('@'):
+        while pos < len(src) and not src.startswith('}', pos):
+            if src.startswith('@', pos):
                 # @media, @page, @font-face
-                src, at_results = self._parse_at_keyword(src)
+                pos, at_results = self._parse_at_keyword(src, pos)
                 if at_results is not None:
                     stylesheet_elements.extend(at_results)
             else:
-                src, nproperties = self._parse_declaration_group(src.lstrip(), braces=False)
+                pos, nproperties = self._parse_declaration_group(src, self._skip_s(src, pos), braces=False)
                 properties += nproperties
-            src = src.lstrip()
+            pos = self._skip_s(src, pos)
 
         result = [self.css_builder.at_page(page, pseudopage, properties)]
 
-        return src[1:].lstrip(), result
+        return self._skip_s(src, pos + 1), result
 
-    def _parse_at_frame(self, src):
+    def _parse_at_frame(self, src, pos):
         """
         XXX Proprietary for PDF
         """
-        ctxsrc = src
-        src = src[len('@frame '):].lstrip()
-        box, src = self._get_ident(src)
-        src, properties = self._parse_declaration_group(src.lstrip())
+        pos = self._skip_s(src, pos + len('@frame '))
+        box, pos = self._get_ident(src, pos)
+        pos, properties = self._parse_declaration_group(src, self._skip_s(src, pos))
         result = [self.css_builder.at_frame(box, properties)]
-        return src.lstrip(), result
+        return self._skip_s(src, pos), result
 
-    def _parse_at_font_face(self, src):
-        ctxsrc = src
-        src = src[len('@font-face '):].lstrip()
-        src, properties = self._parse_declaration_group(src)
+    def _parse_at_font_face(self, src, pos):
+        pos = self._skip_s(src, pos + len('@font-face '))
+        pos, properties = self._parse_declaration_group(src, pos)
         result = [self.css_builder.at_font_face(properties)]
-        return src, result
+        return pos, result
 
-    def _parse_at_ident(self, src):
-        ctxsrc = src
-        atIdent, src = self._get_ident(src[1:])
+    def _parse_at_ident(self, src, pos):
+        ctxpos = pos
+        atIdent, pos = self._get_ident(src, pos + 1)
         if atIdent is None:
-            raise self.ParseError('At-rule expected an identifier for the rule', src, ctxsrc)
+            raise self._error('At-rule expected an identifier for the rule', src, pos, ctxpos)
 
-        src, result = self.css_builder.at_ident(atIdent, self, src)
+        pos, result = self._call_builder(
+            lambda rest: self.css_builder.at_ident(atIdent, self, rest), src, pos)
 
         if result is NotImplemented:
             # An at-rule consists of everything up to and including the next semicolon (;) or the next block,
             # whichever comes first
 
-            semiIdx = src.find(';')
+            semiIdx = src.find(';', pos)
             if semiIdx < 0:
-                semiIdx = None
-            blockIdx = src[:semiIdx].find('{')
-            if blockIdx < 0:
-                blockIdx = None
-
-            if semiIdx is not None and semiIdx < blockIdx:
-                src = src[semiIdx + 1:].lstrip()
-            elif blockIdx is None:
+                blockIdx = src.find('{', pos)
+            else:
+                blockIdx = src.find('{', pos, semiIdx)
+
+            if semiIdx >= 0 and (blockIdx < 0 or semiIdx < blockIdx):
+                pos = self._skip_s(src, semiIdx + 1)
+            elif blockIdx < 0:
                 # consume the rest of the content since we didn't find a block or a semicolon
-                src = src[-1:-1]
-            elif blockIdx is not None:
+                pos = len(src)
+            else:
                 # expecing a block...
-                src = src[blockIdx:]
+                pos = blockIdx
                 try:
                     # try to parse it as a declarations block
-                    src, declarations = self._parse_declaration_group(src)
+                    pos, declarations = self._parse_declaration_group(src, pos)
                 except self.ParseError:
                     # try to parse it as a stylesheet block
-                    src, stylesheet = self._parse_stylesheet(src)
-            else:
-                raise self.ParseError('Unable to ignore @-rule block', src, ctxsrc)
+                    pos, stylesheet = self._parse_stylesheet(src, pos)
 
-        return src.lstrip(), result
+        return self._skip_s(src, pos), result
 
     # ~ ruleset - see selector and declaration groups ~~~~
 
-    def _parse_ruleset(self, src):
+    def _parse_ruleset(self, src, pos):
         """ruleset
         : selector [ ',' S* selector ]*
             '{' S* declaration [ ';' S* declaration ]* '}' S*
         ;
         """
-        src, selectors = self._parse_selector_group(src)
-        src, properties = self._parse_declaration_group(src.lstrip())
+        pos, selectors = self._parse_selector_group(src, pos)
+        pos, properties = self._parse_declaration_group(src, self._skip_s(src, pos))
         result = self.css_builder.ruleset(selectors, properties)
-        return src, result
+        return pos, result
 
     # ~ selector parsing ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-    def _parse_selector_group(self, src):
+    def _parse_selector_group(self, src, pos):
         selectors = []
-        while src[:1] not in ('{', '}', ']', '(', ')', ';', ''):
-            src, selector = self._parse_selector(src)
+        while src[pos:pos + 1] not in ('{', '}', ']', '(', ')', ';', ''):
+            pos, selector = self._parse_selector(src, pos)
             if selector is None:
                 break
             selectors.append(selector)
-            if src.startswith(','):
-                src = src[1:].lstrip()
-        return src, selectors
+            if src.startswith(',', pos):
+                pos = self._skip_s(src, pos + 1)
+        return pos, selectors
 
-    def _parse_selector(self, src):
+    def _parse_selector(self, src, pos):
         """selector
         : simple_selector [ combinator simple_selector ]*
         ;
         """
-        src, selector = self._parse_simple_selector(src)
-        srcLen = len(src) # XXX
-        while src[:1] not in ('', ',', ';', '{', '}', '[', ']', '(', ')'):
+        pos, selector = self._parse_simple_selector(src, pos)
+        startpos = pos # XXX
+        while src[pos:pos + 1] not in ('', ',', ';', '{', '}', '[', ']', '(', ')'):
             for combiner in self.selector_combiners:
-                if src.startswith(combiner):
-                    src = src[len(combiner):].lstrip()
+                if src.startswith(combiner, pos):
+                    pos = self._skip_s(src, pos + len(combiner))
                     break
             else:
                 combiner = ' '
-            src, selectorB = self._parse_simple_selector(src)
+            pos, selectorB = self._parse_simple_selector(src, pos)
 
             # XXX Fix a bug that occured here e.g. : .1 {...}
-            if len(src) >= srcLen:
-                src = src[1:]
-                while src and (src[:1] not in ('', ',', ';', '{', '}', '[', ']', '(', ')')):
-                    src = src[1:]
-                return src.lstrip(), None
+            if pos <= startpos:
+                pos += 1
+                while pos < len(src) and src[pos] not in (',', ';', '{', '}', '[', ']', '(', ')'):
+                    pos += 1
+                return self._skip_s(src, pos), None
 
             selector = self.css_builder.combine_selectors(selector, combiner, selectorB)
 
-        return src.lstrip(), selector
+        return self._skip_s(src, pos), selector
 
-    def _parse_simple_selector(self, src):
+    def _parse_simple_selector(self, src, pos):
         """simple_selector
         : [ namespace_selector ]? element_name? [ HASH | class | attrib | pseudo ]* S*
         ;
         """
-        ctxsrc = src.lstrip()
-        nsPrefix, src = self._get_match_result(self.re_namespace_selector, src)
-        name, src = self._get_match_result(self.re_element_name, src)
+        ctxpos = self._skip_s(src, pos)
+        nsPrefix, pos = self._get_match_result(self.re_namespace_selector, src, pos)
+        name, pos = self._get_match_result(self.re_element_name, src, pos)
         if name:
             pass # already *successfully* assigned
-        elif src[:1] in self.selector_qualifiers:
+        elif src[pos:pos + 1] in self.selector_qualifiers:
             name = '*'
         else:
-            raise self.ParseError('Selector name or qualifier expected', src, ctxsrc)
+            raise self._error('Selector name or qualifier expected', src, pos, ctxpos)
 
         name = self.css_builder.resolve_namespace_prefix(nsPrefix, name)
         selector = self.css_builder.selector(name)
-        while src and src[:1] in self.selector_qualifiers:
-            hash_, src = self._get_match_result(self.re_hash, src)
+        while pos < len(src) and src[pos] in self.selector_qualifiers:
+            hash_, pos = self._get_match_result(self.re_hash, src, pos)
             if hash_ is not None:
                 selector.add_hash_id(hash_)
                 continue
 
-            class_, src = self._get_match_result(self.re_class, src)
+            class_, pos = self._get_match_result(self.re_class, src, pos)
             if class_ is not None:
                 selector.add_class(class_)
                 continue
 
-            if src.startswith('['):
-                src, selector = self._parse_selector_attribute(src, selector)
-            elif src.startswith(':'):
-                src, selector = self._parse_selector_pseudo(src, selector)
+            if src.startswith('[', pos):
+                pos, selector = self._parse_selector_attribute(src, pos, selector)
+            elif src.startswith(':', pos):
+                pos, selector = self._parse_selector_pseudo(src, pos, selector)
             else:
                 break
 
-        return src.lstrip(), selector
+        return self._skip_s(src, pos), selector
 
-    def _parse_selector_attribute(self, src, selector):
+    def _parse_selector_attribute(self, src, pos, selector):
         """attrib
         : '[' S* [ namespace_selector ]? IDENT S* [ [ '=' | INCLUDES | DASHMATCH ] S*
             [ IDENT | STRING ] S* ]? ']'
         ;
         """
-        ctxsrc = src
-        if not src.startswith('['):
-            raise self.ParseError('Selector Attribute opening \'[\' not found', src, ctxsrc)
-        src = src[1:].lstrip()
+        ctxpos = pos
+        if not src.startswith('[', pos):
+            raise self._error('Selector Attribute opening \'[\' not found', src, pos, ctxpos)
+        pos = self._skip_s(src, pos + 1)
 
-        nsPrefix, src = self._get_match_result(self.re_namespace_selector, src)
-        attrName, src = self._get_ident(src)
+        nsPrefix, pos = self._get_match_result(self.re_namespace_selector, src, pos)
+        attrName, pos = self._get_ident(src, pos)
 
-        src = src.lstrip()
+        pos = self._skip_s(src, pos)
 
         if attrName is None:
-            raise self.ParseError('Expected a selector attribute name', src, ctxsrc)
+            raise self._error('Expected a selector attribute name', src, pos, ctxpos)
         if nsPrefix is not None:
             attrName = self.css_builder.resolve_namespace_prefix(nsPrefix, attrName)
 
         for op in self.attribute_operators:
-            if src.startswith(op):
+            if src.startswith(op, pos):
                 break
         else:
             op = ''
-        src = src[len(op):].lstrip()
+        pos = self._skip_s(src, pos + len(op))
 
         if op:
-            attrValue, src = self._get_ident(src)
+            attrValue, pos = self._get_ident(src, pos)
             if attrValue is None:
-                attrValue, src = self._get_string(src)
+                attrValue, pos = self._get_string(src, pos)
                 if attrValue is None:
-                    raise self.ParseError('Expected a selector attribute value', src, ctxsrc)
+                    raise self._error('Expected a selector attribute value', src, pos, ctxpos)
         else:
             attrValue = None
 
-        if not src.startswith(']'):
-            raise self.ParseError('Selector Attribute closing \']\' not found', src, ctxsrc)
+        if not src.startswith(']', pos):
+            raise self._error('Selector Attribute closing \']\' not found', src, pos, ctxpos)
         else:
-            src = src[1:]
+            pos += 1
 
         if op:
             selector.add_attribute_operation(attrName, op, attrValue)
         else:
             selector.add_attribute(attrName)
-        return src, selector
+        return pos, selector
 
-    def _parse_selector_pseudo(self, src, selector):
+    def _parse_selector_pseudo(self, src, pos, selector):
         """pseudo
         : ':' [ IDENT | function ]
         ;
         """
-        ctxsrc = src
-        if not src.startswith(':'):
-            raise self.ParseError('Selector Pseudo \':\' not found', src, ctxsrc)
-        src = re.search('^:{1,2}(.*)', src, re.M | re.S).group(1)
+        ctxpos = pos
+        if not src.startswith(':', pos):
+            raise self._error('Selector Pseudo \':\' not found', src, pos, ctxpos)
+        pos += 2 if src.startswith('::', pos) else 1
 
-        name, src = self._get_ident(src)
+        name, pos = self._get_ident(src, pos)
         if not name:
-            raise self.ParseError('Selector Pseudo identifier not found', src, ctxsrc)
+            raise self._error('Selector Pseudo identifier not found', src, pos, ctxpos)
 
-        if src.startswith('('):
+        if src.startswith('(', pos):
             # function
-            src = src[1:].lstrip()
-            src, term = self._parse_expression(src, True)
-            if not src.startswith(')'):
-                raise self.ParseError('Selector Pseudo Function closing \')\' not found', src, ctxsrc)
-            src = src[1:]
+            pos = self._skip_s(src, pos + 1)
+            pos, term = self._parse_expression(src, pos, True)
+            if not src.startswith(')', pos):
+                raise self._error('Selector Pseudo Function closing \')\' not found', src, pos, ctxpos)
+            pos += 1
             selector.add_pseudo_function(name, term)
         else:
             selector.add_pseudo(name)
 
-        return src, selector
+        return pos, selector
 
     # ~ declaration and expression parsing ~~~~~~~~~~~~~~~
 
-    def _parse_declaration_group(self, src, braces=True):
-        ctxsrc = src
-        if src.startswith('{'):
-            src, braces = src[1:], True
+    def _parse_declaration_group(self, src, pos, braces=True):
+        ctxpos = pos
+        if src.startswith('{', pos):
+            pos, braces = pos + 1, True
         elif braces:
-            raise self.ParseError('Declaration group opening \'{\' not found', src, ctxsrc)
+            raise self._error('Declaration group opening \'{\' not found', src, pos, ctxpos)
 
         properties = []
-        src = src.lstrip()
-        while src[:1] not in ('', ',', '{', '}', '[', ']', '(', ')', '@'): # XXX @?
-            src, property = self._parse_declaration(src)
-
-            # XXX Workaround for styles like "*font: smaller"
-            if src.startswith("*"):
-                src = "-nothing-" + src[1:]
+        hack = False
+        pos = self._skip_s(src, pos)
+        while src[pos:pos + 1] not in ('', ',', '{', '}', '[', ']', '(', ')', '@'): # XXX @?
+            pos, property = self._parse_declaration(src, pos, hack)
+            hack = False
+
+            # XXX Workaround for styles like "*font: smaller", which is
+            # parsed as "-nothing-font: smaller"
+            if src.startswith("*", pos):
+                pos, hack = pos + 1, True
                 continue
 
             if property is None:
                 break
             properties.append(property)
-            if src.startswith(';'):
-                src = src[1:].lstrip()
+            if src.startswith(';', pos):
+                pos = self._skip_s(src, pos + 1)
             else:
                 break
 
         if braces:
-            if not src.startswith('}'):
-                raise self.ParseError('Declaration group closing \'}\' not found', src, ctxsrc)
-            src = src[1:]
+            if not src.startswith('}', pos):
+                raise self._error('Declaration group closing \'}\' not found', src, pos, ctxpos)
+            pos += 1
 
-        return src.lstrip(), properties
+        return self._skip_s(src, pos), properties
 
-    def _parse_declaration(self, src):
+    def _parse_declaration(self, src, pos, hack=False):
         """declaration
         : ident S* ':' S* expr prio?
         | /* empty */
         ;
         """
         # property
-        property_name, src = self._get_ident(src)
+        if hack:
+            property_name, pos = self._get_match_result(self.re_nmchars, src, pos, group=0)
+            property_name = '-nothing-' + property_name
+        else:
+            property_name, pos = self._get_ident(src, pos)
 
         if property_name is not None:
-            src = src.lstrip()
+            pos = self._skip_s(src, pos)
             # S* : S*
-            if src[:1] in (':', '='):
+            if src[pos:pos + 1] in (':', '='):
                 # Note: we are being fairly flexable here...  technically, the
                 # ":" is *required*, but in the name of flexibility we
                 # suppor a null transition, as well as an "=" transition
-                src = src[1:].lstrip()
+                pos = self._skip_s(src, pos + 1)
 
-            src, property = self._parse_declaration_property(src, property_name)
+            pos, property = self._parse_declaration_property(src, pos, property_name)
         else:
             property = None
 
-        return src, property
+        return pos, property
 
-    def _parse_declaration_property(self, src, propertyName):
+    def _parse_declaration_property(self, src, pos, propertyName):
         # expr
-        src, expr = self._parse_expression(src)
+        pos, expr = self._parse_expression(src, pos)
 
         # prio?
-        important, src = self._get_match_result(self.re_important, src)
-        src = src.lstrip()
+        important, pos = self._get_match_result(self.re_important, src, pos)
+        pos = self._skip_s(src, pos)
 
         property = self.css_builder.property(propertyName, expr, important)
-        return src, property
+        return pos, property
 
-    def _parse_expression(self, src, returnList=False):
+    def _parse_expression(self, src, pos, returnList=False):
         """
         expr
         : term [ operator term ]*
         ;
         """
-        src, term = self._parse_expression_term(src)
+        pos, term = self._parse_expression_term(src, pos)
         operator = None
-        while src[:1] not in ('', ';', '{', '}', '[', ']', ')'):
+        while src[pos:pos + 1] not in ('', ';', '{', '}', '[', ']', ')'):
             for operator in self.expression_operators:
-                if src.startswith(operator):
-                    src = src[len(operator):]
+                if src.startswith(operator, pos):
+                    pos += len(operator)
                     break
             else:
                 operator = ' '
-            src, term2 = self._parse_expression_term(src.lstrip())
+            pos, term2 = self._parse_expression_term(src, self._skip_s(src, pos))
             if term2 is NotImplemented:
                 break
             else:
@@ -1042,11 +1055,11 @@ class CSSParser(object):
 
         if operator is None and returnList:
             term = self.css_builder.combine_terms(term, None, None)
-            return src, term
+            return pos, term
         else:
-            return src, term
+            return pos, term
 
-    def _parse_expression_term(self, src):
+    def _parse_expression_term(self, src, pos):
         """term
         : unary_operator?
             [ NUMBER S* | PERCENTAGE S* | LENGTH S* | EMS S* | EXS S* | ANGLE S* |
@@ -1054,68 +1067,91 @@ class CSSParser(object):
         | STRING S* | IDENT S* | URI S* | RGB S* | UNICODERANGE S* | hexcolor
         ;
         """
-        ctxsrc = src
+        ctxpos = pos
 
-        result, src = self._get_match_result(self.re_num, src)
+        result, pos = self._get_match_result(self.re_num, src, pos)
         if result is not None:
-            units, src = self._get_match_result(self.re_unit, src)
+            units, pos = self._get_match_result(self.re_unit, src, pos)
             term = self.css_builder.term_number(result, units)
-            return src.lstrip(), term
+            return self._skip_s(src, pos), term
 
-        result, src = self._get_string(src, self.re_uri)
+        result, pos = self._get_string(src, pos, self.re_uri)
         if result is not None:
             # XXX URL!!!!
             term = self.css_builder.term_uri(result)
-            return src.lstrip(), term
+            return self._skip_s(src, pos), term
 
-        result, src = self._get_string(src)
+        result, pos = self._get_string(src, pos)
         if result is not None:
             term = self.css_builder.term_string(result)
-            return src.lstrip(), term
+            return self._skip_s(src, pos), term
 
-        result, src = self._get_match_result(self.re_functionterm, src)
+        result, pos = self._get_match_result(self.re_functionterm, src, pos)
         if result is not None:
-            src, params = self._parse_expression(src, True)
-            if src[0] != ')':
-                raise self.ParseError('Terminal function expression expected closing \')\'', src, ctxsrc)
-            src = src[1:].lstrip()
+            pos, params = self._parse_expression(src, pos, True)
+            if src[pos] != ')':
+                raise self._error('Terminal function expression expected closing \')\'', src, pos, ctxpos)
+            pos = self._skip_s(src, pos + 1)
             term = self.css_builder.term_function(result, params)
-            return src, term
+            return pos, term
 
-        result, src = self._get_match_result(self.re_rgbcolor, src)
+        result, pos = self._get_match_result(self.re_rgbcolor, src, pos)
         if result is not None:
             term = self.css_builder.term_rgb(result)
-            return src.lstrip(), term
+            return self._skip_s(src, pos), term
 
-        result, src = self._get_match_result(self.re_unicoderange, src)
+        result, pos = self._get_match_result(self.re_unicoderange, src, pos)
         if result is not None:
             term = self.css_builder.term_unicode_range(result)
-            return src.lstrip(), term
+            return self._skip_s(src, pos), term
 
-        nsPrefix, src = self._get_match_result(self.re_namespace_selector, src)
-        result, src = self._get_ident(src)
+        nsPrefix, pos = self._get_match_result(self.re_namespace_selector, src, pos)
+        result, pos = self._get_ident(src, pos)
         if result is not None:
             if nsPrefix is not None:
                 result = self.css_builder.resolve_namespace_prefix(nsPrefix, result)
             term = self.css_builder.term_ident(result)
-            return src.lstrip(), term
+            return self._skip_s(src, pos), term
 
-        result, src = self._get_match_result(self.re_unicodeid, src)
+        result, pos = self._get_match_result(self.re_unicodeid, src, pos)
         if result is not None:
             term = self.css_builder.term_ident(result)
-            return src.lstrip(), term
+            return self._skip_s(src, pos), term
 
-        return self.css_builder.term_unknown(src)
+        # An unknown term never extends past the end of its declaration, so
+        # the builder only gets to see the source up to there
+        end = self.re_term_end.search(src, pos)
+        return self._call_builder(self.css_builder.term_unknown, src, pos, end and end.start())
 
     # ~ utility methods ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-    def _get_ident(self, src, default=None):
-        return self._get_match_result(self.re_ident, src, default)
+    def _skip_s(self, src, pos):
+        return self.re_s.match(src, pos).end()
 
-    def _get_string(self, src, rexpression=None, default=None):
+    def _error(self, msg, src, pos, ctxpos):
+        return self.ParseError(msg, src[pos:], src[ctxpos:])
+
+    def _call_builder(self, callback, src, pos, end=None):
+        """Hands src[pos:end] to a builder callback which takes and returns
+        the source still to be parsed, such as CSSBuilderAbstract.at_ident,
+        and turns the returned source back into an offset.
+        """
+        if end is None:
+            end = len(src)
+        rest = src[pos:end]
+        rest, result = callback(rest)
+        if not src.endswith(rest, pos, end):
+            raise self.ParseError('Builder returned source which does not follow the parsed source',
+                                  rest, src[pos:])
+        return end - len(rest), result
+
+    def _get_ident(self, src, pos, default=None):
+        return self._get_match_result(self.re_ident, src, pos, default)
+
+    def _get_string(self, src, pos, rexpression=None, default=None):
         if rexpression is None:
             rexpression = self.re_string
-        result = rexpression.match(src)
+        result = rexpression.match(src, pos)
         if result:
             strres = filter(None, result.groups())
             if strres:
@@ -1125,20 +1161,19 @@ class CSSParser(object):
                     strres = result.groups()[0]
             else:
                 strres = ''
-            return strres, src[result.end():]
+            return strres, result.end()
         else:
-            return default, src
+            return default, pos
 
-    def _get_string_or_uri(self, src):
-        result, src = self._get_string(src, self.re_uri)
+    def _get_string_or_uri(self, src, pos):
+        result, pos = self._get_string(src, pos, self.re_uri)
         if result is None:
-            result, src = self._get_string(src)
-        return result, src
+            result, pos = self._get_string(src, pos)
+        return result, pos
 
-    def _get_match_result(self, rexpression, src, default=None, group=1):
-        result = rexpression.match(src)
+    def _get_match_result(self, rexpression, src, pos, default=None, group=1):
+        result = rexpression.match(src, pos)
         if result:
-            return result.group(group), src[result.end():]
+            return result.group(group), result.end()
         else:
-            return default, src
-
+            return default, pos
@@ -123,6 +123,42 @@ class PmlBaseDoc(BaseDocTemplate):
             self.canv.setPageDuration(self.pml_data["duration"])
         '''
 
+    def start_build(self):
+        """
+        Starts laying out a story which is handed over in parts with
+        add_flowables and finished by end_build, for documents which are
+        rendered while they are parsed. Does what build does, in steps.
+        """
+        self._pending = []
+        self._startBuild()
+        self._savedInfo = self.canv._doc.info
+        self.canv._doctemplate = self
+
+    def add_flowables(self, flowables):
+        pending = self._pending
+        pending.extend(flowables)
+        # handle_keepWithNext puts a flowable together with the following
+        # ones, those at the end are kept until the next flowables arrive
+        kept = 0
+        while kept < len(pending) and pending[-1 - kept].getKeepWithNext():
+            kept += 1
+        while len(pending) > kept:
+            self._handle_pending()
+
+    def end_build(self):
+        while self._pending:
+            self._handle_pending()
+        del self.canv._doctemplate
+        self.canv._doc.info = self._savedInfo
+        self._endBuild()
+
+    def _handle_pending(self):
+        # The loop of BaseDocTemplate.build, xhtml2pdf does not use the
+        # PageBreakIfNotEmpty it handles
+        if hasattr(self, "clean_hanging"):
+            self.clean_hanging()
+        self.handle_flowable(self._pending)
+
     def afterFlowable(self, flowable):
         # Does the flowable contain fragments?
         if getattr(flowable, "outline", False):